@@ -0,0 +1,211 @@
+# batch.py -- convert a whole folder of lightburn exports in one go, one file per worker process.
+#
+# Running millburn.py and postProcessZBug.py for each file of a job means starting the interpreter twice
+# per file, and uses one core.  This tool takes any number of files, directories (every .nc file in them)
+# and glob patterns, and runs the conversion -- followed by the Z-bug post-process, unless --no-zfix is
+# given -- on each file in a pool of worker processes.  Within a worker the stages are chained as
+# generators, exactly as in a 'millburn.py ... - | postProcessZBug.py - ...' pipe, so nothing is written
+# to disk between them.
+#
+# Each output file is written next to its input (or in --outdir), named <name><suffix>.nc, e.g.
+# job.nc -> job_mill.nc.  Input files whose names already end in the suffix are skipped, so running the
+# batch again over the same folder doesn't convert its own output.
+#
+# A file that fails (bad input, unreadable, ...) is reported, its partial output is removed, and the rest of
+# the batch carries on.  The time taken for each file is reported as it finishes, with a summary at the end.
+#
+#   python batch.py jobs/ --outdir out/ --jobs 8 --optimize
+
+import os
+import sys
+import glob
+import time
+import shutil
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from settings import SETTINGS
+import diagnostics
+import millburn
+from postProcessZBug import add_zfix_arguments, zfix_stage_lines, zfix_summaries
+from gcodeio import open_input, open_output
+from cache import ConversionCache, file_digest, convert_key, zfix_key, option_values
+
+DEFAULT_SUFFIX = '_mill'
+INPUT_EXTENSIONS = ('.nc',)
+
+
+def find_inputs(patterns, suffix=DEFAULT_SUFFIX):
+    '''
+    The input files named by a list of files, directories and glob patterns (sorted, without duplicates).
+    '''
+    found = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            paths = [os.path.join(pattern, name) for name in os.listdir(pattern)
+                     if name.lower().endswith(INPUT_EXTENSIONS)]
+        else:
+            paths = glob.glob(pattern) or [pattern]     # a missing file is reported by its worker
+        for path in paths:
+            stem = os.path.splitext(os.path.basename(path))[0]
+            if suffix and stem.endswith(suffix):
+                continue
+            if not os.path.isdir(path):
+                found.append(os.path.normpath(path))
+    return sorted(set(found))
+
+
+def output_path(inputfile, outdir=None, suffix=DEFAULT_SUFFIX):
+    stem, ext = os.path.splitext(os.path.basename(inputfile))
+    return os.path.join(outdir or os.path.dirname(inputfile), stem + suffix + (ext or '.nc'))
+
+
+def convert_file(inputfile, outputfile, args):
+    '''
+    Convert (and Z-fix) one file; runs in a worker process.  Returns a dict of results for the file;
+    a failure is returned as its 'error' rather than raised.
+    '''
+    started = time.perf_counter()
+    result = {'input': inputfile, 'output': outputfile, 'error': None}
+    state = {}
+    stats = {}
+    zstate = {}
+    try:
+        if args.cache:
+            meta, result['cache'] = _convert_cached(inputfile, outputfile, args)
+            result['summaries'] = meta['summaries']
+            result['lines in'] = meta['lines in']
+        else:
+            with open_input(inputfile) as infil, open_output(outputfile) as f:
+                lines = millburn.stage_lines(infil, args, state, stats)
+                if args.zfix:
+                    lines = zfix_stage_lines(lines, args, zstate)
+                f.writelines(lines)
+            result['summaries'] = millburn.stage_summaries(args, state, stats)
+            if args.zfix:
+                result['summaries'].extend(zfix_summaries(args, zstate))
+            result['lines in'] = state['counts']['lines in']
+    except Exception as e:
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+        try:
+            os.remove(outputfile)
+        except OSError:
+            pass
+    result['seconds'] = time.perf_counter() - started
+    return result
+
+
+def _convert_cached(inputfile, outputfile, args):
+    # convert_file() through the cache: returns the stored counts, and 'hit', 'convert hit' (only the Z-bug
+    # post-process was run) or 'miss'
+    cache = ConversionCache(args.cache_dir, args.cache_size)
+    ckey = convert_key(file_digest(inputfile), option_values(args, millburn.add_stage_arguments))
+    key = zfix_key(ckey, option_values(args, add_zfix_arguments)) if args.zfix else ckey
+    found = cache.lookup(key)
+    if found is not None:
+        path, meta = found
+        shutil.copyfile(path, outputfile)
+        return meta, 'hit'
+
+    found = cache.lookup(ckey)
+    if found is None:
+        state = {}
+        stats = {}
+        with open_input(inputfile) as infil, open_output(outputfile) as f:
+            f.writelines(millburn.stage_lines(infil, args, state, stats))
+        meta = {'summaries': millburn.stage_summaries(args, state, stats), 'lines in': state['counts']['lines in']}
+        path = cache.store(ckey, outputfile, meta)
+        if not args.zfix:
+            return meta, 'miss'
+        usage = 'miss'
+    else:
+        path, meta = found
+        usage = 'convert hit'
+
+    zstate = {}
+    with open_input(path) as infil, open_output(outputfile) as f:
+        f.writelines(zfix_stage_lines(infil, args, zstate))
+    meta = {'summaries': meta['summaries'] + zfix_summaries(args, zstate), 'lines in': meta['lines in']}
+    cache.store(key, outputfile, meta)
+    return meta, usage
+
+
+def run_batch(inputs, args, diag):
+    '''
+    Convert the input files in a pool of args.jobs processes, reporting each one as it finishes.
+    Returns the number of files that failed.
+    '''
+    failed = converted = lines_in = cache_hits = 0
+    cpu_seconds = 0.0
+    started = time.perf_counter()
+    if args.outdir:
+        os.makedirs(args.outdir, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = {pool.submit(convert_file, path, output_path(path, args.outdir, args.suffix), args): path
+                   for path in inputs}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:          # the worker itself died
+                result = {'input': futures[future], 'error': '{}: {}'.format(type(e).__name__, e), 'seconds': 0.0}
+            cpu_seconds += result['seconds']
+            if result['error'] is not None:
+                failed += 1
+                diag.error('batch', 'FAILED - {}: {}'.format(result['input'], result['error']),
+                           input=result['input'], error=result['error'])
+                continue
+            converted += 1
+            lines_in += result['lines in']
+            counts = {'input': result['input'], 'output': result['output'],
+                      'lines in': result['lines in'], 'seconds': round(result['seconds'], 3)}
+            if args.cache:
+                counts['cache'] = result['cache']
+                cache_hits += result['cache'] == 'hit'
+            diag.summary('file', counts)
+            if diag.trace:
+                for stage, counts in result['summaries']:
+                    diag.event('batch', 'summary', '  {}: {}'.format(stage, counts), input=result['input'],
+                               stage_summary=stage, counts=counts)
+    elapsed = time.perf_counter() - started
+    counts = {'files': len(inputs), 'converted': converted, 'failed': failed}
+    if args.cache:
+        counts['cache hits'] = cache_hits
+    counts.update({'lines in': lines_in, 'worker seconds': round(cpu_seconds, 3), 'elapsed seconds': round(elapsed, 3)})
+    diag.summary('batch', counts)
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='batch.py',
+                                     description='convert many lightburn gcode files in parallel')
+    parser.add_argument('inputs', nargs='+', help='.nc files, directories and/or glob patterns')
+    parser.add_argument('--outdir', help='directory for the output files (default: next to each input)')
+    parser.add_argument('--suffix', default=DEFAULT_SUFFIX,
+                        help='added to each input name to make its output name (default %(default)s)')
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count(),
+                        help='number of worker processes (default: one per CPU, %(default)s)')
+    parser.add_argument('--no-zfix', dest='zfix', action='store_false',
+                        help="don't run the Z-bug post-process after the conversion")
+    parser.add_argument('--cache', action='store_true',
+                        help='reuse the stored output of an unchanged job (see cache.py)')
+    parser.add_argument('--cache-dir', default=SETTINGS.CacheDir, help='cache directory (default %(default)s)')
+    parser.add_argument('--cache-size', type=int, default=SETTINGS.CacheMaxBytes,
+                        help='cache size limit in bytes (default %(default)s)')
+    add_zfix_arguments(parser)
+    millburn.add_stage_arguments(parser)
+    diagnostics.add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    with diagnostics.from_args(args) as diag:
+        if not args.suffix and not args.outdir:
+            diag.error('batch', 'an empty --suffix needs an --outdir (the inputs would be overwritten)')
+            return 1
+        inputs = find_inputs(args.inputs, args.suffix)
+        if not inputs:
+            diag.error('batch', 'no input files found')
+            return 1
+        failed = run_batch(inputs, args, diag)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
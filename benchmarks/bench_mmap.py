@@ -0,0 +1,84 @@
+# bench_mmap.py -- compare the text (decode every line) and memory-mapped (--mmap) input backends of
+#                  millburn.py and postProcessZBug.py on a large generated file.
+#
+# The file is a mix of what lightburn writes for vector work (travel moves, G1 moves with and without
+# S/F words) and for raster engraving, repeated until it reaches the requested size.  Both backends are
+# run on it, their outputs are checked to be identical, and the throughput of each is reported.
+#
+# usage: python benchmarks/bench_mmap.py [size-in-MB (default 1024)] [work-directory]
+
+import os
+import sys
+import time
+import filecmp
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import millburn
+import postProcessZBug
+
+
+def make_block():
+    # about 1MB of mixed vector and raster gcode
+    lines = []
+    for shape in range(60):
+        x0 = 10 + shape * 3.5
+        lines.append("G0 X{:.3f}Y{:.3f}\n".format(x0, 20.0))
+        lines.append("G1 X{:.3f}Y{:.3f}S800F1200\n".format(x0 + 1, 20.0))
+        for i in range(200):
+            lines.append("G1 X{:.3f}Y{:.3f}\n".format(x0 + 1 + (i % 7) * 0.25, 20.0 + i * 0.1))
+    for row in range(40):
+        y = 50 + row * 0.1
+        lines.append("G0 X10Y{:.2f}\n".format(y))
+        for i in range(100):
+            lines.append("G1 X{:.2f}S{}\n".format(10 + i * 0.1, 100 + (i * 37 + row) % 600))
+    lines.append("M5\nM4\n")
+    return ''.join(lines).encode('ascii')
+
+
+def make_file(path, megabytes):
+    block = make_block()
+    with open(path, 'wb') as f:
+        f.write(b"G00 G17 G40 G21 G54\nG90\nM4\n")
+        for _ in range(max(1, megabytes * 1024 * 1024 // len(block))):
+            f.write(block)
+        f.write(b"M5\nM2\n")
+
+
+def timed(label, func, argv, size):
+    start = time.perf_counter()
+    func(argv)
+    elapsed = time.perf_counter() - start
+    print('  {:<24} {:8.2f}s  {:8.1f} MB/s'.format(label, elapsed, size / elapsed / 1e6))
+    return elapsed
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    megabytes = int(argv[0]) if argv else 1024
+    with tempfile.TemporaryDirectory(dir=argv[1] if len(argv) > 1 else None) as tmp:
+        source = os.path.join(tmp, 'job.nc')
+        make_file(source, megabytes)
+        size = os.path.getsize(source)
+        print('input: {:,} bytes'.format(size))
+
+        print('millburn.py (convert):')
+        text = timed('text', millburn.main, [source, os.path.join(tmp, 'text.nc'), '-q'], size)
+        mapped = timed('mmap', millburn.main, [source, os.path.join(tmp, 'mmap.nc'), '--mmap', '-q'], size)
+        print('  speedup {:.2f}x, outputs identical: {}'.format(
+            text / mapped, filecmp.cmp(os.path.join(tmp, 'text.nc'), os.path.join(tmp, 'mmap.nc'), shallow=False)))
+        os.remove(os.path.join(tmp, 'mmap.nc'))
+
+        converted = os.path.join(tmp, 'text.nc')
+        size = os.path.getsize(converted)
+        print('postProcessZBug.py (zfix), {:,} bytes:'.format(size))
+        text = timed('text', postProcessZBug.main, [converted, os.path.join(tmp, 'ztext.nc'), '-q'], size)
+        mapped = timed('mmap', postProcessZBug.main, [converted, os.path.join(tmp, 'zmmap.nc'), '--mmap', '-q'], size)
+        print('  speedup {:.2f}x, outputs identical: {}'.format(
+            text / mapped, filecmp.cmp(os.path.join(tmp, 'ztext.nc'), os.path.join(tmp, 'zmmap.nc'), shallow=False)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,61 @@
+# bench_simplify.py -- throughput and reduction of the simplify stage on a dense engraving.
+#
+# The synthetic job is what lightburn writes for curved artwork: circles and spirals made of
+# ~0.2mm G1 moves, plus short straight runs, already converted to mill gcode.
+#
+# usage: python benchmarks/bench_simplify.py [number-of-lines] [tolerance-mm]
+
+import math
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import simplify
+from millburn import convert_lines
+
+
+def make_lines(n):
+    lines = ["G00 G17 G40 G21 G54\n", "G90\n", "M4\n"]
+    shape = 0
+    while len(lines) < n:
+        cx = 20 + (shape * 37) % 260
+        cy = 20 + (shape * 53) % 260
+        r = 2 + (shape * 7) % 40
+        turns = 1 + shape % 3
+        steps = max(12, int(turns * 2 * math.pi * r / 0.2))
+        lines.append("G0 X{:.3f}Y{:.3f}\n".format(cx + r, cy))
+        for i in range(1, steps + 1):
+            a = turns * 2 * math.pi * i / steps
+            rr = r * (1.0 - 0.3 * i / steps) if shape % 2 else r      # every other shape is a spiral
+            lines.append("G1 X{:.3f}Y{:.3f}{}\n".format(cx + rr * math.cos(a), cy + rr * math.sin(a),
+                                                      "S300F3000" if i == 1 else ""))
+        lines.append("G0 X{:.3f}Y{:.3f}\n".format(cx, cy))
+        for i in range(1, 40):
+            lines.append("G1 X{:.3f}Y{:.3f}{}\n".format(cx + i * 0.1, cy, "S300F3000" if i == 1 else ""))
+        shape += 1
+    lines.append("M5\n")
+    return lines
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    n = int(argv[0]) if argv else 200000
+    tolerance = float(argv[1]) if len(argv) > 1 else 0.01
+    converted = list(convert_lines(make_lines(n)))
+    stats = {}
+    start = time.perf_counter()
+    out = sum(1 for _ in simplify.simplify_lines(converted, tolerance, stats=stats))
+    elapsed = time.perf_counter() - start
+    in_bytes = sum(len(line) for line in converted)
+    print('simplify: {:,} lines in {:.2f}s ({:,.0f} lines/sec), {:,} lines out'.format(
+        len(converted), elapsed, len(converted) / elapsed, out))
+    for name, value in simplify.summary(stats).items():
+        print('  {}: {}'.format(name, value))
+    print('  input size: {:,} bytes'.format(in_bytes))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,64 @@
+# bench_startup.py -- cold-start time of each millburn.py command, and which optional heavy modules it loads.
+#
+# Each command is started as a fresh interpreter (with --help, so it does nothing but start up and parse its
+# arguments) a number of times, and the median wall time is reported next to that of a bare interpreter.  A
+# second run of each command reports whether it imported NumPy or pyserial: neither should be loaded just to
+# start up (NumPy is only imported by a conversion with a batch big enough to use it, pyserial only when a
+# port is opened).
+#
+# usage: python benchmarks/bench_startup.py [runs (default 20)]
+
+import os
+import sys
+import time
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+COMMANDS = ('convert', 'zfix', 'validate', 'send', 'estimate', 'batch', 'parallel', 'cache')
+HEAVY_MODULES = ('numpy', 'serial')
+
+# run 'millburn.py <command> --help' in-process, then report the heavy modules it imported
+_PROBE = '''
+import sys
+sys.path.insert(0, {root!r})
+sys.argv = ['millburn.py', {command!r}, '--help']
+import millburn
+try:
+    millburn.main()
+except SystemExit:
+    pass
+sys.stdout = sys.__stdout__
+print(' '.join(name for name in {heavy!r} if name in sys.modules) or '-')
+'''
+
+
+def median_ms(argv, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(argv, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=ROOT)
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return times[len(times) // 2] * 1000
+
+
+def heavy_imports(command):
+    probe = _PROBE.format(root=ROOT, command=command, heavy=HEAVY_MODULES)
+    result = subprocess.run([sys.executable, '-c', probe], capture_output=True, text=True, cwd=ROOT)
+    return result.stdout.strip().splitlines()[-1] if result.stdout.strip() else '?'
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    runs = int(argv[0]) if argv else 20
+    baseline = median_ms([sys.executable, '-c', 'pass'], runs)
+    print('{:<12} {:>8}  {:>8}  {}'.format('command', 'ms', 'over', 'heavy modules loaded'))
+    print('{:<12} {:8.1f}'.format('(python)', baseline))
+    for command in COMMANDS:
+        elapsed = median_ms([sys.executable, 'millburn.py', command, '--help'], runs)
+        print('{:<12} {:8.1f}  {:8.1f}  {}'.format(command, elapsed, elapsed - baseline, heavy_imports(command)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
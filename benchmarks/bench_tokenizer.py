@@ -0,0 +1,81 @@
+# bench_tokenizer.py -- compare the single-pass gcodewords tokenizer with the per-word re.search
+#                       calls that millburn.py used to make on every G1 line.
+#
+# This is a parity check, not a speed-up: the two run at about the same rate (measured from 1.0x to 1.4x,
+# depending on the machine and Python version), but parse_line() reads every word, in every form (integer
+# and leading-dot numbers, signs, G01, lower case, comments), where the old patterns read five fixed ones
+# and missed or mangled several of those forms.  A ratio well below 1.0 means parse_line() has regressed.
+#
+# usage: python benchmarks/bench_tokenizer.py [number-of-lines]
+
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from gcodewords import parse_line
+
+
+def make_lines(n):
+    # a mix of the G1 forms lightburn writes: spaced/unspaced, decimal/integer, with and without S/F
+    lines = []
+    for i in range(n):
+        x = (i % 4000) * 0.05
+        y = (i // 4000) * 0.1
+        if i % 4 == 0:
+            lines.append("G1 X{:.3f} Y{:.3f} S{:.2f} F{:.2f}\n".format(x, y, 100 + i % 900, 3000.0))
+        elif i % 4 == 1:
+            lines.append("G1 X{:.2f}Y{:.2f}S{}\n".format(x, y, 100 + i % 900))
+        elif i % 4 == 2:
+            lines.append("G1 X{:.3f} Y{:.3f}\n".format(x, y))
+        else:
+            lines.append("G1 X{}Y{}Z-{:.2f}F1200\n".format(int(x), int(y), 0.1))
+    return lines
+
+
+def regex_per_word(lines):
+    # the original approach: one re.search (i.e. one scan of the line) per word
+    for line in lines:
+        match = re.search(r'X(-?\d+\.\d+)', line)
+        x = float(match.group(1)) if match else None
+        match = re.search(r'Y(-?\d+\.\d+)', line)
+        y = float(match.group(1)) if match else None
+        match = re.search(r'Z(-?\d+\.\d+)', line)
+        z = float(match.group(1)) if match else None
+        match = re.search(r'S(\d+\.\d+)', line)
+        s = match.group(1) if match else None
+        match = re.search(r'F(\d+\.\d+)', line)
+        f = float(match.group(1)) if match else None
+
+
+def single_pass(lines):
+    for line in lines:
+        words = parse_line(line)
+        x, y, z, s, f = words.get('X'), words.get('Y'), words.get('Z'), words.get('S'), words.get('F')
+
+
+def bench(name, func, lines, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(lines)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print('{:<24} {:>12,.0f} lines/sec  ({:.3f}s for {:,} lines)'.format(name, len(lines) / best, best, len(lines)))
+    return best
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    n = int(argv[0]) if argv else 200000
+    lines = make_lines(n)
+    old = bench('re.search per word', regex_per_word, lines)
+    new = bench('gcodewords.parse_line', single_pass, lines)
+    print('parse_line / re.search rate: {:.2f}x'.format(old / new))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
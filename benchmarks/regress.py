@@ -0,0 +1,265 @@
+# regress.py -- the benchmark and regression suite: throughput, peak memory and output digests of the
+#               conversion (millburn.py, with each of its optional stages), the Z-bug post-process
+#               (postProcessZBug.py, with and without --coalesce) and the parallel.py and batch.py drivers,
+#               on each of the synthetic workloads in workloads.py (raster, vector, mixed) at each size (10k,
+#               1M, 10M lines).
+#
+# Every stage runs in its own interpreter, so its peak memory (max RSS of the main process) is its own, and
+# is timed from just before to just after its main() (not counting interpreter start-up).  Then:
+#
+#   - the SHA-256 of the output of each stage (and option) is compared with the golden digest in
+#     golden.json: any change in the output fails the run (the workloads are generated deterministically),
+#   - --simplify may drop points, but must only ever move to points of the original path: every XY position
+#     its output reaches has to be one the plain conversion reaches (a kept single-axis move that picked up the other
+#     axis from the wrong point would not be),
+#   - the stages that must give the same output as another -- --mmap, parallel.py, batch.py, and batch.py
+#     through its cache (a miss, then a hit, then a 'convert hit' with a different post-process option) --
+#     are compared with the output of that one, and the cache runs must report the cache use expected,
+#   - lines/sec and peak memory are reported, and compared with baselines.json if there is one.  Timings
+#     depend on the machine (and on what else it is doing), so by default they are only reported, never a
+#     failure; record a machine's own baselines with --update-baselines (baselines.json is not under version
+#     control), and then --fail-on-regression makes a slowdown or memory growth beyond the tolerance a failure.
+#
+# --update-golden records the current outputs' digests (after a deliberate change of output).  Entries
+# missing from golden.json are reported as 'new' and don't fail the run.  The exit status is 1 if an output
+# changed or differed (or, with --fail-on-regression, a stage regressed).
+#
+# usage: python benchmarks/regress.py [--sizes 10k,1M] [--workloads raster,vector,mixed] [--tolerance 0.3]
+#                                     [--update-baselines] [--fail-on-regression] [--update-golden] [--workdir DIR]
+
+import os
+import sys
+import json
+import shutil
+import hashlib
+import argparse
+import tempfile
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, '..')
+sys.path.insert(0, HERE)
+sys.path.insert(0, ROOT)
+
+from workloads import SIZES, WORKLOADS, write_workload
+from gcodewords import parse_line
+
+BASELINES = os.path.join(HERE, 'baselines.json')
+GOLDEN = os.path.join(HERE, 'golden.json')
+DEFAULT_SIZES = ('10k', '1M')
+DEFAULT_TOLERANCE = 0.3
+
+_FILES = ['{input}', '{output}', '-q']
+_BATCH = ['{input}', '--outdir', '{dir}', '--suffix', '', '--jobs', '1']
+_CACHE = _BATCH + ['--cache', '--cache-dir', '{cache}']
+_CHUNKS = ['--jobs', '4', '--min-chunk', '32768']
+
+# (stage, tool module, arguments, input: the workload or the 'convert' output, golden output, cache use
+# expected).  A stage whose golden output has already been produced by an earlier stage must give the same.
+STAGES = (
+    ('convert', 'millburn', _FILES, 'source', 'convert', None),
+    ('convert --mmap', 'millburn', _FILES + ['--mmap'], 'source', 'convert', None),
+    ('convert --optimize', 'millburn', _FILES + ['--optimize'], 'source', 'convert --optimize', None),
+    ('convert --passes', 'millburn', _FILES + ['--passes'], 'source', 'convert --passes', None),
+    ('convert --ramp', 'millburn', _FILES + ['--passes', '--ramp'], 'source', 'convert --passes --ramp', None),
+    ('convert --simplify', 'millburn', _FILES + ['--simplify'], 'source', 'convert --simplify', None),
+    ('convert --compact', 'millburn', _FILES + ['--compact'], 'source', 'convert --compact', None),
+    ('zfix', 'postProcessZBug', _FILES, 'convert', 'zfix', None),
+    ('zfix --mmap', 'postProcessZBug', _FILES + ['--mmap'], 'convert', 'zfix', None),
+    ('zfix --coalesce', 'postProcessZBug', _FILES + ['--coalesce'], 'convert', 'zfix --coalesce', None),
+    ('zfix --co --mmap', 'postProcessZBug', _FILES + ['--coalesce', '--mmap'], 'convert', 'zfix --coalesce', None),
+    ('parallel', 'parallel', _FILES + _CHUNKS, 'source', 'zfix', None),
+    ('parallel --no-zfix', 'parallel', _FILES + _CHUNKS + ['--no-zfix'], 'source', 'convert', None),
+    ('parallel --co', 'parallel', _FILES + _CHUNKS + ['--coalesce'], 'source', 'zfix --coalesce', None),
+    ('batch', 'batch', _BATCH + ['-q'], 'source', 'zfix', None),
+    ('batch --cache', 'batch', _CACHE, 'source', 'zfix', 'cache miss'),
+    ('batch --cache hit', 'batch', _CACHE, 'source', 'zfix', 'cache hit'),
+    ('batch --cache --co', 'batch', _CACHE + ['--coalesce'], 'source', 'zfix --coalesce', 'cache convert hit'),
+)
+
+# stages whose output must only reach XY positions that the plain conversion reaches
+ON_PATH = ('convert --simplify',)
+
+# run one tool's main() in a fresh interpreter, and report its time and peak memory
+_RUNNER = '''
+import sys, json, time, resource
+sys.path.insert(0, sys.argv[1])
+module = __import__(sys.argv[2])
+start = time.perf_counter()
+status = module.main(sys.argv[3:])
+seconds = time.perf_counter() - start
+print(json.dumps({'status': status, 'seconds': seconds,
+                  'peak KB': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}))
+'''
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def xy_positions(path):
+    # the XY positions reached by the moves of an (absolute) gcode file, rounded to 0.1um
+    positions = set()
+    x = y = motion = None
+    with open(path) as f:
+        for line in f:
+            words = parse_line(line)
+            if words.motion is not None:
+                motion = words.motion
+            elif 'G' in words or motion is None:
+                continue
+            x = words.get('X', x)
+            y = words.get('Y', y)
+            if x is not None and y is not None:
+                positions.add((round(x, 4), round(y, 4)))
+    return positions
+
+
+def run_stage(module, argv):
+    # run a tool: its measurements, and in 'log' what it wrote to stderr
+    result = subprocess.run([sys.executable, '-c', _RUNNER, ROOT, module] + argv, capture_output=True, text=True)
+    measured = json.loads(result.stdout.strip().splitlines()[-1]) if result.returncode == 0 else {}
+    if measured.get('status', 1) != 0:
+        raise RuntimeError('{} failed:\n{}'.format(module, result.stderr))
+    measured['log'] = result.stderr
+    return measured
+
+
+def load(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except OSError:
+        return {}
+
+
+def save(path, data):
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+        f.write('\n')
+
+
+def check(key, measured, baselines, tolerance):
+    # compare one stage's measurements with its baseline: returns 'ok', '-' (no baseline) or what is worse
+    baseline = baselines.get(key)
+    if baseline is None:
+        return '-'
+    worse = []
+    if measured['lines per second'] < baseline['lines per second'] * (1 - tolerance):
+        worse.append('{:.0%} slower'.format(1 - measured['lines per second'] / baseline['lines per second']))
+    if measured['peak KB'] > baseline['peak KB'] * (1 + tolerance):
+        worse.append('{:.0%} more memory'.format(measured['peak KB'] / baseline['peak KB'] - 1))
+    return ', '.join(worse) if worse else 'ok'
+
+
+def run_suite(workloads, sizes, tolerance, workdir, update_baselines=False, update_golden=False,
+              fail_on_regression=False):
+    '''
+    Run every stage on every workload and size; returns the number of failures.
+
+    fail_on_regression counts a stage that is slower or uses more memory than its baseline as a failure.
+    '''
+    baselines = load(BASELINES)
+    golden = load(GOLDEN)
+    failures = 0
+    print('{:<24} {:<20} {:>12} {:>9} {:>9}  {:<10} {}'.format(
+        'workload', 'stage', 'lines/sec', 'MB/sec', 'peak MB', 'output', 'performance'))
+    for size in sizes:
+        count = SIZES[size]
+        for kind in workloads:
+            name = '{}/{}'.format(kind, size)
+            top = os.path.join(workdir, '{}_{}'.format(kind, size))
+            os.mkdir(top)
+            filename = '{}_{}.nc'.format(kind, size)
+            paths = {'source': os.path.join(top, filename)}
+            write_workload(paths['source'], kind, count)
+            recorded = {}           # golden output -> the digest of its first stage this run
+            for number, (stage, module, argv, source, output, cache_use) in enumerate(STAGES):
+                stagedir = os.path.join(top, str(number))
+                os.mkdir(stagedir)
+                outputfile = os.path.join(stagedir, filename)
+                measured = run_stage(module, [arg.format(input=paths[source], output=outputfile, dir=stagedir,
+                                                         cache=os.path.join(top, 'cache')) for arg in argv])
+                paths.setdefault(output, outputfile)
+                size_in = os.path.getsize(paths[source])
+                measured['lines per second'] = count / measured['seconds']
+
+                key = '{}/{}'.format(name, stage)
+                digest = file_digest(outputfile)
+                golden_key = '{}/{}'.format(name, output)
+                recorded_now = golden_key not in recorded
+                if golden_key in recorded:
+                    # a variant (--mmap, parallel, batch, cache) of a stage already run: it must give the same output
+                    verdict = 'ok' if recorded[golden_key] == digest else 'DIFFERS'
+                    if cache_use is not None and ', {}\n'.format(cache_use) not in measured['log']:
+                        verdict = 'NOT ' + cache_use.upper()
+                    failures += verdict != 'ok'
+                elif update_golden:
+                    golden[golden_key] = digest
+                    verdict = 'recorded'
+                elif golden_key not in golden:
+                    verdict = 'new'
+                elif golden[golden_key] == digest:
+                    verdict = 'ok'
+                else:
+                    verdict = 'CHANGED'
+                    failures += 1
+                if recorded_now:
+                    recorded[golden_key] = digest
+                if stage in ON_PATH and not xy_positions(outputfile) <= xy_positions(paths['convert']):
+                    verdict = 'OFF PATH'
+                    failures += 1
+                if update_baselines:
+                    baselines[key] = {'lines per second': round(measured['lines per second']),
+                                      'peak KB': measured['peak KB']}
+                    performance = 'recorded'
+                else:
+                    performance = check(key, measured, baselines, tolerance)
+                    if fail_on_regression and performance not in ('ok', '-'):
+                        performance = performance.upper()
+                        failures += 1
+                print('{:<24} {:<20} {:>12,.0f} {:>9.1f} {:>9.1f}  {:<10} {}'.format(
+                    name, stage, measured['lines per second'], size_in / measured['seconds'] / 1e6,
+                    measured['peak KB'] / 1024, verdict, performance))
+            shutil.rmtree(top)          # the 10M-line files are big
+    if update_baselines:
+        save(BASELINES, baselines)
+    if update_golden:
+        save(GOLDEN, golden)
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='regress.py', description='benchmark and regression suite')
+    parser.add_argument('--sizes', default=','.join(DEFAULT_SIZES),
+                        help='comma-separated sizes, of {} (default %(default)s)'.format(', '.join(SIZES)))
+    parser.add_argument('--workloads', default=','.join(WORKLOADS),
+                        help='comma-separated workloads (default %(default)s)')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='slowdown / memory growth over the baseline worth reporting (default %(default)s)')
+    parser.add_argument('--update-baselines', action='store_true', help='record the measurements as the baselines')
+    parser.add_argument('--fail-on-regression', action='store_true',
+                        help='count a slowdown or memory growth over the baseline as a failure')
+    parser.add_argument('--update-golden', action='store_true', help="record the outputs' digests as golden")
+    parser.add_argument('--workdir', help='directory for the generated files (default: a temporary directory)')
+    args = parser.parse_args(argv)
+    sizes = args.sizes.split(',')
+    workloads = args.workloads.split(',')
+    for value, known in ((sizes, SIZES), (workloads, WORKLOADS)):
+        unknown = [item for item in value if item not in known]
+        if unknown:
+            parser.error('unknown: {}'.format(', '.join(unknown)))
+
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        failures = run_suite(workloads, sizes, args.tolerance, workdir, args.update_baselines, args.update_golden,
+                             args.fail_on_regression)
+    print('{} failure{}'.format(failures, '' if failures == 1 else 's'))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
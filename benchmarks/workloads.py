@@ -0,0 +1,149 @@
+# workloads.py -- synthetic lightburn-style gcode, for the benchmarks and the regression suite (regress.py).
+#
+# Each generator yields exactly 'count' lines (header and footer included), deterministically for a given
+# seed, so its output -- and the converted output -- can be checked against stored digests:
+#
+#   raster   raster engraving: back-and-forth rows of short G1 moves with a changing S on nearly every
+#            move, as lightburn writes for images,
+#   vector   vector cutting: closed contours (polygons and circles of 3-decimal G1 moves), each started by a
+#            G0 travel and a G1 that sets S/F,
+#   mixed    a mix of G0/G1 moves with integer and decimal words, spaced and unspaced, 'G00'/'G01' forms,
+#            occasional Z words, comments and M codes, G1 lines that only set S/F followed by moves
+#            with no G word (which rely on the G1 as the motion mode), and fine staircases of single-axis
+#            moves (lightburn leaves out an axis that doesn't change).
+#
+#   python benchmarks/workloads.py raster 1000000 raster_1M.nc
+
+import math
+import random
+import sys
+
+HEADER = ("G00 G17 G40 G21 G54\n", "G90\n", "M4\n")
+FOOTER = ("M5\n", "M2\n")
+
+SIZES = {'10k': 10000, '1M': 1000000, '10M': 10000000}
+
+
+def _with_frame(body, count):
+    # the header, 'count' lines in all from body, and the footer
+    count = max(count, len(HEADER) + len(FOOTER))
+    for line in HEADER:
+        yield line
+    remaining = count - len(HEADER) - len(FOOTER)
+    for line in body:
+        if remaining <= 0:
+            break
+        yield line
+        remaining -= 1
+    for line in FOOTER:
+        yield line
+
+
+def _raster(rng):
+    row = 0
+    while True:
+        y = 20 + row * 0.1
+        forwards = row % 2 == 0
+        yield "G0 X{:.1f}Y{:.2f}\n".format(10.0 if forwards else 110.0, y)
+        yield "G1 F3000\n"
+        for i in range(1, 1001):
+            x = 10 + i * 0.1 if forwards else 110 - i * 0.1
+            yield "G1 X{:.1f}S{}\n".format(x, rng.randrange(0, 1000, 5))
+        row += 1
+
+
+def _vector(rng):
+    while True:
+        cx = rng.uniform(20, 280)
+        cy = rng.uniform(20, 280)
+        r = rng.uniform(1, 30)
+        power = rng.choice((800, 900, 1000, 300, 500))
+        feed = rng.choice((600, 1200, 3000))
+        if rng.random() < 0.5:
+            sides = rng.randrange(3, 9)
+        else:
+            sides = max(12, int(2 * math.pi * r / 0.3))         # a circle, as ~0.3mm chords
+        yield "G0 X{:.3f}Y{:.3f}\n".format(cx + r, cy)
+        for k in range(1, sides + 1):
+            a = 2 * math.pi * k / sides
+            x = cx + r * math.cos(a)
+            y = cy + r * math.sin(a)
+            if k == 1:
+                yield "G1 X{:.3f}Y{:.3f}S{}F{}\n".format(x, y, power, feed)
+            else:
+                yield "G1 X{:.3f}Y{:.3f}\n".format(x, y)
+
+
+def _mixed(rng):
+    x = y = 0.0
+    while True:
+        choice = rng.random()
+        if choice < 0.1:
+            x = rng.randrange(0, 300)
+            y = rng.randrange(0, 300)
+            yield rng.choice(("G0 X{}Y{}\n", "G00 X{} Y{}\n")).format(x, y)
+        elif choice < 0.15:
+            yield "G1 X{} Y{} S{} F{}\n".format(int(x) + 1, int(y), rng.randrange(100, 1000), rng.choice((600, 1200)))
+        elif choice < 0.17:
+            yield "G1 Z-{:.2f} F100\n".format(rng.choice((0.1, 0.2, 0.5)))
+        elif choice < 0.18:
+            yield "; segment {}\n".format(rng.randrange(1000))
+        elif choice < 0.185:
+            yield rng.choice(("M5\n", "M4\n", "M8\n", "M9\n"))
+        elif choice < 0.192:
+            # a staircase of single-axis steps, finer than the chordal tolerance, then a long move along X
+            for _ in range(rng.randrange(5, 40)):
+                y += 0.009
+                yield "G1 Y{:.3f}\n".format(y)
+                x += 0.009
+                yield "G1 X{:.3f}\n".format(x)
+            x += rng.uniform(5, 50)
+            yield "G1 X{:.3f}\n".format(x)
+        elif choice < 0.197:
+            # a G1 that only sets the speeds, then moves that rely on it as the motion mode
+            yield "G1 S{} F{}\n".format(rng.randrange(100, 1000), rng.choice((600, 1200)))
+            for _ in range(rng.randrange(1, 4)):
+                x += rng.uniform(-2, 2)
+                y += rng.uniform(-2, 2)
+                yield "X{:.3f} Y{:.3f}\n".format(x, y)
+        else:
+            x += rng.uniform(-2, 2)
+            y += rng.uniform(-2, 2)
+            form = rng.random()
+            if form < 0.4:
+                yield "G1 X{:.3f}Y{:.3f}\n".format(x, y)
+            elif form < 0.7:
+                yield "G1 X{:.2f} Y{:.2f}\n".format(x, y)
+            elif form < 0.9:
+                yield "G01 X{:.3f} Y{:.3f} S{}\n".format(x, y, rng.randrange(100, 1000))
+            else:
+                yield "G1 X{}Y{}\n".format(int(round(x)), int(round(y)))
+
+
+WORKLOADS = {'raster': _raster, 'vector': _vector, 'mixed': _mixed}
+
+
+def workload_lines(kind, count, seed=1):
+    '''
+    Generator: 'count' lines of the named workload (see WORKLOADS).
+    '''
+    return _with_frame(WORKLOADS[kind](random.Random(seed)), count)
+
+
+def write_workload(path, kind, count, seed=1):
+    with open(path, 'w', newline='\n') as f:
+        f.writelines(workload_lines(kind, count, seed))
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 3 or argv[0] not in WORKLOADS:
+        print('usage: python benchmarks/workloads.py {} LINES FILE'.format('|'.join(WORKLOADS)), file=sys.stderr)
+        return 2
+    count = SIZES.get(argv[1]) or int(argv[1])
+    write_workload(argv[2], argv[0], count)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
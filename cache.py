@@ -0,0 +1,204 @@
+# cache.py -- an on-disk, content-addressed cache of converted (and Z-fixed) outputs.
+#
+# The same lightburn exports are converted again and again while one value in mappings.py is tweaked.  Each
+# stage's output is stored under a key that covers everything it depends on:
+#
+#   convert:  the SHA-256 of the input file, the mappings.py settings, the stage options (--optimize,
+#             --passes, ...) and the source of the conversion modules (so a code change is a new key),
+#   zfix:     the convert key, the post-process options (--dwell, --coalesce) and the post-processor source.
+#
+# So an unchanged job is just copied out of the cache, and a change that only affects the Z-bug pass (e.g.
+# --dwell) re-runs only the post-process, on the cached conversion.  Settings that can't change the output
+# (the serial port, the estimator's machine limits, ...) are left out of the keys.
+#
+# Entries are files in CacheDir (mappings.py) named by their key, each with a small .json file of the stage's
+# counts, so a cache hit still reports them.  When the cache grows beyond CacheMaxBytes the least recently
+# used entries are removed.
+#
+#   python cache.py              show the cache's size
+#   python cache.py --clear      empty it
+
+import os
+import sys
+import json
+import shutil
+import hashlib
+import argparse
+import tempfile
+from settings import SETTINGS
+import diagnostics
+
+CONVERT_MODULES = ('millburn', 'remap', 'modal', 'optimize', 'passes', 'simplify', 'gcodewords', 'gcodeio')
+ZFIX_MODULES = ('postProcessZBug', 'gcodewords', 'gcodeio')
+
+# mappings.py settings that don't affect the conversion (the post-process ones go in the zfix key)
+ZFIX_SETTINGS = ('ZBugDwell',)
+UNUSED_SETTINGS = ('RapidRateXY', 'RapidRateZ', 'AccelerationXY', 'AccelerationZ', 'JunctionDeviation',
+                   'PlannerBlocks', 'SerialPort', 'SerialBaudRate', 'ControllerRxBufferSize', 'CacheDir',
+                   'CacheMaxBytes')
+
+_HASH_BLOCK_SIZE = 1024 * 1024
+_ENTRY_SUFFIX = '.nc'
+_META_SUFFIX = '.json'
+
+
+def file_digest(path):
+    # the SHA-256 of a file's contents, as hex
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(_HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def source_digest(modules):
+    # the SHA-256 of the source of some modules: the tool version, as far as the cache is concerned
+    digest = hashlib.sha256()
+    for name in modules:
+        module = __import__(name)
+        with open(os.path.splitext(module.__file__)[0] + '.py', 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def setting_values(names=None, exclude=()):
+    # the settings (all of them, or those named), as a sorted list of (name, repr(value))
+    values = SETTINGS.as_dict()
+    return sorted((name, repr(values[name])) for name in (names or values) if name not in exclude)
+
+
+def option_values(args, add_arguments):
+    # the values in args of the options that add_arguments() (e.g. millburn.add_stage_arguments) adds to a parser
+    parser = argparse.ArgumentParser(add_help=False)
+    add_arguments(parser)
+    return {name: getattr(args, name) for name in vars(parser.parse_args([]))}
+
+
+def make_key(*parts):
+    '''
+    A cache key (hex SHA-256) for a list of JSON-able parts.
+    '''
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def convert_key(input_digest, options):
+    # the key of a conversion: options is a dict of the stage options
+    return make_key('convert', input_digest, setting_values(exclude=ZFIX_SETTINGS + UNUSED_SETTINGS), options,
+                    source_digest(CONVERT_MODULES))
+
+
+def zfix_key(convert, options):
+    # the key of a post-process of a conversion
+    return make_key('zfix', convert, setting_values(ZFIX_SETTINGS), options, source_digest(ZFIX_MODULES))
+
+
+class ConversionCache(object):
+    '''
+    a directory of stage outputs, each stored under its key (see convert_key() and zfix_key()).
+    '''
+
+    def __init__(self, directory=SETTINGS.CacheDir, max_bytes=SETTINGS.CacheMaxBytes):
+        self.directory = os.path.expanduser(directory)
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + _ENTRY_SUFFIX)
+
+    def lookup(self, key):
+        '''
+        The path and stored counts of a cached output, or None if there is none.  A hit counts as a use.
+        '''
+        path = self.path(key)
+        try:
+            with open(os.path.join(self.directory, key + _META_SUFFIX)) as f:
+                meta = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return path, meta
+
+    def store(self, key, source, meta):
+        '''
+        Store a copy of the file 'source' (and its counts, meta) under key; returns the entry's path.
+        '''
+        path = self.path(key)
+        # write under temporary names and rename, so a reader (or another worker) never sees a partial entry,
+        # and the counts only appear once the output is complete
+        for suffix, write in ((_ENTRY_SUFFIX, lambda f: _copy(source, f)),
+                              (_META_SUFFIX, lambda f: f.write(json.dumps(meta).encode('utf-8')))):
+            fd, temp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    write(f)
+                os.replace(temp, os.path.join(self.directory, key + suffix))
+            except BaseException:
+                os.remove(temp)
+                raise
+        self.evict(keep=key)
+        return path
+
+    def entries(self):
+        # (last used, size, key) of every entry
+        found = []
+        for name in os.listdir(self.directory):
+            if name.endswith(_ENTRY_SUFFIX):
+                try:
+                    st = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                found.append((st.st_mtime, st.st_size, name[:-len(_ENTRY_SUFFIX)]))
+        return found
+
+    def evict(self, keep=None):
+        # remove the least recently used entries (but not 'keep', e.g. the one just stored and about to be used)
+        # until the cache fits in max_bytes; returns the number removed
+        entries = sorted(self.entries())
+        total = sum(size for used, size, key in entries)
+        removed = 0
+        for used, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            self.remove(key)
+            total -= size
+            removed += 1
+        return removed
+
+    def remove(self, key):
+        for suffix in (_META_SUFFIX, _ENTRY_SUFFIX):
+            try:
+                os.remove(os.path.join(self.directory, key + suffix))
+            except OSError:
+                pass
+
+    def clear(self):
+        for used, size, key in self.entries():
+            self.remove(key)
+
+
+def _copy(source, f):
+    with open(source, 'rb') as src:
+        shutil.copyfileobj(src, f, _HASH_BLOCK_SIZE)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='cache.py', description='show or clear the conversion cache')
+    parser.add_argument('--dir', default=SETTINGS.CacheDir, help='cache directory (default %(default)s)')
+    parser.add_argument('--clear', action='store_true', help='remove every entry')
+    diagnostics.add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    with diagnostics.from_args(args) as diag:
+        cache = ConversionCache(args.dir)
+        if args.clear:
+            cache.clear()
+        entries = cache.entries()
+        diag.summary('cache', {'directory': cache.directory, 'entries': len(entries),
+                               'bytes': sum(size for used, size, key in entries), 'limit': cache.max_bytes})
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,135 @@
+# controller.py -- one persistent session with the grblHAL controller, shared by the millburn tools.
+#
+# Opening the serial port resets most grbl boards, and each reset costs a couple of seconds of start-up, so
+# the tools open the port once per run, through a ControllerSession, and do everything over that:
+#
+#   - command() sends one line and reads its whole response, however many lines it has, up to the final
+#     'ok' (or 'error:N', which raises ControllerError),
+#   - settings() returns the '$$' settings, parsed into a dict of '$N' -> value text.  They are read from the
+#     controller once and cached; set_setting() keeps the cache up to date, and invalidate_settings() drops
+#     it (e.g. after something else may have changed the settings),
+#   - stream() sends a batch of lines with character-counting flow control (see sender.py), e.g. a whole
+#     program, or a set of G10 offset writes (write_offsets()) that would otherwise each wait for their own
+#     reply.
+#
+#   with ControllerSession() as session:
+#       if session.settings()['$100'] != '250.000': ...
+#       session.write_offsets(['G10 L20 P1 X0 Y0 Z0', 'G10 L20 P2 X0 Y0 Z0'])
+
+import time
+from settings import SETTINGS
+import diagnostics
+from sender import Sender, SendError, open_port, clean_line, REPLY_TIMEOUT, WAKE_TIME, DEFAULT_INTERVAL
+
+
+class ControllerError(SendError):
+    pass
+
+
+def parse_settings(lines):
+    '''
+    Parse the lines of a '$$' listing (e.g. '$110=3000.000') into a dict of '$N' -> value text.
+    '''
+    settings = {}
+    for line in lines:
+        line = line.strip()
+        if line.startswith('$') and '=' in line:
+            param, value = line.split('=', 1)
+            settings[param.strip()] = value.split('(')[0].split(';')[0].strip()
+    return settings
+
+
+class ControllerSession(object):
+    '''
+    an open connection to the controller: synchronous commands, cached settings and streaming.
+    '''
+
+    def __init__(self, path=SETTINGS.SerialPort, baud=SETTINGS.SerialBaudRate,
+                 rx_buffer_size=SETTINGS.ControllerRxBufferSize, diag=None, port=None, wake=WAKE_TIME,
+                 reply_timeout=REPLY_TIMEOUT):
+        # port: an already open port (anything with pyserial's write()/readline()/close()) instead of path/baud
+        # wake: seconds to wait for the controller to start up (0 = it is already awake)
+        # reply_timeout: seconds of silence while streaming before giving up (0 = never, see sender.py)
+        self.diag = diagnostics.Diagnostics(diagnostics.SILENT) if diag is None else diag
+        self.port = open_port(path, baud) if port is None else port
+        self.sender = Sender(self.port, rx_buffer_size, self.diag, reply_timeout)
+        self._settings = None
+        if wake:
+            self.sender.wake(wake)
+
+    def command(self, line, timeout=REPLY_TIMEOUT):
+        '''
+        Send one line and return the lines of its response (without the final 'ok').
+        '''
+        text = clean_line(line)
+        self.port.write((text + '\n').encode('ascii'))
+        response = []
+        deadline = time.monotonic() + timeout
+        while True:
+            raw = self.port.readline()
+            if not raw:
+                if time.monotonic() > deadline:
+                    raise ControllerError("no reply to '{}' from the controller".format(text))
+                continue
+            reply = raw.decode('ascii', 'replace').strip()
+            if reply == 'ok':
+                return response
+            if reply.startswith('error') or reply.startswith('ALARM'):
+                raise ControllerError("'{}' -> {}".format(text, reply))
+            if reply:
+                response.append(reply)
+                deadline = time.monotonic() + timeout
+
+    def settings(self):
+        '''
+        The controller's '$$' settings as a dict of '$N' -> value text (read once, then cached).
+        '''
+        if self._settings is None:
+            self._settings = parse_settings(self.command('$$'))
+        return dict(self._settings)
+
+    def set_setting(self, param, value):
+        # e.g. set_setting('$100', '250.000')
+        self.command('{}={}'.format(param, value))
+        if self._settings is not None:
+            self._settings[param] = str(value)
+
+    def invalidate_settings(self):
+        self._settings = None
+
+    def stream(self, lines, progress=None, interval=DEFAULT_INTERVAL, wait=False):
+        '''
+        Send lines with character-counting flow control; returns the sender's stats.
+
+        wait also waits for the machine to finish moving.  Lines the controller rejects are in
+        self.sender.errors.
+        '''
+        self.sender.start()
+        try:
+            stats = self.sender.send(lines, progress, interval)
+            if wait:
+                self.sender.wait_idle()
+        finally:
+            self.sender.stop()
+        return stats
+
+    def write_offsets(self, commands):
+        # send a batch of G10 (coordinate offset) commands in one go; raise if any is rejected
+        errors = len(self.sender.errors)
+        self.stream(commands)
+        if len(self.sender.errors) > errors:
+            number, text, reply = self.sender.errors[errors]
+            raise ControllerError("'{}' -> {}".format(text, reply))
+
+    def close(self):
+        if self.port is not None:
+            self.sender.stop()
+            self.port.close()
+            self.port = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
@@ -0,0 +1,105 @@
+# diagnostics.py -- verbosity-controlled reporting for the millburn tools.
+#
+# Printing a message for every gcode line makes terminal I/O the bottleneck on large files, so the
+# tools report through a Diagnostics object instead of calling print() in their main loops:
+#
+#   SILENT   - nothing but errors
+#   SUMMARY  - (default) one line of aggregate counts per stage when the stage finishes
+#   DEBUG    - every per-line message as well (the old behaviour)
+#
+# Optionally, every event (per-line messages and summaries) is also written as one JSON object per line
+# to a diagnostics file, for later analysis.
+#
+# The converters check diag.trace (True only when per-line events are wanted) before building
+# a per-line message, and keep their counters in local variables that are handed to
+# diag.summary() once at the end, so the default mode costs (almost) nothing per line.
+#
+# All console output goes to stderr, so it never mixes with gcode written to stdout.
+
+import sys
+import json
+
+SILENT = 0
+SUMMARY = 1
+DEBUG = 2
+
+
+class Diagnostics(object):
+
+    def __init__(self, level=SUMMARY, jsonl_path=None, stream=None):
+        self.level = level
+        self.stream = sys.stderr if stream is None else stream
+        self.jsonl = open(jsonl_path, "w") if jsonl_path else None
+        # trace: are per-line events wanted at all (on the console or in the diagnostics file)?
+        self.trace = level >= DEBUG or self.jsonl is not None
+
+    def event(self, stage, kind, message, **fields):
+        # a per-line event; callers should only build these when self.trace is True
+        if self.level >= DEBUG:
+            print(message, file=self.stream)
+        if self.jsonl is not None:
+            record = {'stage': stage, 'event': kind, 'message': message}
+            record.update(fields)
+            self.jsonl.write(json.dumps(record) + '\n')
+
+    def error(self, stage, message, **fields):
+        # errors are always reported
+        print(message, file=self.stream)
+        if self.jsonl is not None:
+            record = {'stage': stage, 'event': 'error', 'message': message}
+            record.update(fields)
+            self.jsonl.write(json.dumps(record) + '\n')
+
+    def summary(self, stage, counts):
+        # aggregate counts for a completed stage, e.g. summary('convert', {'lines in': 10, ...})
+        if self.level >= SUMMARY:
+            text = ', '.join('{} {}'.format(name, _format_count(value)) for name, value in counts.items())
+            print('SUMMARY - {}: {}'.format(stage, text), file=self.stream)
+        if self.jsonl is not None:
+            record = {'stage': stage, 'event': 'summary'}
+            record.update(counts)
+            self.jsonl.write(json.dumps(record) + '\n')
+
+    def report(self, stage, text, fields):
+        # a multi-line report that was asked for (e.g. --profile): printed unless quiet, and written to the
+        # diagnostics file as one record
+        if self.level >= SUMMARY:
+            print(text, file=self.stream)
+        if self.jsonl is not None:
+            record = {'stage': stage, 'event': 'report'}
+            record.update(fields)
+            self.jsonl.write(json.dumps(record) + '\n')
+
+    def close(self):
+        if self.jsonl is not None:
+            self.jsonl.close()
+            self.jsonl = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def _format_count(value):
+    if isinstance(value, float):
+        return '{:.4f}'.format(value).rstrip('0').rstrip('.')
+    return str(value)
+
+
+def add_arguments(parser):
+    # add the common verbosity options to a command-line parser
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('-q', '--quiet', action='store_const', dest='verbosity', const=SILENT,
+                       default=SUMMARY, help='report nothing but errors')
+    group.add_argument('-v', '--verbose', action='store_const', dest='verbosity', const=DEBUG,
+                       help='report every converted line (slow on large files)')
+    parser.add_argument('--diagnostics', metavar='FILE',
+                        help='also write every event as JSON lines to FILE')
+
+
+def from_args(args):
+    # create a Diagnostics object from options added by add_arguments()
+    return Diagnostics(args.verbosity, args.diagnostics)
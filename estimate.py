@@ -0,0 +1,460 @@
+# estimate.py -- estimate how long a (converted) program will take to run on the machine.
+#
+# The program is walked move by move with the same kind of motion model grbl uses:
+#
+#   - each move runs at its feed rate (G1/G2/G3) or at the rapid rate (G0), limited by the maximum rate of
+#     every axis it moves ($110-$112, mm/min), and accelerates/decelerates with a trapezoidal velocity
+#     profile limited by the acceleration of every axis it moves ($120-$122, mm/s^2),
+#   - the speed through the corner between two moves is limited by the junction deviation ($11), as in
+#     grbl's planner, and the planner only looks ahead 'PlannerBlocks' moves, so the machine must always be
+#     able to stop by the end of them,
+#   - arcs are limited to the speed at which their centripetal acceleration stays within the axis limits,
+#   - the machine comes to a stop for dwells (G4), M codes and at the end of the program.
+#
+# The total time is split into cutting (G1/G2/G3 moves in X/Y), rapids (G0 moves in X/Y), Z moves (retracts,
+# plunges and the Z-bug corrections -- anything that only moves Z) and dwells (G4), so the cost of each stage
+# shows: the retract/plunge pairs added by millburn.py, the slow moves and 5s dwells added by
+# postProcessZBug.py, and so on.
+#
+# The machine settings come from a '$$' listing saved from the controller (--settings FILE), or are read from
+# the controller itself (--controller); anything missing falls back to the values in mappings.py.
+#
+#   python estimate.py job_mill.nc --settings grblhal_settings.txt
+
+import os
+import re
+import sys
+import math
+import argparse
+from settings import SETTINGS
+import diagnostics
+from gcodeio import open_input, open_mapped
+from gcodewords import parse_line, MOTION_CODES
+
+WINDOW = 4096                   # moves planned together (the planner only looks PlannerBlocks moves ahead anyway)
+CATEGORIES = ('cutting', 'rapids', 'Z moves', 'dwells')
+
+_CUT, _RAPID, _Z = 0, 1, 2
+_MODE_RE = re.compile(rb'G0*(91|20)(?![0-9.])', re.I)   # relative or inch coordinates: no parallel estimate
+_STOPS = (4.0, 28.0, 30.0)      # G codes after which the machine is stopped
+_UNTIMED = (10.0, 53.0, 92.0)   # offsets and machine-coordinate moves: not timed
+
+
+class Machine(object):
+    '''
+    the machine's motion limits: rates in mm/s, accelerations in mm/s^2.
+    '''
+    __slots__ = ('rates', 'accels', 'junction_deviation', 'planner_blocks')
+
+    def __init__(self, rates=None, accels=None, junction_deviation=SETTINGS.JunctionDeviation,
+                 planner_blocks=SETTINGS.PlannerBlocks):
+        self.rates = rates or (SETTINGS.RapidRateXY / 60.0, SETTINGS.RapidRateXY / 60.0, SETTINGS.RapidRateZ / 60.0)
+        self.accels = accels or (SETTINGS.AccelerationXY, SETTINGS.AccelerationXY, SETTINGS.AccelerationZ)
+        self.junction_deviation = junction_deviation
+        self.planner_blocks = planner_blocks
+
+    @classmethod
+    def from_settings(cls, settings):
+        # from a dict of '$N' -> value text (missing settings take the mappings.py defaults)
+        default = cls()
+
+        def value(param, fallback, scale=1.0):
+            try:
+                return float(settings[param]) * scale
+            except (KeyError, ValueError):
+                return fallback
+        rates = tuple(value('$11{}'.format(k), default.rates[k], 1 / 60.0) for k in range(3))
+        accels = tuple(value('$12{}'.format(k), default.accels[k]) for k in range(3))
+        return cls(rates, accels, value('$11', default.junction_deviation))
+
+    def limits(self, ux, uy, uz):
+        # the highest rate (mm/s) and acceleration (mm/s^2) along a unit direction
+        rate = accel = float('inf')
+        for u, r, a in ((ux, self.rates[0], self.accels[0]), (uy, self.rates[1], self.accels[1]),
+                        (uz, self.rates[2], self.accels[2])):
+            u = abs(u)
+            if u > 1e-9:
+                rate = min(rate, r / u)
+                accel = min(accel, a / u)
+        return rate, accel
+
+
+def _move_time(length, entry, exit, cruise, accel):
+    # time for a trapezoidal (or triangular) velocity profile
+    up = (cruise * cruise - entry * entry) / (2 * accel)
+    down = (cruise * cruise - exit * exit) / (2 * accel)
+    if up + down <= length:
+        return (cruise - entry) / accel + (cruise - exit) / accel + (length - up - down) / cruise
+    peak = math.sqrt(max((2 * accel * length + entry * entry + exit * exit) / 2, 0.0))
+    return max(peak - entry, 0.0) / accel + max(peak - exit, 0.0) / accel
+
+
+class _Planner(object):
+    # a lookahead planner: moves are added one at a time, and timed in windows of WINDOW moves
+
+    def __init__(self, machine, times, counts):
+        self.machine = machine
+        self.times = times              # seconds per category
+        self.counts = counts
+        self.moves = []                 # (length, cruise speed, accel, max entry speed, category)
+        self.entry = 0.0                # speed at the start of the first pending move
+        self.direction = None           # unit direction at the end of the last move added (None = stopped)
+        self.last_cruise = 0.0
+
+    def add(self, length, cruise, accel, start_dir, end_dir, category):
+        machine = self.machine
+        if self.direction is None:
+            junction = 0.0
+        else:
+            px, py, pz = self.direction
+            cos_theta = -(px * start_dir[0] + py * start_dir[1] + pz * start_dir[2])
+            if cos_theta > 0.999999:
+                junction = 0.0                      # a full reversal
+            elif cos_theta < -0.999999:
+                junction = float('inf')             # straight on
+            else:
+                sin_half = math.sqrt(0.5 * (1.0 - cos_theta))
+                junction = math.sqrt(accel * machine.junction_deviation * sin_half / (1.0 - sin_half))
+        if junction > cruise:
+            junction = cruise
+        if junction > self.last_cruise:
+            junction = self.last_cruise
+        self.moves.append((length, cruise, accel, junction, category))
+        self.direction = end_dir
+        self.last_cruise = cruise
+        if len(self.moves) >= WINDOW + machine.planner_blocks:
+            self._plan(WINDOW)
+
+    def stop(self):
+        # the machine comes to a stop: time every pending move
+        if self.moves:
+            self._plan(len(self.moves))
+        self.entry = 0.0
+        self.direction = None
+        self.last_cruise = 0.0
+
+    def _plan(self, count):
+        # time the first 'count' pending moves; the rest are kept, to be planned with the moves that follow
+        moves = self.moves
+        n = len(moves)
+        blocks = self.machine.planner_blocks
+        # the furthest the planner can see from each move: the machine must be able to stop within the next
+        # 'blocks' moves (a sliding sum of 2*a*L)
+        reach = [0.0] * (n + 1)
+        entries = [0.0] * (n + 1)       # squared entry speeds
+        # backward pass: every move must be able to slow down to the entry speed of the next
+        following = 0.0
+        for k in range(n - 1, -1, -1):
+            length, cruise, accel, limit, category = moves[k]
+            reach[k] = total = reach[k + 1] + 2 * accel * length
+            v2 = following + 2 * accel * length
+            if limit * limit < v2:
+                v2 = limit * limit
+            horizon = total - reach[k + blocks if k + blocks < n else n]
+            if horizon < v2:
+                v2 = horizon if horizon > 0.0 else 0.0
+            entries[k] = following = v2
+        # forward pass: and to speed up to it, from the actual speed at its start
+        times = self.times
+        counts = self.counts
+        v = min(self.entry, math.sqrt(entries[0]))
+        for k in range(count):
+            length, cruise, accel, limit, category = moves[k]
+            exit = math.sqrt(min(entries[k + 1], v * v + 2 * accel * length))
+            times[category] += _move_time(length, v, exit, cruise, accel)
+            counts[category] += 1
+            v = exit
+        self.entry = v
+        del moves[:count]
+
+
+def estimate_lines(lines, machine=None, stats=None, state=None):
+    '''
+    Estimate the running time of a program (an iterable of gcode lines) on a machine.
+
+    Returns (and fills in, if given) a dict of seconds and move counts per category; see summary().
+
+    state is an optional dict of the modal state at the first line ('position', 'motion', 'feed'), e.g.
+    from scan_modal_state(); by default the program starts at 0,0,0 with no motion mode or feed rate.
+    '''
+    if machine is None:
+        machine = Machine()
+    if stats is None:
+        stats = {}
+    times = [0.0, 0.0, 0.0]
+    counts = [0, 0, 0]
+    planner = _Planner(machine, times, counts)
+    dwell_time = 0.0
+    dwells = 0
+    state = state or {}
+    x, y, z = state.get('position', (0.0, 0.0, 0.0))
+    motion = state.get('motion')
+    feed = state.get('feed')
+    absolute = True
+    scale = 1.0                 # G20: inches
+    lines_in = 0
+    no_feed = 0
+
+    limit_cache = {}            # direction -> limits (raster lines and Z moves repeat the same few directions)
+    xy_rate, xy_accel = machine.limits(1.0, 0.0, 0.0)
+    xy_rate = min(xy_rate, machine.limits(0.0, 1.0, 0.0)[0])
+    xy_accel = min(xy_accel, machine.limits(0.0, 1.0, 0.0)[1])
+
+    for line in lines:
+        lines_in += 1
+        words = parse_line(line)
+        if not words:
+            continue
+        if 'G' in words:
+            skip = False
+            for letter, value in words.pairs:
+                if letter != 'G':
+                    continue
+                g = float(value)
+                if g in MOTION_CODES:
+                    motion = int(g)
+                elif g == 90.0:
+                    absolute = True
+                elif g == 91.0:
+                    absolute = False
+                elif g == 20.0:
+                    scale = 25.4
+                elif g == 21.0:
+                    scale = 1.0
+                elif g in _STOPS:
+                    planner.stop()
+                    if g == 4.0:
+                        dwell_time += words.get('P', 0.0)
+                        dwells += 1
+                    skip = True
+                elif g in _UNTIMED:
+                    skip = True
+            if skip:
+                continue
+        if 'M' in words:
+            planner.stop()
+        if 'F' in words:
+            feed = words['F'] * scale
+        if motion is None or not ('X' in words or 'Y' in words or 'Z' in words):
+            continue
+
+        # the move's end point
+        if absolute:
+            tx = words['X'] * scale if 'X' in words else x
+            ty = words['Y'] * scale if 'Y' in words else y
+            tz = words['Z'] * scale if 'Z' in words else z
+        else:
+            tx = x + words.get('X', 0.0) * scale
+            ty = y + words.get('Y', 0.0) * scale
+            tz = z + words.get('Z', 0.0) * scale
+        dx, dy, dz = tx - x, ty - y, tz - z
+
+        if motion in (2, 3) and ('I' in words or 'J' in words or 'R' in words):
+            # arc in the XY plane (helical if Z moves too)
+            if 'R' in words:
+                r = abs(words['R'] * scale)
+                chord = math.hypot(dx, dy)
+                if chord == 0.0 or r < chord / 2:
+                    x, y, z = tx, ty, tz
+                    continue
+                sweep = 2 * math.asin(min(chord / (2 * r), 1.0))
+                if words['R'] < 0:
+                    sweep = 2 * math.pi - sweep
+                h = math.sqrt(max(r * r - chord * chord / 4, 0.0))
+                mx, my = x + dx / 2, y + dy / 2
+                side = 1.0 if (motion == 3) == (words['R'] > 0) else -1.0
+                cx = mx - side * h * dy / chord
+                cy = my + side * h * dx / chord
+            else:
+                cx = x + words.get('I', 0.0) * scale
+                cy = y + words.get('J', 0.0) * scale
+                r = math.hypot(x - cx, y - cy)
+                a0 = math.atan2(y - cy, x - cx)
+                a1 = math.atan2(ty - cy, tx - cx)
+                sweep = a1 - a0 if motion == 3 else a0 - a1
+                if sweep <= 1e-12:
+                    sweep += 2 * math.pi
+            if r == 0.0:
+                x, y, z = tx, ty, tz
+                continue
+            length = math.hypot(r * sweep, dz)
+            sign = 1.0 if motion == 3 else -1.0
+            # tangent directions at the start and end of the arc
+            sx, sy = -sign * (y - cy) / r, sign * (x - cx) / r
+            ex, ey = -sign * (ty - cy) / r, sign * (tx - cx) / r
+            start_dir = (sx, sy, 0.0)
+            end_dir = (ex, ey, 0.0)
+            rate, accel = xy_rate, xy_accel
+            rate = min(rate, math.sqrt(accel * r))      # centripetal acceleration limit
+            category = _CUT
+        else:
+            length = math.sqrt(dx * dx + dy * dy + dz * dz)
+            if length == 0.0:
+                continue
+            u = (dx / length, dy / length, dz / length)
+            start_dir = end_dir = u
+            limits = limit_cache.get(u)
+            if limits is None:
+                if len(limit_cache) > 65536:
+                    limit_cache.clear()
+                limits = limit_cache[u] = machine.limits(*u)
+            rate, accel = limits
+            category = _Z if dx == 0.0 and dy == 0.0 else (_RAPID if motion == 0 else _CUT)
+
+        if motion != 0:
+            if not feed:
+                no_feed += 1            # grbl would reject this move
+                x, y, z = tx, ty, tz
+                continue
+            rate = min(rate, feed / 60.0)
+        planner.add(length, rate, accel, start_dir, end_dir, category)
+        x, y, z = tx, ty, tz
+
+    planner.stop()
+    stats['lines in'] = lines_in
+    stats['seconds'] = {'cutting': times[_CUT], 'rapids': times[_RAPID], 'Z moves': times[_Z], 'dwells': dwell_time}
+    stats['moves'] = {'cutting': counts[_CUT], 'rapids': counts[_RAPID], 'Z moves': counts[_Z], 'dwells': dwells}
+    stats['moves without a feed rate'] = no_feed
+    return stats
+
+
+def scan_modal_state(path, start, end):
+    '''
+    The modal state entries ('X', 'Y', 'Z', 'motion', 'feed') last assigned in bytes start..end of a file
+    (entries the range never assigns are left out).  Mirrors the state updates in estimate_lines(), for
+    programs in absolute millimetres (no G91/G20).
+    '''
+    from parallel import reverse_lines
+    found = {}
+    for line in reverse_lines(path, start, end):
+        if len(found) == 5:
+            break
+        words = parse_line(line)
+        if not words:
+            continue
+        if 'G' in words:
+            gcodes = words.gcodes
+            motions = [g for g in gcodes if g in MOTION_CODES]
+            if motions:
+                found.setdefault('motion', int(motions[-1]))
+            if any(g in _STOPS or g in _UNTIMED for g in gcodes):
+                continue
+        if 'F' in words:
+            found.setdefault('feed', words['F'])
+        for letter in 'XYZ':
+            if letter in words:
+                found.setdefault(letter, words[letter])
+    return found
+
+
+def _estimate_chunk(path, start, end, machine, found):
+    # worker: estimate one chunk, starting from the modal state assigned before it
+    state = {'position': tuple(found.get(letter, 0.0) for letter in 'XYZ'),
+             'motion': found.get('motion'), 'feed': found.get('feed')}
+    from parallel import read_chunk
+    return estimate_lines(read_chunk(path, start, end), machine, state=state)
+
+
+def estimate_parallel(path, machine=None, jobs=None, stats=None):
+    '''
+    Estimate a large program file in chunks across 'jobs' worker processes (see estimate_lines()).
+
+    Each chunk is planned as if the machine were stopped at its start and end, which adds a little time
+    per chunk.  Programs that switch to relative (G91) or inch (G20) coordinates are estimated in one piece.
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+    from parallel import chunk_bounds
+    if stats is None:
+        stats = {}
+    jobs = jobs or os.cpu_count()
+    with open_mapped(path) as buf:
+        switches_mode = _MODE_RE.search(buf) is not None
+    bounds = [(0, os.path.getsize(path))] if switches_mode else chunk_bounds(path, jobs)
+    if len(bounds) == 1:
+        with open_input(path) as f:
+            return estimate_lines(f, machine, stats)
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        # the modal state at the start of each chunk
+        states = [{}]
+        for found in pool.map(scan_modal_state, [path] * (len(bounds) - 1), [b[0] for b in bounds[:-1]],
+                              [b[1] for b in bounds[:-1]]):
+            state = dict(states[-1])
+            state.update(found)
+            states.append(state)
+        results = list(pool.map(_estimate_chunk, [path] * len(bounds), [b[0] for b in bounds],
+                                [b[1] for b in bounds], [machine] * len(bounds), states))
+    stats['lines in'] = sum(result['lines in'] for result in results)
+    stats['seconds'] = {category: sum(result['seconds'][category] for result in results) for category in CATEGORIES}
+    stats['moves'] = {category: sum(result['moves'][category] for result in results) for category in CATEGORIES}
+    stats['moves without a feed rate'] = sum(result['moves without a feed rate'] for result in results)
+    stats['chunks'] = len(bounds)
+    return stats
+
+
+def format_time(seconds):
+    # e.g. 3725.5 -> '1:02:06'
+    seconds = int(round(seconds))
+    return '{}:{:02d}:{:02d}'.format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def summary(stats):
+    '''
+    Summarise an estimate: the total time, and the time, share and number of moves of each category.
+    '''
+    seconds = stats['seconds']
+    total = sum(seconds.values())
+    counts = {'total': format_time(total)}
+    for category in CATEGORIES:
+        share = seconds[category] / total if total else 0.0
+        counts[category] = '{} ({:.0%}, {} moves)'.format(format_time(seconds[category]), share,
+                                                         stats['moves'][category])
+    if stats['moves without a feed rate']:
+        counts['moves without a feed rate'] = stats['moves without a feed rate']
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='estimate.py', description='estimate the machine time of a gcode program')
+    parser.add_argument('inputfile', help="gcode file ('-' = stdin)")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--settings', metavar='FILE', help="the controller's settings, as saved from '$$'")
+    source.add_argument('--controller', action='store_true', help="read the settings ('$$') from the controller")
+    parser.add_argument('--port', default=SETTINGS.SerialPort,
+                        help='with --controller, the serial port (default %(default)s)')
+    parser.add_argument('--planner-blocks', type=int, default=SETTINGS.PlannerBlocks,
+                        help="moves the controller's planner looks ahead (default %(default)s)")
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='estimate a large file in chunks across N worker processes (default %(default)s)')
+    diagnostics.add_arguments(parser)
+    args = parser.parse_args(argv)
+    if args.jobs > 1 and args.inputfile == '-':
+        parser.error('--jobs needs an input file')
+
+    with diagnostics.from_args(args) as diag:
+        machine = Machine()
+        if args.settings or args.controller:
+            from controller import ControllerSession, SendError, parse_settings
+            try:
+                if args.settings:
+                    with open(args.settings) as f:
+                        settings = parse_settings(f)
+                else:
+                    with ControllerSession(args.port) as session:
+                        settings = session.settings()
+            except (SendError, OSError) as e:
+                diag.error('estimate', str(e))
+                return 1
+            machine = Machine.from_settings(settings)
+        machine.planner_blocks = args.planner_blocks
+        if args.jobs > 1:
+            stats = estimate_parallel(args.inputfile, machine, args.jobs)
+        else:
+            with open_input(args.inputfile) as infil:
+                stats = estimate_lines(infil, machine)
+        diag.summary('estimate', summary(stats))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
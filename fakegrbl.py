@@ -0,0 +1,176 @@
+# fakegrbl.py -- a stand-in grbl controller on a pty, for trying out (and testing) sender.py without a machine.
+#
+# It opens a pseudo-terminal, prints the name of the device to connect to, and then behaves (roughly) like
+# grblHAL on the other end:
+#
+#   - incoming bytes go into a receive buffer of 'rx_buffer_size' bytes, which (being a ring buffer in
+#     grbl) holds one byte less; bytes that arrive when it is full are dropped and counted as overruns
+#     (a correct sender never causes any),
+#   - complete lines are taken out of the receive buffer into a planner of 'planner_blocks' blocks, and
+#     answered with 'ok' (or 'error:N' for a line grbl would reject); while the planner is full, lines
+#     wait in the receive buffer,
+#   - the planner executes 'rate' blocks per second (0 = instantly),
+#   - a G4 dwell (G4Pn, n in seconds) waits for the planner to finish and then for n seconds before its 'ok',
+#     and nothing after it is taken in meanwhile,
+#   - the real-time '?' status request is answered straight away with '<Idle|...>' or '<Run|...>',
+#   - '$$' lists its settings and '$N=value' changes one.
+#
+# On exit (Ctrl-C) it prints what it saw: lines, errors, overruns and the highest receive buffer fill.
+#
+#   python fakegrbl.py --rx-buffer 128 --rate 500
+
+import os
+import re
+import sys
+import pty
+import time
+import tty
+import select
+import argparse
+from collections import deque
+from settings import SETTINGS
+
+PLANNER_BLOCKS = SETTINGS.PlannerBlocks     # planner buffer size (mappings.py)
+BANNER = b"GrblHAL 1.1f ['$' or '$HELP' for help]\r\n"
+
+DEFAULT_GRBL_SETTINGS = {'$100': '250.000', '$101': '250.000', '$102': '250.000',
+                         '$110': '3000.000', '$111': '3000.000', '$112': '1000.000',
+                         '$120': '200.000', '$121': '200.000', '$122': '100.000'}
+
+_LINE_RE = re.compile(r'^([A-Z][-+]?[0-9]*\.?[0-9]+)*$')
+_SETTING_RE = re.compile(r'^(\$[0-9]+)=(.*)$')
+_DWELL_RE = re.compile(r'^G0*4P([0-9]*\.?[0-9]+)$')
+
+
+class FakeGrbl(object):
+
+    def __init__(self, rx_buffer_size=SETTINGS.ControllerRxBufferSize, planner_blocks=PLANNER_BLOCKS, rate=0.0):
+        self.rx_buffer_size = rx_buffer_size
+        self.planner_blocks = planner_blocks
+        self.block_time = 1.0 / rate if rate > 0 else 0.0
+        self.rx = bytearray()
+        self.planner = deque()
+        self.next_done = None
+        self.dwell_end = None       # when the dwell being executed ends (its 'ok' is held until then)
+        self.lines = 0
+        self.errors = 0
+        self.overruns = 0
+        self.max_rx = 0
+        self.settings = dict(DEFAULT_GRBL_SETTINGS)
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)      # no echo, no newline translation
+        self.name = os.ttyname(self.slave)
+
+    def reply_for(self, line):
+        # the reply grbl would give to a (cleaned) line
+        if line == '$$':
+            return ''.join('{}={}\r\n'.format(k, v) for k, v in sorted(self.settings.items())).encode() + b'ok\r\n'
+        setting = _SETTING_RE.match(line)
+        if setting:
+            if setting.group(1) not in self.settings:
+                return b'error:3\r\n'       # invalid statement
+            self.settings[setting.group(1)] = setting.group(2)
+            return b'ok\r\n'
+        if not _LINE_RE.match(line):
+            return b'error:1\r\n'           # expected command letter
+        return b'ok\r\n'
+
+    def _receive(self, data):
+        replies = bytearray()
+        for byte in data:
+            if byte == 0x3f:        # '?': real-time status request, never buffered
+                state = 'Run' if self.planner else 'Idle'
+                replies += '<{}|MPos:0.000,0.000,0.000|Bf:{},{}>\r\n'.format(
+                    state, self.planner_blocks - len(self.planner), self.rx_buffer_size - len(self.rx)).encode()
+            elif byte == 0x18:      # ctrl-x: soft reset
+                self.rx.clear()
+                self.planner.clear()
+                replies += BANNER
+            elif len(self.rx) >= self.rx_buffer_size - 1:
+                self.overruns += 1
+            else:
+                self.rx.append(byte)
+        self.max_rx = max(self.max_rx, len(self.rx))
+        return replies
+
+    def _execute(self, now):
+        # retire the planner blocks that have finished by now
+        while self.planner and self.next_done is not None and now >= self.next_done:
+            self.planner.popleft()
+            self.next_done = self.next_done + self.block_time if self.planner else None
+
+    def _parse(self, now):
+        # move complete lines from the receive buffer into the planner, answering each one
+        replies = bytearray()
+        if self.dwell_end is not None:
+            if now < self.dwell_end:
+                return replies
+            self.dwell_end = None
+            replies += b'ok\r\n'
+        while len(self.planner) < self.planner_blocks:
+            end = self.rx.find(b'\n')
+            if end < 0:
+                break
+            line = self.rx[:end].decode('ascii', 'replace').strip()
+            del self.rx[:end + 1]
+            dwell = _DWELL_RE.match(line)
+            if dwell:
+                self.lines += 1
+                finished = self.next_done + (len(self.planner) - 1) * self.block_time if self.planner else now
+                self.dwell_end = finished + float(dwell.group(1))
+                break
+            reply = self.reply_for(line)
+            if line:
+                self.lines += 1
+                if not reply.endswith(b'ok\r\n'):
+                    self.errors += 1
+                elif self.block_time and not line.startswith('$'):
+                    self.planner.append(line)
+                    if self.next_done is None:
+                        self.next_done = now + self.block_time
+            replies += reply
+        return replies
+
+    def run(self):
+        while True:
+            timeout = None
+            ends = [end for end in (self.next_done, self.dwell_end) if end is not None]
+            if ends:
+                timeout = max(min(ends) - time.monotonic(), 0.0)
+            ready, _, _ = select.select([self.master], [], [], timeout)
+            replies = bytearray()
+            if ready:
+                replies += self._receive(os.read(self.master, 4096))
+            now = time.monotonic()
+            self._execute(now)
+            replies += self._parse(now)
+            if replies:
+                os.write(self.master, bytes(replies))
+
+    def report(self):
+        return 'lines {}, errors {}, overruns {}, max receive buffer fill {}/{} bytes'.format(
+            self.lines, self.errors, self.overruns, self.max_rx, self.rx_buffer_size)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='fakegrbl.py', description='a stand-in grbl controller on a pty')
+    parser.add_argument('--rx-buffer', type=int, default=SETTINGS.ControllerRxBufferSize,
+                        help='receive buffer size in bytes (default %(default)s)')
+    parser.add_argument('--planner', type=int, default=PLANNER_BLOCKS,
+                        help='planner buffer size in blocks (default %(default)s)')
+    parser.add_argument('--rate', type=float, default=0.0,
+                        help='blocks executed per second (default: instantly)')
+    args = parser.parse_args(argv)
+
+    grbl = FakeGrbl(args.rx_buffer, args.planner, args.rate)
+    print(grbl.name, file=sys.stderr)
+    try:
+        grbl.run()
+    except KeyboardInterrupt:
+        pass
+    print(grbl.report(), file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
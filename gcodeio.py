@@ -0,0 +1,172 @@
+# gcodeio.py -- line-at-a-time, buffered input/output for the millburn tools.
+#
+# The conversion tools never hold a whole gcode file in memory: input is read one line at a time,
+# each line is transformed by a generator, and the results are written through a large output
+# buffer.  Memory use is therefore flat regardless of the size of the input file, and output starts
+# appearing as soon as the first lines have been converted.
+#
+# A path of '-' means stdin (for input) or stdout (for output), so that the conversion and the
+# Z-bug post-process can be run as a single chain with no temporary files, e.g.:
+#
+#   python millburn.py job.nc - | python postProcessZBug.py - job_mill.nc
+#
+# (all informational messages go to stderr, so they never end up in the piped gcode.)
+
+import io
+import os
+import sys
+import mmap
+import locale
+from contextlib import contextmanager
+
+BUFFER_SIZE = 1024 * 1024   # bytes of buffering used for both input and output files
+
+
+@contextmanager
+def open_input(path):
+    # open a gcode file for line-at-a-time reading ('-' = stdin, which is left open on exit)
+    if path == '-':
+        yield sys.stdin
+    else:
+        with open(path, "r", buffering=BUFFER_SIZE) as infil:
+            yield infil
+
+
+@contextmanager
+def open_output(path):
+    # open a gcode file for buffered writing ('-' = stdout, which is flushed but left open on exit)
+    if path == '-':
+        try:
+            yield sys.stdout
+        finally:
+            sys.stdout.flush()
+    else:
+        with open(path, "w", buffering=BUFFER_SIZE) as outfil:
+            yield outfil
+
+
+# --- memory-mapped input -------------------------------------------------------------------------------
+#
+# Most lines of a program pass through the converter and the post-processor unchanged, and don't need to be
+# decoded into str objects at all.  open_mapped() memory-maps an input file, and scan_mapped() splits it into:
+#
+#   - the lines a stage has to look at (those containing a match for the stage's pattern), decoded to str,
+#   - the runs of lines in between, as RawLines: a memoryview of the mapped file (no copy, no decoding),
+#     which the stages pass straight through and write_mixed() writes straight to the (binary) output.
+#
+# Finding and cutting out each line that matches costs more than decoding it along with its neighbours, so
+# where most lines match (raster engraving, where nearly every line sets a new S) this would be slower than
+# text mode.  The file is therefore scanned a window (WINDOW bytes) at a time, and a window in which more
+# than DENSE of the lines of its first SAMPLE bytes match is simply decoded as a whole, as text mode would.
+#
+# The output is byte-for-byte the same as reading and writing in text mode.  Files containing '\r' (whose
+# line endings text mode would translate) are decoded line by line instead (see newlines_translated()).
+
+ENCODING = locale.getpreferredencoding(False)    # the encoding open() uses in text mode
+TEXT_RUN = 4096                                  # str lines encoded and written together
+WINDOW = 1024 * 1024                             # bytes of a mapped file scanned at a time
+SAMPLE = 16 * 1024                               # bytes of each window sampled for its share of matching lines
+DENSE = 0.25                                     # a window with more matching lines than this is decoded whole
+
+
+class RawLines(object):
+    '''
+    a run of whole input lines that is passed through undecoded: 'data' is a memoryview of them,
+    'count' the number of lines.
+    '''
+    __slots__ = ('data', 'count')
+
+    def __init__(self, data, count):
+        self.data = data
+        self.count = count
+
+
+@contextmanager
+def open_mapped(path):
+    # memory-map a file for reading (an empty file gives b'')
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b''
+            return
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield mapped
+        finally:
+            try:
+                mapped.close()
+            except BufferError:     # a RawLines is still referenced somewhere; the map is freed with it
+                pass
+
+
+def newlines_translated(buf):
+    # would text mode change this file's line endings?  (then it can't be passed through as bytes)
+    return buf.find(b'\r') >= 0
+
+
+def scan_mapped(buf, pattern):
+    '''
+    Generator: the lines of buf (a mapped file) that contain a match for the compiled bytes regular
+    expression 'pattern' (which must not match across a newline), decoded to str, with RawLines for
+    the runs of lines in between.
+    '''
+    view = memoryview(buf)
+    size = len(buf)
+    pos = 0
+    search = pattern.search
+    while pos < size:
+        # the next window, ending at a line boundary
+        limit = buf.find(b'\n', min(pos + WINDOW, size) - 1)
+        limit = size if limit < 0 else limit + 1
+        sample = min(pos + SAMPLE, limit)
+        lines = buf[pos:sample].count(b'\n') or 1
+        if len(pattern.findall(buf, pos, sample)) > DENSE * lines:
+            # mostly matching lines: decode the whole window (lines split at '\n' only, as in text mode)
+            yield from io.StringIO(buf[pos:limit].decode(ENCODING), newline='')
+            pos = limit
+            continue
+        while pos < limit:
+            match = search(buf, pos, limit)
+            if match is None:
+                start = end = limit
+            else:
+                start = max(buf.rfind(b'\n', pos, match.start()) + 1, pos)
+                end = buf.find(b'\n', match.start(), limit)
+                end = limit if end < 0 else end + 1
+            if start > pos:
+                count = buf[pos:start].count(b'\n')
+                yield RawLines(view[pos:start], count + (buf[start - 1] != 10))
+            if end > start:
+                yield buf[start:end].decode(ENCODING)
+            pos = end
+
+
+def write_mixed(out, lines):
+    # write str lines and RawLines to a binary file: str lines are encoded in runs, RawLines written as they are
+    text = []
+    for line in lines:
+        if line.__class__ is RawLines:
+            if text:
+                out.write(''.join(text).encode(ENCODING))
+                text = []
+            out.write(line.data)
+        else:
+            text.append(line)
+            if len(text) >= TEXT_RUN:
+                out.write(''.join(text).encode(ENCODING))
+                text = []
+    if text:
+        out.write(''.join(text).encode(ENCODING))
+
+
+@contextmanager
+def open_output_bytes(path):
+    # open a gcode file for buffered binary writing ('-' = stdout, which is flushed but left open on exit)
+    if path == '-':
+        sys.stdout.flush()
+        try:
+            yield sys.stdout.buffer
+        finally:
+            sys.stdout.buffer.flush()
+    else:
+        with open(path, "wb", buffering=BUFFER_SIZE) as outfil:
+            yield outfil
@@ -0,0 +1,121 @@
+# gcodewords.py -- single-pass gcode line tokenizer shared by the millburn tools.
+#
+# Each gcode line is scanned exactly once by a single compiled regular expression, which picks out
+# every word (a letter followed by a number).  The words are kept in a compact Words record
+# (a dict of letter -> value with __slots__ for the extras), so the converter and the post-processor
+# can look up e.g. the X, Z or S value without rescanning the line.
+#
+# Numbers may be integer or decimal, signed or unsigned, with or without a leading zero
+# (e.g. 'S700', 'S700.00', 'Z-0.5', 'Z-.5', 'X+10').  Words need not be separated by spaces
+# (lightburn writes e.g. 'G1 X10.5Y20S700F1200'), and lower case letters are accepted.
+# Comments may be in parentheses '( ... )' or follow a semicolon '; ...'; letters inside comments
+# are never treated as words.
+#
+# The point of the single tokenizer is correctness and one place to get it right, not speed: it reads every
+# word of every form above in about the time the old fixed per-word patterns took to read five of them (and
+# miss some).  benchmarks/bench_tokenizer.py keeps an eye on that; in pure Python the regex scan and building
+# the dict of floats are about all a line costs, so there is little more to win here.
+
+import re
+
+_WORD_RE = re.compile(r'([A-Z])\s*([-+]?[0-9]*\.?[0-9]+)')
+_COMMENT_RE = re.compile(r'\(([^)]*)\)|;(.*)')
+
+# G codes that select a motion mode
+MOTION_CODES = (0.0, 1.0, 2.0, 3.0)
+
+
+class Words(dict):
+    '''
+    The words of a single gcode line, as a dict of upper case letter -> float value
+    (e.g. words['X'], words.get('S')).
+
+    G and M words may appear more than once on a line, so the dict only holds the last of each;
+    all of them are available (in line order) as the tuples 'gcodes' and 'mcodes'.
+    'comment' holds the text of the (last) comment on the line, or None.
+    '''
+    __slots__ = ('pairs', 'comment')
+
+    @property
+    def gcodes(self):
+        if 'G' not in self:
+            return ()
+        return tuple(float(value) for letter, value in self.pairs if letter == 'G')
+
+    @property
+    def mcodes(self):
+        if 'M' not in self:
+            return ()
+        return tuple(float(value) for letter, value in self.pairs if letter == 'M')
+
+    @property
+    def motion(self):
+        # the motion mode (0, 1, 2 or 3 for G0/G1/G2/G3) selected on this line, or None if there is none
+        g = self.get('G')
+        if g is None:
+            return None
+        for letter, value in self.pairs:
+            if letter == 'G':
+                g = float(value)
+                if g in MOTION_CODES:
+                    return int(g)
+        return None
+
+    def __repr__(self):
+        fields = ['%s%s' % pair for pair in self.pairs]
+        if self.comment is not None:
+            fields.append('(%s)' % self.comment)
+        return 'Words(' + ' '.join(fields) + ')'
+
+
+def parse_line(line):
+    '''
+    Tokenize one gcode line into a Words record, scanning the line once.
+    '''
+    comment = None
+    if '(' in line or ';' in line:
+        # rare: pull the comment(s) out first so their letters are not taken as words
+        for paren, semi in _COMMENT_RE.findall(line):
+            comment = (semi or paren).strip()
+        line = _COMMENT_RE.sub(' ', line)
+    if not line.isupper():
+        line = line.upper()
+    pairs = _WORD_RE.findall(line)
+    words = Words({letter: float(value) for letter, value in pairs})
+    words.pairs = pairs
+    words.comment = comment
+    return words
+
+
+def format_number(value):
+    # format a word value compactly, e.g. 10.0 -> '10', -0.25 -> '-0.25' (at most 4 decimal places)
+    text = ('%.4f' % value).rstrip('0').rstrip('.')
+    return '0' if text == '-0' else text
+
+
+def _code_end(line):
+    # where the words of a gcode line end: at the first comment, or the line ending
+    end = len(line.rstrip('\r\n'))
+    for mark in '(;':
+        i = line.find(mark)
+        if 0 <= i < end:
+            end = i
+    return end
+
+
+_DROP_RES = {}
+
+
+def drop_words(line, letters):
+    # remove every word with one of 'letters' (e.g. 'SF') from a gcode line, leaving any comment alone
+    pattern = _DROP_RES.get(letters)
+    if pattern is None:
+        pattern = _DROP_RES[letters] = re.compile(r'\s*[%s]\s*[-+]?[0-9]*\.?[0-9]+' % (letters + letters.lower()))
+    end = _code_end(line)
+    return pattern.sub('', line[:end]) + line[end:]
+
+
+def add_words(line, extra):
+    # add words (e.g. ' S800 F1200') to a gcode line, before any comment and the line ending
+    end = _code_end(line)
+    return line[:end].rstrip() + extra + line[end:]
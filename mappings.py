@@ -39,7 +39,46 @@ defaultSpindleSpeed = 5000
 defaultFeedRate = 400
 DepthPerPass = 0.1
 NumberOfPasses = 2
+PlungeFeedRate = 100        # mm/min: feed rate for plunging (or ramping) down to each pass depth
+ChordalTolerance = 0.01     # mm: how far simplified moves/arcs may stray from the original path
+
+# machine rapid (G0) rates: mm/min.  Only used for estimating machine time (e.g. by the toolpath optimiser).
+RapidRateXY = 3000
+RapidRateZ = 1000
+
+# machine acceleration and cornering, for estimate.py when it isn't given the controller's '$$' settings
+AccelerationXY = 100        # mm/s^2 ($120, $121)
+AccelerationZ = 50          # mm/s^2 ($122)
+JunctionDeviation = 0.01    # mm ($11)
+PlannerBlocks = 35          # moves the controller's planner looks ahead (grblHAL default)
+
+# Z-bug workaround (postProcessZBug.py): dwell after the short correction move at each Z direction change
+ZBugDwell = 5.0             # seconds (G4 P)
 
 # laser power: spindle speed ratio is not linear. Rather, the laser power value + feed rate specified by Snnn + Fnnn values in the input G1 code lines 
 # are used to determine whether this is an engraving or cutting operation. 
 # The SMapping lookup table is used to map the laser power to the spindle speed.
+#
+# SMapping: laser power (Snnn) -> spindle speed, and FMapping: laser feed rate (Fnnn) -> mill feed rate.
+# Each is None, or one of:
+#   ('linear', [(input, output), ...])        -- piecewise-linear interpolation between the points
+#   ('banded', [(min, max, output), ...])     -- a fixed output for each (inclusive) input band
+# Spindle speeds are clamped to CutterMinSpeed..CutterMaxSpeed.
+# SMapping = None: every S becomes defaultSpindleSpeed.   FMapping = None: feed rates are passed through unchanged.
+#
+# e.g.
+# SMapping = ('banded', [(LaserEngravingPowerMin, LaserEngravingPowerMax, 5000),
+#                        (LaserCuttingPowerMin, LaserCuttingPowerMax, 9000)])
+# FMapping = ('linear', [(600, 150), (6000, 600)])
+SMapping = None
+FMapping = None
+
+
+# controller connection, for sender.py (and validateSettings.py)
+SerialPort = '/dev/ttyUSB0'
+SerialBaudRate = 115200
+ControllerRxBufferSize = 1024   # bytes: size of the controller's serial receive buffer (grblHAL default; classic grbl: 128)
+
+# conversion cache (batch.py --cache): converted outputs are kept here, keyed on the input file and these settings
+CacheDir = '~/.cache/millburn'
+CacheMaxBytes = 2 * 1024 * 1024 * 1024     # the least recently used entries are removed beyond this
@@ -1,225 +1,391 @@
-# millburn.py -- convert a lightburn -compatible .nc file into a form that 
-# can be used to generate a toolpath for a (grblhal-controlled) mill.  
-# This is a simple script that reads the gcode file and converts the 2D 
+# millburn.py -- convert a lightburn -compatible .nc file into a form that
+# can be used to generate a toolpath for a (grblhal-controlled) mill.
+# This is a simple script that reads the gcode file and converts the 2D
 # laser path into a 2.5d millpath.  It is not perfect, but it is a start.
-# 
+#
 # if you have a gcode file that you want to convert, you can run this script as follows:
 # python millburn.py <inputfile> <outputfile>
-# 
+#
+# either file may be given as '-' to read from stdin / write to stdout, so the conversion can be
+# piped straight into the Z-bug post-processor:
+# python millburn.py <inputfile> - | python postProcessZBug.py - <outputfile>
+#
+# millburn.py also runs the other tools, as commands: 'python millburn.py zfix ...', 'send', 'validate', ...
+# (see COMMANDS below).
+#
 
-import sys
 import re
-from mappings import *
+import sys
+import argparse
+import importlib
+from settings import SETTINGS
+import diagnostics
+import profiling
+import modal
+import optimize
+import passes
+import remap
+import simplify
+from gcodeio import open_input, open_output, open_mapped, open_output_bytes, newlines_translated, scan_mapped, write_mixed, RawLines
+from gcodewords import parse_line, add_words, drop_words
 
-if len(sys.argv) != 3:
-    print("Usage: python millburn.py <inputfile> <outputfile>")
-    sys.exit(1)
+BATCH_SIZE = 4096     # lines tokenized and remapped together
 
-inputfile = sys.argv[1]
-outputfile = sys.argv[2]
-OutputPower = 0
-OutputFeedRate = 0.0
-CurrentZ = 0.0
+# with --mmap, the only lines convert_lines() has to decode: those with an S, F or Z word, or a G word other
+# than G1 (G1 lines without S/F/Z, and lines without any of these words, pass through unchanged)
+CONVERT_PATTERN = re.compile(rb'[SFZsfz]|[Gg][ \t\f\v]*(?!0*1(?:\.0*)?(?![0-9.]))[-+.0-9]')
+_NO_WORDS = parse_line('')
 
+# 'millburn.py COMMAND ...' runs one of the tools: (command, module, description).  A tool's module is only
+# imported when its command is run, so e.g. pyserial is only loaded by the commands that talk to the controller.
+COMMANDS = (
+    ('convert', None, 'convert lightburn laser gcode into 2.5d mill gcode (the default)'),
+    ('zfix', 'postProcessZBug', 'work around the grblhal Z-axis direction-change bug'),
+    ('validate', 'validateSettings', "check the controller's settings"),
+    ('send', 'sender', 'stream a program to the controller'),
+    ('estimate', 'estimate', 'estimate the machine time of a program'),
+    ('batch', 'batch', 'convert many files in parallel'),
+    ('parallel', 'parallel', 'convert one large file on all cores'),
+    ('cache', 'cache', 'show or clear the conversion cache'),
+)
 
-with open(inputfile, "r") as infil:
-    lines = infil.readlines()   
 
-# open the output file
+def _batches(lines, size):
+    # group an iterable of lines into lists of at most 'size' lines
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
-with open(outputfile, "w") as f:
 
-    # write the header
-    # f.write("G21\n")
-    # f.write("G90\n")
-    # f.write("G17\n")
-    # f.write("G94\n")
+def convert_lines(lines, state=None, diag=None):
+    """
+    Generator: convert an iterable of lightburn gcode lines into 2.5d mill gcode lines.
 
-    # loop through the lines in the input file, making the necessary changes and printing each line to the output file
-    # The following is a description of the changes that are made:
+    Lines are read, transformed and yielded in small batches, so the input can be a file object
+    (or any other iterable) of any size.  The following changes are made:
 
-    #          - inserts z-axis clearance G0 codes before+after each pre-existing G0 rapid move.
-    #            (clearance height is specified by parameter 'ZClearance' in mappings.py)
-    #          - remaps laser power:spindle speeds specified by Snnn values in G1 code lines according to the SMapping lookup table in 'mappings.py'
-    #          - remaps feed rates specified by Fnnn values in G1 code lines according to the FMapping lookup table in 'mappings.py'
-    #          - switches grbl ???$35??? value from laser to spindle mode.
-    #          - deals with M* codes as appropriate
+             - inserts z-axis clearance G0 codes before+after each pre-existing G0 rapid move.
+               (clearance height is specified by parameter 'ZClearance' in mappings.py)
+             - remaps G1 (and G2/G3) Sxxx (laser power) values to spindle speeds, and Fxxx values to mill feed rates,
+               according to the SMapping / FMapping tables in mappings.py (see remap.py).
+               S and F words that would repeat the value already in effect are dropped -- except on the
+               first cut after a rapid or a Z move, which always sets them again (the Z-bug post-process
+               puts a slow F10 move in front of Z moves that change direction).
+             - passes other lines (and arcs without S/F) through unchanged.
 
-    for line in lines:
-        # check if the line is a laser command
-        #print('processing: ' + line)
-        if line.startswith("G1"):
-            # extract the x and y coordinates
-            match = re.search(r'X(-?\d+\.\d+)', line)
-            if match:
-                x = float(match.group(1))
-                XwasSpecified = True
-            else:
-                XwasSpecified = False
-
-            match = re.search(r'Y(-?\d+\.\d+)', line)
-            if match:
-                y = float(match.group(1))
-                YwasSpecified = True
-            else:
-                YwasSpecified = False
-
-            match = re.search(r'Z(-?\d+\.\d+)', line)
-            if match:
-                z = float(match.group(1))
-                ZwasSpecified = True
-            else:
-                ZwasSpecified = False
-
-            # extract the laser power
-            match = re.search(r'S(\d+\.\d+)', line)
-            if match:
-                inputPower = int(match.group(1))
-                powerWasSpecified = True
-            else:
-                powerWasSpecified = False
-
-            #extract the feed rate
-            match = re.search(r'F(\d+\.\d+)', line)
-            if match:
-                inputFeedRate = float(match.group(1))
-                feedRateWasSpecified = True
-            else:
-                feedRateWasSpecified = False
-
-            # if the power and feedrate are known to be greater than 0, 
-            # or write a move command,
-            # otherwise write a sequence of rapid move commands to move up to the clearance height,
-            # then move to the x and y coordinates, and then move back down to the cutting height.
-            if feedRateWasSpecified:
-                #OutputFeedRate = defaultFeedRate
-                OutputFeedRate = inputFeedRate  
-                print('INFO - feed rate was specified as: ' + str(OutputFeedRate))
-            if powerWasSpecified:
-                OutputPower = defaultSpindleSpeed
-                #OutputPower = inputPower
-        
-            if XwasSpecified and YwasSpecified and not ZwasSpecified:
-                if powerWasSpecified and feedRateWasSpecified:
-                    f.write("G1 X{:.2f} Y{:.2f} S{:.2f} F{:.2f}\n".format(x, y, OutputPower, OutputFeedRate))
-                    print("G1 X{:.2f} Y{:.2f} S{:.2f} F{:.2f}".format(x, y, OutputPower, OutputFeedRate))
-                elif powerWasSpecified:
-                    f.write("G1 X{:.2f} Y{:.2f} S{:.2f}\n".format(x, y, OutputPower))
-                    print("G1 X{:.2f} Y{:.2f} S{:.2f}".format(x, y, OutputPower))
-                elif feedRateWasSpecified:
-                    f.write("G1 X{:.2f} Y{:.2f} F{:.2f}\n".format(x, y, OutputFeedRate))
-                    print("G1 X{:.2f} Y{:.2f} F{:.2f}".format(x, y, OutputFeedRate))
-                else:
-                    f.write(line)
-                    #print(line)
-                    continue
-            elif XwasSpecified and not YwasSpecified and not ZwasSpecified:
-                f.write(line)
-                #print(line)
-                continue
-            elif not XwasSpecified and YwasSpecified and not ZwasSpecified:
-                f.write(line)
-                #print(line)
-                continue
-            elif ZwasSpecified:
-                print('WARNING - Z was specified in G1 command. passing through unchanged\n \
-                               - and setting CurrentZ to ' + str(z) + 'check if this is correct')
-                CurrentZ = z
-                f.write(line)
-                continue
-            '''
-            if ZwasSpecified:
-
-                if powerWasSpecified:
-                    if inputPower != OutputPower:
-                        OutputPower = inputPower
-                        print('INFO - power change was specified')  
-
-                    #OutputPower = defaultSpindleSpeed
-                    #insert dwell time here to allow spindle to reach speed
-                    f.write("G4 P2.0\n")
-
-                    f.write("G1 X{:.2f} Y{:.2f} S{:.2f} F{:.2f}\n".format(x, y, OutputPower, OutputFeedRate))
-                    print('WARNING - power was specified -- writing anyway as: G1 X{:.2f} Y{:.2f} S{:.2f} F{:.2f}'.format(x, y, OutputPower, OutputFeedRate))
-                else:
-                    f.write("G1 X{:.2f} Y{:.2f} F{:.2f}\n".format(x, y, OutputFeedRate))
-                    print('INFO - feed rate was specified - writing as: G1 X{:.2f} Y{:.2f} F{:.2f}'.format(x, y, OutputFeedRate))
+    state is an optional dict holding the modal conversion state ('CurrentZ', 'OutputPower',
+    'OutputFeedRate', and 'EmittedPower'/'EmittedFeedRate', the last S/F values actually written).
+    Missing entries start at zero (or unknown); the dict is updated in place when the
+    generator finishes, so the caller can inspect the final state.  Aggregate counts for the
+    run are left in state['counts'].
+
+    diag is an optional diagnostics.Diagnostics object; per-line messages are only built when
+    diag.trace is set.
+
+    lines may also contain gcodeio.RawLines (runs of lines from scan_mapped() that need no
+    conversion); they are passed through as they are.
+    """
+    if state is None:
+        state = {}
+    OutputPower = state.get('OutputPower', 0)
+    OutputFeedRate = state.get('OutputFeedRate', 0.0)
+    CurrentZ = state.get('CurrentZ', 0.0)
+    EmittedPower = state.get('EmittedPower')        # None = not known yet
+    EmittedFeedRate = state.get('EmittedFeedRate')
+    trace = diag is not None and diag.trace
+    spindle = remap.spindle_remapper()
+    feed = remap.feed_remapper()
+
+    lines_in = 0
+    lines_converted = 0
+    arcs_converted = 0
+    rapids_wrapped = 0
+    z_moves = 0
+    passed_through = 0
+    words_dropped = 0
+
+    try:
+        for batch in _batches(lines, BATCH_SIZE):
+            # tokenize the batch, then remap all of its G1 and G2/G3 S and F values in one go
+            parsed = [parse_line(line) if line.__class__ is not RawLines else _NO_WORDS for line in batch]
+            motions = [words.motion for words in parsed]
+            cuts = [words for words, motion in zip(parsed, motions)
+                    if motion == 2 or motion == 3 or (motion == 1 and 'Z' not in words)]
+            powers = iter(spindle.map_values([words['S'] for words in cuts if 'S' in words]))
+            feeds = iter(feed.map_values([words['F'] for words in cuts if 'F' in words]))
+
+            for line, words, motion in zip(batch, parsed, motions):
+                lines_in += 1
+
+                # check if the line is a laser command
+                if motion == 1:
+                    # extract the x, y and z coordinates
+                    x = words.get('X')
+                    XwasSpecified = x is not None
+                    y = words.get('Y')
+                    YwasSpecified = y is not None
+                    z = words.get('Z')
+                    ZwasSpecified = z is not None
+
+                    if ZwasSpecified:
+                        z_moves += 1
+                        if trace:
+                            diag.event('convert', 'z', 'WARNING - Z was specified in G1 command. passing through unchanged\n'
+                                       '          - and setting CurrentZ to ' + str(z) + ' check if this is correct',
+                                       line=lines_in, z=z)
+                        CurrentZ = z
+                        # the line goes out as it is, so its S and F become the values in effect; without
+                        # them, the values after a Z move aren't known (see above)
+                        EmittedPower = words.get('S')
+                        EmittedFeedRate = words.get('F')
+                        yield line
+                        continue
+
+                    # the laser power and feed rate (already remapped, above)
+                    powerWasSpecified = 'S' in words
+                    if powerWasSpecified:
+                        OutputPower = next(powers)
+                    feedRateWasSpecified = 'F' in words
+                    if feedRateWasSpecified:
+                        OutputFeedRate = next(feeds)
+                        if trace:
+                            diag.event('convert', 'feed', 'INFO - feed rate was specified as: ' + str(OutputFeedRate),
+                                       line=lines_in, feed=OutputFeedRate)
+
+                    if not powerWasSpecified and not feedRateWasSpecified:
+                        # nothing to remap -- pass through unchanged
+                        passed_through += 1
+                        yield line
+                        continue
+
+                    # write the move, leaving out S/F words that repeat the values already in effect
+                    out = "G1"
+                    if XwasSpecified:
+                        out += " X{:.2f}".format(x)
+                    if YwasSpecified:
+                        out += " Y{:.2f}".format(y)
+                    if powerWasSpecified:
+                        if OutputPower != EmittedPower:
+                            out += " S{:.2f}".format(OutputPower)
+                            EmittedPower = OutputPower
+                        else:
+                            words_dropped += 1
+                    if feedRateWasSpecified:
+                        if OutputFeedRate != EmittedFeedRate:
+                            out += " F{:.2f}".format(OutputFeedRate)
+                            EmittedFeedRate = OutputFeedRate
+                        else:
+                            words_dropped += 1
+                    if out == "G1":
+                        # only redundant words were left -- the line has nothing to do
+                        continue
+                    lines_converted += 1
+                    out += "\n"
+                    yield out
+                    if trace:
+                        diag.event('convert', 'g1', out.rstrip('\n'), line=lines_in)
+
+                elif motion == 0 and 'X' not in words and 'Y' not in words:
+                    passed_through += 1
+                    if 'Z' in words:
+                        CurrentZ = words['Z']   # a Z-only rapid (e.g. a retract written by the multi-pass stage)
+                        EmittedPower = EmittedFeedRate = None
+                    yield line   #no X/Y travel: assume that this is the header line ( e.g. G00 G17 G21 G40 G49 G54 G80 G90 G94)
 
-            else:
-                if OutputPower != 0 and OutputFeedRate != 0:
-                    f.write(line)
-                    print('line')
+                elif motion == 0:
+                    rapids_wrapped += 1
+                    EmittedPower = EmittedFeedRate = None
+                    yield "G0 Z{:.2f}\n".format(SETTINGS.ZClearance)
+                    yield line
+                    yield "G0 Z{:.2f}\n".format(CurrentZ)
+                    if trace:
+                        diag.event('convert', 'g0', 'INFO - wrote G0 commands for moving to clearance height, then to X,Y coordinates, '
+                                   'then back down to cutting height: ' + line.rstrip('\n'), line=lines_in)
+                elif motion == 2 or motion == 3:
+                    # an arc: its S and F are remapped as for a G1 move, and the rest of the line is kept
+                    if 'Z' in words:
+                        CurrentZ = words['Z']
+                    if 'S' not in words and 'F' not in words:
+                        passed_through += 1
+                        yield line
+                        continue
+                    extra = ''
+                    if 'S' in words:
+                        OutputPower = next(powers)
+                        if OutputPower != EmittedPower:
+                            extra += " S{:.2f}".format(OutputPower)
+                            EmittedPower = OutputPower
+                        else:
+                            words_dropped += 1
+                    if 'F' in words:
+                        OutputFeedRate = next(feeds)
+                        if OutputFeedRate != EmittedFeedRate:
+                            extra += " F{:.2f}".format(OutputFeedRate)
+                            EmittedFeedRate = OutputFeedRate
+                        else:
+                            words_dropped += 1
+                    arcs_converted += 1
+                    out = add_words(drop_words(line, 'SF'), extra)
+                    yield out
+                    if trace:
+                        diag.event('convert', 'arc', out.rstrip('\n'), line=lines_in)
+                elif line.__class__ is RawLines:
+                    # a run of lines that need no conversion, passed through undecoded (--mmap)
+                    lines_in += line.count - 1
+                    passed_through += line.count
+                    yield line
                 else:
-                    print ('WARNING - no feed rate specified or in effect for G1 command, but outputting anyway')
-                    f.write(line)
-                    print('line: ' + line)
-                #print("ERROR - no feed rate specified for G1 command")
-                #exit(1)
-            '''
-        elif line.startswith("G00"):
-            f.write(line)   #assume that this is the header line ( e.g. G00 G17 G21 G40 G49 G54 G80 G90 G94)
-    
-        elif line.startswith("G0"):
-            f.write("G0 Z{:.2f}\n".format(ZClearance))
-            f.write(line)
-            f.write("G0 Z{:.2f}\n".format(CurrentZ))
-            #f.write("G1 Z-{:.2f}\n".format(ZClearance))
-            print(line)
-            print('INFO - wrote G0 commands for moving to clearance height, then to X,Y coordinates, then back down to cutting height') 
-        else:
-            f.write(line)
-            print('passing through: ' + line)
-
-'''
-            # extract the x and y coordinates
-            match = re.search(r'X(-?\d+\.\d+)', line)
-            if match:
-                x = float(match.group(1))
-                XwasSpecified = True
-            else:
-                XwasSpecified = False
-
-            match = re.search(r'Y(-?\d+\.\d+)', line)
-            if match:
-                y = float(match.group(1))
-                YwasSpecified = True
-            else:
-                YwasSpecified = False
-
-            match = re.search(r'Z(-?\d+\.\d+)', line)
-            if match:
-                z = float(match.group(1))
-                print('INFO - Z was specified as: ' + str(z))
-                ZwasSpecified = True
-            else:
-                print('INFO - Z was not specified')
-                ZwasSpecified = False
-
-            if XwasSpecified == True and YwasSpecified == True and ZwasSpecified == False:
-                f.write("G0 Z{:.2f}\n".format(ZClearance))
-                f.write("G0 X{:.2f} Y{:.2f}\n".format(x, y))
-                f.write("G1 Z-{:2f}\n".format(ZClearance))
-                print('INFO - wrote G0 commands for moving to clearance height, then to X,Y coordinates, then back down to cutting height')
-            else:
-                print("ERROR - laserburn input G0 command should specify X and Y coordinates and not Z coordinates")
-                print("ERROR - input line: " + line)
-                print ('X,Y,ZwasSpecified: ' + str(XwasSpecified) + ',' + str(YwasSpecified) + ',' + str(ZwasSpecified))
-                print("ERROR - don't know what to do with this... exiting")
-                exit(1)
-        elif line.startswith("M3"):
-            # if the line is a laser on command, write a spindle on command
-            f.write("M3\n")
-        elif line.startswith("M5"):
-            # if the line is a laser off command, write a spindle off command
-            f.write("M5\n")
-        elif line.startswith("M30"):
-            # if the line is an end of program command, write the end of program command
-            f.write("M30\n")
-        else:
-            # if the line is not a laser command, write the line as is
-            print('passing through: ' + line)
-            f.write(line)
-'''
-        # write the footer
-        # f.write("M05\n")
-        # f.write("M30\n")
+                    passed_through += 1
+                    # S and F words on passed-through lines (e.g. M3 S1000) take effect too
+                    if 'S' in words:
+                        EmittedPower = words['S']
+                    if 'F' in words:
+                        EmittedFeedRate = words['F']
+                    yield line
+                    if trace:
+                        diag.event('convert', 'passthrough', 'passing through: ' + line.rstrip('\n'), line=lines_in)
+    finally:
+        state['OutputPower'] = OutputPower
+        state['OutputFeedRate'] = OutputFeedRate
+        state['CurrentZ'] = CurrentZ
+        state['EmittedPower'] = EmittedPower
+        state['EmittedFeedRate'] = EmittedFeedRate
+        state['counts'] = {
+            'lines in': lines_in,
+            'G1 lines converted': lines_converted,
+            'G2/G3 arcs converted': arcs_converted,
+            'rapids wrapped': rapids_wrapped,
+            'G1 Z moves': z_moves,
+            'lines passed through': passed_through,
+            'redundant S/F words dropped': words_dropped,
+        }
+
+
+def add_stage_arguments(parser):
+    # the options that select and tune the optional stages (shared with batch.py)
+    parser.add_argument('--optimize', action='store_true',
+                        help='reorder cuts to minimise rapid travel and Z retracts')
+    parser.add_argument('--reverse', action='store_true',
+                        help='with --optimize, allow cuts to be made in the reverse direction')
+    parser.add_argument('--window', type=int, default=optimize.DEFAULT_WINDOW,
+                        help='with --optimize, the maximum number of cuts reordered together (default %(default)s)')
+    parser.add_argument('--passes', action='store_true',
+                        help='cut each segment in depth passes (DepthPerPass/NumberOfPasses in mappings.py)')
+    parser.add_argument('--ramp', action='store_true',
+                        help='with --passes, ramp down along the first cutting move instead of plunging')
+    parser.add_argument('--simplify', action='store_true',
+                        help='merge collinear moves and fit arcs (G2/G3) to chains of short G1 moves')
+    parser.add_argument('--tolerance', type=float, default=SETTINGS.ChordalTolerance,
+                        help='with --simplify, the chordal tolerance in mm (default %(default)s)')
+    parser.add_argument('--compact', action='store_true',
+                        help='drop redundant words and no-op moves, and merge back-to-back rapids')
+
+
+def stage_lines(lines, args, state, stats, diag=None, profile=None):
+    """
+    Chain the conversion and the optional stages selected by args (from add_stage_arguments()).
+
+    Returns a generator of the output lines.  state is the dict handed to convert_lines(); stats is
+    a dict that is given one dict of counts per optional stage, for stage_summaries().  profile is an
+    optional profiling.Profile, which times each stage.
+    """
+    if profile is None:
+        profile = profiling.Profile()
+    for name in ('optimize', 'passes', 'simplify', 'compact'):
+        stats.setdefault(name, {})
+    if args.optimize:
+        lines = profile.stage('optimize', optimize.optimize_lines(lines, args.reverse, args.window, stats['optimize']))
+    if args.passes:
+        lines = profile.stage('passes', passes.pass_lines(lines, args.ramp, stats=stats['passes']))
+    lines = profile.stage('convert', convert_lines(lines, state, diag))
+    if args.simplify:
+        lines = profile.stage('simplify', simplify.simplify_lines(lines, args.tolerance, stats=stats['simplify']))
+    if args.compact:
+        lines = profile.stage('compact', modal.modal_lines(lines, stats=stats['compact']))
+    return lines
+
+
+def stage_summaries(args, state, stats):
+    # (stage, counts) for each stage that ran, in pipeline order
+    summaries = []
+    if args.optimize:
+        summaries.append(('optimize', optimize.summary(stats['optimize'])))
+    if args.passes:
+        summaries.append(('passes', stats['passes']))
+    summaries.append(('convert', state['counts']))
+    if args.simplify:
+        summaries.append(('simplify', simplify.summary(stats['simplify'])))
+    if args.compact:
+        summaries.append(('compact', stats['compact']))
+    return summaries
+
+
+def command_counts(counts):
+    # lines by command type, for the --profile report, from convert_lines()' counts
+    return {
+        'G0 rapids wrapped': counts['rapids wrapped'],
+        'G0 clearance moves inserted': 2 * counts['rapids wrapped'],
+        'G1 converted': counts['G1 lines converted'],
+        'G2/G3 converted': counts['G2/G3 arcs converted'],
+        'G1 Z moves': counts['G1 Z moves'],
+        'passed through': counts['lines passed through'],
+    }
+
+
+def convert_main(argv=None):
+    parser = argparse.ArgumentParser(prog='millburn.py [convert]',
+                                     description='convert lightburn laser gcode into 2.5d mill gcode',
+                                     epilog='other commands (millburn.py COMMAND -h for their options): ' +
+                                            ', '.join(name for name, module, description in COMMANDS if module))
+    parser.add_argument('inputfile', help="lightburn-generated .nc file ('-' = stdin)")
+    parser.add_argument('outputfile', help="2.5d mill .nc file to create ('-' = stdout)")
+    add_stage_arguments(parser)
+    parser.add_argument('--mmap', action='store_true',
+                        help='memory-map the input and pass unchanged lines through undecoded (faster; '
+                             'not with the optional stages or -v)')
+    diagnostics.add_arguments(parser)
+    profiling.add_arguments(parser)
+    args = parser.parse_args(argv)
+    if args.mmap and (args.inputfile == '-' or args.optimize or args.passes or args.simplify or args.compact):
+        parser.error('--mmap needs an input file, and no optional stages')
+
+    # read, convert and write one line at a time
+    state = {}
+    stats = {}
+    profile = profiling.from_args(args)
+    with diagnostics.from_args(args) as diag:
+        if args.mmap and not diag.trace:
+            with open_mapped(args.inputfile) as buf:
+                if not newlines_translated(buf):
+                    with profile, open_output_bytes(args.outputfile) as f:
+                        lines = profile.stage('read', scan_mapped(buf, CONVERT_PATTERN))
+                        write_mixed(f, profile.stage('convert', convert_lines(lines, state, diag)))
+        if 'counts' not in state:
+            with profile, open_input(args.inputfile) as infil, open_output(args.outputfile) as f:
+                f.writelines(stage_lines(profile.stage('read', infil), args, state, stats, diag, profile))
+        for stage, counts in stage_summaries(args, state, stats):
+            diag.summary(stage, counts)
+        profile.report(diag, 'convert', command_counts(state['counts']))
+    return 0
+
+
+def main(argv=None):
+    '''
+    'millburn.py [COMMAND] ...': run one of the tools (see COMMANDS); with no command, convert.
+    '''
+    argv = sys.argv[1:] if argv is None else list(argv)
+    modules = {name: module for name, module, description in COMMANDS}
+    if argv and argv[0] in modules:
+        command = argv.pop(0)
+        if modules[command] is not None:
+            return importlib.import_module(modules[command]).main(argv)
+    return convert_main(argv)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
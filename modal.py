@@ -0,0 +1,238 @@
+# modal.py -- modal-state tracking: drop redundant words, merge back-to-back rapids, remove no-op moves.
+#
+# gcode is modal: the controller remembers the motion mode, position, feed rate, spindle speed, units and
+# distance mode until a line changes them.  This stage runs on the converted (mill) program and tracks that
+# state line by line, so that it can:
+#
+#   - drop X/Y/Z, F and S words that repeat the value already in effect,
+#   - remove moves that go nowhere (every axis word equal to the current position),
+#   - merge a run of consecutive G0 rapids (e.g. the retract/travel/plunge sequences written for
+#     back-to-back rapids) into a single retract, travel and plunge.  A run is only merged when all of
+#     its XY travel happens at the highest Z in the run, so the merged travel is never lower than the
+#     original.
+#
+# Smaller files stream faster to grblHAL, whose planner buffer is the real bottleneck when streaming.
+#
+# Lines that can't be handled safely -- comments, arcs, dwells, M codes, coordinate-system changes, relative
+# (G91) moves -- are passed through unchanged, and only update the tracked state.  G28/G30/G53/G92/G10 and
+# unit changes make the position unknown until the next absolute move sets it again.  The G0/G1 word is
+# always kept on motion lines, so that line-oriented tools such as postProcessZBug.py still see every move;
+# a line passed through that moves without one gets the motion mode restated, if the line that set it was
+# dropped.
+
+from gcodewords import parse_line
+
+_PLAIN_WORDS = frozenset('GXYZFS')
+_AXES = ('X', 'Y', 'Z')
+_POSITION_RESETS = (28.0, 30.0, 53.0, 92.0, 10.0)
+
+
+class ModalState(object):
+    '''
+    the controller's modal state, as far as it is known (None = unknown).
+    '''
+    __slots__ = ('motion', 'X', 'Y', 'Z', 'feed', 'spindle', 'units', 'absolute')
+
+    def __init__(self):
+        self.motion = None          # 0, 1, 2 or 3
+        self.X = self.Y = self.Z = None
+        self.feed = None
+        self.spindle = None
+        self.units = None           # 20 (inch) or 21 (mm)
+        self.absolute = True        # G90 / G91
+
+    def apply(self, words):
+        # update the state for a line that is passed through unchanged
+        gcodes = words.gcodes
+        for g in gcodes:
+            if g == 90.0:
+                self.absolute = True
+            elif g == 91.0:
+                self.absolute = False
+            elif g in (20.0, 21.0):
+                if self.units is not None and self.units != g:
+                    self.X = self.Y = self.Z = None
+                self.units = g
+        motion = words.motion
+        if motion is not None:
+            self.motion = motion
+        if any(g in _POSITION_RESETS for g in gcodes):
+            self.X = self.Y = self.Z = None
+        elif motion is not None or (self.motion is not None and not gcodes):
+            for axis in _AXES:
+                if axis in words:
+                    setattr(self, axis, words[axis] if self.absolute else None)
+        if 'F' in words:
+            self.feed = words['F']
+        if 'S' in words:
+            self.spindle = words['S']
+
+
+def _is_plain(words, state):
+    # a G0/G1 line with nothing but axis, F and S words, in absolute mode, and no comment
+    if words.comment is not None or not state.absolute or not _PLAIN_WORDS.issuperset(words):
+        return False
+    gcodes = words.gcodes
+    if len(gcodes) > 1:
+        return False
+    if gcodes:
+        return gcodes[0] in (0.0, 1.0)
+    return state.motion in (0, 1) and any(axis in words for axis in _AXES)
+
+
+def _compact(words, state, stats):
+    # the shortest line that has the same effect as a plain motion line (or None), updating the state
+    motion = words.motion
+    if motion is None:
+        motion = state.motion
+    else:
+        # an explicit G0/G1 sets the mode for the lines after it, even on a line that doesn't move
+        state.motion = motion
+    kept = []
+    moved = False
+    for letter, text in words.pairs:
+        if letter == 'G':
+            continue
+        value = words[letter]
+        if letter in _AXES:
+            if getattr(state, letter) == value:
+                stats['words dropped'] += 1
+                continue
+            setattr(state, letter, value)
+            moved = True
+        elif letter == 'F':
+            if state.feed == value:
+                stats['words dropped'] += 1
+                continue
+            state.feed = value
+        elif letter == 'S':
+            if state.spindle == value:
+                stats['words dropped'] += 1
+                continue
+            state.spindle = value
+        kept.append(letter + text)
+    if not moved:
+        if any(axis in words for axis in _AXES):
+            stats['no-op moves removed'] += 1
+        if not kept:
+            return None
+    return 'G{} {}\n'.format(motion, ' '.join(kept))
+
+
+def _flush_rapids(run, state, stats):
+    # yield the lines for a run of consecutive plain G0 lines
+    x, y, z = state.X, state.Y, state.Z
+    if len(run) > 1 and None not in (x, y, z):
+        text = {}
+        top = z
+        top_text = None
+        points = []
+        for words in run:
+            for letter, value in words.pairs:
+                if letter in _AXES:
+                    text[letter] = value
+            x = words.get('X', x)
+            y = words.get('Y', y)
+            z = words.get('Z', z)
+            if z > top:
+                top = z
+                top_text = text['Z']
+            points.append((x, y, z, 'Z' in words))
+        # only merge if every XY travel in the run happens at the top of the run
+        start = (state.X, state.Y)
+        safe = True
+        previous = start
+        for px, py, pz, has_z in points:
+            if (px, py) != previous and (pz != top or has_z):
+                safe = False
+                break
+            previous = (px, py)
+        if safe:
+            out = []
+            if (x, y) != start:
+                if top > state.Z:
+                    out.append('G0 Z{}\n'.format(top_text))
+                travel = []
+                if x != state.X:
+                    travel.append('X' + text['X'])
+                if y != state.Y:
+                    travel.append('Y' + text['Y'])
+                out.append('G0 {}\n'.format(' '.join(travel)))
+                if z != top:
+                    out.append('G0 Z{}\n'.format(text['Z']))
+            elif z != state.Z:
+                out.append('G0 Z{}\n'.format(text['Z']))
+            stats['rapids merged'] += len(run) - len(out)
+            state.X, state.Y, state.Z = x, y, z
+            state.motion = 0
+            for line in out:
+                yield line
+            return
+    for words in run:
+        line = _compact(words, state, stats)
+        if line is not None:
+            yield line
+
+
+def modal_lines(lines, state=None, stats=None):
+    '''
+    Generator: yield the (converted) gcode lines with redundant words, no-op moves and
+    back-to-back rapids removed.
+
+    state is an optional ModalState giving the state at the start (it is updated in place).
+    stats, if given, is a dict that is filled with counts for the summary.
+    '''
+    if state is None:
+        state = ModalState()
+    if stats is None:
+        stats = {}
+    for key in ('lines in', 'lines out', 'words dropped', 'no-op moves removed', 'rapids merged'):
+        stats.setdefault(key, 0)
+
+    run = []
+    lines_in = lines_out = 0
+    written = state.motion      # the motion mode as the controller will see it, from the lines written so far
+    try:
+        for line in lines:
+            lines_in += 1
+            words = parse_line(line)
+            if _is_plain(words, state):
+                motion = words.motion
+                if motion is None:
+                    motion = state.motion
+                if motion == 0 and 'F' not in words and 'S' not in words:
+                    run.append(words)
+                    continue
+                for out in _flush_rapids(run, state, stats):
+                    lines_out += 1
+                    written = 0
+                    yield out
+                run = []
+                out = _compact(words, state, stats)
+                if out is not None:
+                    lines_out += 1
+                    written = state.motion
+                    yield out
+                continue
+
+            for out in _flush_rapids(run, state, stats):
+                lines_out += 1
+                written = 0
+                yield out
+            run = []
+            if (not words.gcodes and state.motion != written and state.absolute
+                    and any(axis in words for axis in _AXES)):
+                # a move that relies on the motion mode of a line that was dropped: restate the mode
+                line = 'G{} {}'.format(state.motion, line)
+            state.apply(words)
+            if words.motion is not None:
+                written = words.motion
+            lines_out += 1
+            yield line
+
+        for out in _flush_rapids(run, state, stats):
+            lines_out += 1
+            yield out
+    finally:
+        stats['lines in'] += lines_in
+        stats['lines out'] += lines_out
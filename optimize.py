@@ -0,0 +1,345 @@
+# optimize.py -- optional toolpath optimiser: reorder cuts to minimise rapid travel and Z retracts.
+#
+# lightburn emits its cuts in its own order.  On a laser that costs nothing, but on a mill every G0
+# rapid becomes a retract to ZClearance, a travel move and a plunge back down (see millburn.py), so
+# both the travel distance and the number of rapids cost real machine time.
+#
+# The optimiser runs on the lightburn gcode, before the conversion stage.  It splits the program
+# into cut segments -- a G0 travel move followed by the G1 cutting moves that start there -- and
+# reorders the segments of each run to shorten the travel between them:
+#
+#   - a greedy nearest-neighbour tour, using a uniform grid as a spatial index so each step only
+#     looks at nearby segments,
+#   - optionally (allow_reverse) cutting a segment backwards if its far end is closer, followed by
+#     a 2-opt improvement pass over the tour,
+#   - a segment that starts exactly where the previous one ended is merged into it: its G0 is
+#     dropped, so the conversion stage emits no retract/plunge for it.  Travel moves with no cuts
+#     after them are dropped too.
+#
+# Only runs of plain XY cutting can be reordered safely, so anything else (M codes, comments, Z moves,
+# arcs, header lines, relative-mode G91 sections ...) is a fixed barrier: segments are never moved
+# across it, and the modal state (position, S, F) on reaching it is the same as in the original
+# program.  Within a run each moved segment is given explicit S/F words where the modal values
+# in effect would otherwise differ from the original.  Runs are optimised in windows of at most
+# 'window' segments, which bounds both memory and the optimiser's running time.
+#
+# Reversing a cut changes climb milling into conventional milling (and vice versa), which is why
+# it is off by default.
+
+import math
+from settings import SETTINGS
+from gcodewords import parse_line, format_number, add_words
+
+DEFAULT_WINDOW = 5000     # maximum number of segments reordered together
+TWO_OPT_NEIGHBOURS = 40   # 2-opt only tries reversing runs of up to this many segments
+TWO_OPT_PASSES = 3
+MERGE_TOLERANCE = 1e-6    # mm: a segment starting this close to the current position needs no rapid
+
+_SEGMENT_WORDS = frozenset('GXYSF')
+
+
+class Segment(object):
+    '''
+    one G0 travel move plus the G1 cutting moves that follow it.
+    '''
+    __slots__ = ('rapid', 'lines', 'points', 'start', 'end', 's_in', 'f_in', 's_out', 'f_out', 'reversible')
+
+    def __init__(self, rapid, start, s_in, f_in):
+        self.rapid = rapid            # the original G0 line
+        self.lines = []               # the original G1 lines
+        self.points = [start]         # position before the first and after each G1 line
+        self.start = start
+        self.end = start
+        self.s_in = s_in              # modal S and F in effect when the segment starts ...
+        self.f_in = f_in
+        self.s_out = s_in             # ... and when it ends
+        self.f_out = f_in
+        self.reversible = True        # only plain X/Y moves with S/F on the first line can be reversed
+
+
+def _dist(a, b):
+    return math.hypot(a[0] - b[0], a[1] - b[1])
+
+
+class _Grid(object):
+    '''
+    uniform grid spatial index of segment end points, with lazy deletion.
+    '''
+
+    def __init__(self, entries):
+        # entries: [(point, segment index, reversed), ...]
+        xs = [p[0] for p, i, r in entries]
+        ys = [p[1] for p, i, r in entries]
+        self.x0 = min(xs)
+        self.y0 = min(ys)
+        extent = max(max(xs) - self.x0, max(ys) - self.y0, 1e-3)
+        self.size = max(extent / math.sqrt(len(entries)), 1e-3)
+        self.cells = {}
+        for entry in entries:
+            self.cells.setdefault(self._cell(entry[0]), []).append(entry)
+        self.nx = int(extent / self.size) + 1   # grid extent in cells
+
+    def _cell(self, p):
+        return (int((p[0] - self.x0) // self.size), int((p[1] - self.y0) // self.size))
+
+    def nearest(self, p, used):
+        # nearest entry to p whose segment is not yet used, or None
+        # (a point outside the grid is searched from the nearest cell inside it)
+        nx = self.nx
+        cx, cy = self._cell(p)
+        cx = min(max(cx, 0), nx)
+        cy = min(max(cy, 0), nx)
+        best = None
+        best_d = float('inf')
+        cells = self.cells
+        for ring in range(max(cx, nx - cx, cy, nx - cy) + 1):
+            for gx in range(cx - ring, cx + ring + 1):
+                edge = gx == cx - ring or gx == cx + ring
+                step = 1 if edge else 2 * ring
+                for gy in range(cy - ring, cy + ring + 1, step or 1):
+                    bucket = cells.get((gx, gy))
+                    if not bucket:
+                        continue
+                    live = [entry for entry in bucket if not used[entry[1]]]
+                    if len(live) != len(bucket):
+                        cells[(gx, gy)] = live
+                    for entry in live:
+                        d = _dist(p, entry[0])
+                        if d < best_d:
+                            best_d = d
+                            best = entry
+            # every point not yet searched is at least ring * size away
+            if best is not None and best_d <= ring * self.size:
+                break
+        return best
+
+
+def _ends(seg, rev):
+    return (seg.end, seg.start) if rev else (seg.start, seg.end)
+
+
+def _tour(segments, origin, tail, allow_reverse):
+    # greedy nearest-neighbour tour from origin, finishing with a travel move to tail;
+    # returns [(segment index, reversed), ...]
+    entries = [(seg.start, i, False) for i, seg in enumerate(segments)]
+    if allow_reverse:
+        entries += [(seg.end, i, True) for i, seg in enumerate(segments) if seg.reversible]
+    grid = _Grid(entries)
+    used = [False] * len(segments)
+    tour = []
+    here = origin
+    for _ in range(len(segments)):
+        point, i, rev = grid.nearest(here, used)
+        used[i] = True
+        tour.append((i, rev))
+        here = _ends(segments[i], rev)[1]
+    if allow_reverse:
+        _two_opt(segments, tour, origin, tail)
+    return tour
+
+
+def _two_opt(segments, tour, origin, tail):
+    # reversing tour[i..j] also reverses every segment in it, so the cost change only depends on
+    # the two travel moves at the ends of the reversed run
+    n = len(tour)
+    for _ in range(TWO_OPT_PASSES):
+        improved = False
+        for i in range(n - 1):
+            seg_i, rev_i = tour[i]
+            if not segments[seg_i].reversible:
+                continue
+            prev_end = origin if i == 0 else _ends(segments[tour[i - 1][0]], tour[i - 1][1])[1]
+            start_i = _ends(segments[seg_i], rev_i)[0]
+            for j in range(i + 1, min(n, i + 1 + TWO_OPT_NEIGHBOURS)):
+                seg_j, rev_j = tour[j]
+                if not segments[seg_j].reversible:
+                    break
+                end_j = _ends(segments[seg_j], rev_j)[1]
+                next_start = tail if j + 1 == n else _ends(segments[tour[j + 1][0]], tour[j + 1][1])[0]
+                delta = (_dist(prev_end, end_j) + _dist(start_i, next_start)
+                         - _dist(prev_end, start_i) - _dist(end_j, next_start))
+                if delta < -1e-9:
+                    tour[i:j + 1] = [(k, not rev) for k, rev in reversed(tour[i:j + 1])]
+                    improved = True
+                    seg_i, rev_i = tour[i]
+                    start_i = _ends(segments[seg_i], rev_i)[0]
+        if not improved:
+            break
+
+
+def _emit(seg, rev, here, s, f):
+    # yield the lines for one segment, given the current position and modal S/F
+    start, end = _ends(seg, rev)
+    if _dist(here, start) > MERGE_TOLERANCE:
+        if rev:
+            yield "G0 X{} Y{}\n".format(format_number(start[0]), format_number(start[1]))
+        else:
+            words = parse_line(seg.rapid)
+            if 'X' in words and 'Y' in words:
+                yield seg.rapid
+            else:
+                yield "G0 X{} Y{}\n".format(format_number(start[0]), format_number(start[1]))
+    if rev:
+        # the modal S/F of a reversible segment are set on its first line and never change after it
+        extra = ''
+        if seg.s_out is not None:
+            extra += ' S' + format_number(seg.s_out)
+        if seg.f_out is not None:
+            extra += ' F' + format_number(seg.f_out)
+        for k, point in enumerate(reversed(seg.points[:-1])):
+            yield "G1 X{} Y{}{}\n".format(format_number(point[0]), format_number(point[1]), extra if k == 0 else '')
+    else:
+        first = True
+        for line in seg.lines:
+            if first:
+                first = False
+                words = parse_line(line)
+                extra = ''
+                if seg.s_in is not None and seg.s_in != s and 'S' not in words:
+                    extra += ' S' + format_number(seg.s_in)
+                if seg.f_in is not None and seg.f_in != f and 'F' not in words:
+                    extra += ' F' + format_number(seg.f_in)
+                if extra:
+                    line = add_words(line, extra)
+            yield line
+
+
+def _flush(segments, origin, s, f, allow_reverse, stats):
+    # yield one window of segments, reordered, starting from position origin with modal S/F
+    if not segments:
+        return
+    segments = list(segments)
+    before = 0.0
+    here = origin
+    for seg in segments:
+        if _dist(here, seg.start) > MERGE_TOLERANCE:
+            stats['rapids before'] += 1
+        before += _dist(here, seg.start)
+        here = seg.end
+
+    # the last segment stays last, so the position and modal state after the window are unchanged.
+    # Travel moves with no cuts after them (other than the last) are simply dropped.
+    last = segments.pop()
+    segments = [seg for seg in segments if seg.lines]
+    tour = _tour(segments, origin, last.start, allow_reverse) if segments else []
+    tour.append((len(segments), False))
+    segments.append(last)
+    after = 0.0
+    here = origin
+    for i, rev in tour:
+        seg = segments[i]
+        start, end = _ends(seg, rev)
+        if _dist(here, start) > MERGE_TOLERANCE:
+            stats['rapids after'] += 1
+        after += _dist(here, start)
+        if rev:
+            stats['segments reversed'] += 1
+        for line in _emit(seg, rev, here, s, f):
+            yield line
+        here = end
+        if seg.lines:
+            s, f = seg.s_out, seg.f_out
+    stats['segments'] += len(segments)
+    stats['travel before'] += before
+    stats['travel after'] += after
+
+
+def optimize_lines(lines, allow_reverse=False, window=DEFAULT_WINDOW, stats=None):
+    '''
+    Generator: reorder the cut segments of lightburn gcode lines to minimise rapid travel.
+
+    allow_reverse lets a segment of plain X/Y cuts be cut backwards.  window is the maximum
+    number of segments held in memory and reordered together.  stats, if given, is a dict
+    that is filled with the counts and distances used by summary().
+    '''
+    if stats is None:
+        stats = {}
+    for key in ('segments', 'segments reversed', 'rapids before', 'rapids after'):
+        stats.setdefault(key, 0)
+    for key in ('travel before', 'travel after'):
+        stats.setdefault(key, 0.0)
+
+    x = y = 0.0              # modal position, S and F in the original program
+    s = f = None
+    absolute = True          # G90/G91
+    segments = []            # the current window
+    seg = None               # the segment currently being collected
+    origin = (x, y)          # position, S and F at the start of the current window
+    origin_s = origin_f = None
+
+    for line in lines:
+        words = parse_line(line)
+        motion = words.motion
+        plain = absolute and _SEGMENT_WORDS.issuperset(words)
+        if plain and motion == 0 and ('X' in words or 'Y' in words) and 'S' not in words and 'F' not in words:
+            # a travel move: start a new segment
+            if len(segments) >= window:
+                for out in _flush(segments, origin, origin_s, origin_f, allow_reverse, stats):
+                    yield out
+                segments = []
+            if not segments:
+                origin = (x, y)
+                origin_s, origin_f = s, f
+            x = words.get('X', x)
+            y = words.get('Y', y)
+            seg = Segment(line, (x, y), s, f)
+            segments.append(seg)
+            continue
+        if plain and motion == 1 and seg is not None:
+            # a cutting move: add it to the current segment
+            if 'S' in words or 'F' in words:
+                if seg.lines:
+                    seg.reversible = False
+                s = words.get('S', s)
+                f = words.get('F', f)
+            if 'X' not in words and 'Y' not in words:
+                seg.reversible = False
+            x = words.get('X', x)
+            y = words.get('Y', y)
+            seg.lines.append(line)
+            seg.points.append((x, y))
+            seg.end = (x, y)
+            seg.s_out, seg.f_out = s, f
+            continue
+
+        # anything else is a barrier: write out the window, then the line itself
+        for out in _flush(segments, origin, origin_s, origin_f, allow_reverse, stats):
+            yield out
+        segments = []
+        seg = None
+        gcodes = words.gcodes
+        if 90.0 in gcodes:
+            absolute = True
+        if 91.0 in gcodes:
+            absolute = False
+        if motion is not None and absolute:
+            x = words.get('X', x)
+            y = words.get('Y', y)
+        s = words.get('S', s)
+        f = words.get('F', f)
+        yield line
+
+    for out in _flush(segments, origin, origin_s, origin_f, allow_reverse, stats):
+        yield out
+
+
+def summary(stats, rapid_rate_xy=SETTINGS.RapidRateXY, rapid_rate_z=SETTINGS.RapidRateZ,
+            clearance=SETTINGS.ZClearance):
+    '''
+    Summarise optimiser stats: travel distance and an estimate of the machine time saved.
+
+    Each rapid costs its XY travel at rapid_rate_xy plus a retract and plunge of 'clearance' mm
+    at rapid_rate_z (rates in mm/min).
+    '''
+    travel_saved = stats['travel before'] - stats['travel after']
+    rapids_saved = stats['rapids before'] - stats['rapids after']
+    seconds = 60.0 * (travel_saved / rapid_rate_xy + rapids_saved * 2.0 * clearance / rapid_rate_z)
+    return {
+        'segments': stats['segments'],
+        'segments reversed': stats['segments reversed'],
+        'rapids before': stats['rapids before'],
+        'rapids after': stats['rapids after'],
+        'travel before (mm)': round(stats['travel before'], 3),
+        'travel after (mm)': round(stats['travel after'], 3),
+        'estimated time saved (s)': round(seconds, 1),
+    }
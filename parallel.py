@@ -0,0 +1,411 @@
+# parallel.py -- convert (and Z-fix) a single huge file on all cores, by splitting it into chunks.
+#
+# The state carried from line to line is small: the converter's CurrentZ, OutputPower, OutputFeedRate and
+# the S/F values last written (see convert_lines()), and the post-processor's current_z, current_z_dir,
+# firstmove and feed (see zfix_lines()).  So the input file is split at line boundaries into one chunk per worker
+# process, and:
+#
+#   1. a pre-scan works out the converter state at the start of each chunk.  Each state entry is simply the
+#      last value assigned before that point, so it reads each chunk backwards from its end, only as far as
+#      needed to find the last assignment of every entry -- usually just a few lines,
+#   2. the workers convert their chunks in parallel, each starting from its own state, into temporary files.
+#      Each also notes the first and last Z moves in its output, the direction of its last Z reversal and
+#      the last feed rate it sets, which is all that is needed to work out the post-processor state at the
+#      start of the next chunk,
+#   3. with --coalesce, the workers collapse the runs of Z-only moves in their converted chunks.  A run must
+#      not be split, so the Z-only moves a chunk starts with are taken by the worker for the chunk before,
+#      and the Z position at the start of each is worked out from the moves before it, as for step 4,
+#   4. the workers run the Z-bug post-process on their (converted or coalesced) chunks in parallel (unless
+#      --no-zfix),
+#   5. the chunk outputs are joined up, in order.
+#
+# The result is byte-for-byte the same as the sequential 'millburn.py | postProcessZBug.py' chain.  The
+# optional stages (--optimize, --passes, --simplify, --compact) carry much more state, and aren't supported.
+#
+#   python parallel.py big_engrave.nc big_engrave_mill.nc --jobs 8
+
+import os
+import re
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import diagnostics
+import remap
+from settings import SETTINGS
+from millburn import convert_lines
+from postProcessZBug import (zfix_lines, coalesce_z_lines, z_target, add_zfix_arguments, zfix_summaries,
+                             ZFixError, z_only)
+from gcodeio import BUFFER_SIZE, ENCODING
+from gcodewords import parse_line
+
+MIN_CHUNK_SIZE = 4 * 1024 * 1024    # bytes: smaller files (or chunks) aren't worth splitting
+SCAN_BLOCK_SIZE = 64 * 1024         # bytes read at a time by the backwards pre-scan
+
+_NEWLINE_RE = re.compile(r'[^\n]*\n|[^\n]+')
+_CONVERT_STATE = ('CurrentZ', 'OutputPower', 'OutputFeedRate', 'EmittedPower', 'EmittedFeedRate')
+_REMAPPED = object()                # in scan_convert_state(): an S/F value written is the remapped one
+
+
+def chunk_bounds(path, chunks, min_chunk_size=MIN_CHUNK_SIZE):
+    '''
+    Split a file into at most 'chunks' (start, end) byte ranges, each ending just after a newline.
+    '''
+    size = os.path.getsize(path)
+    chunks = max(1, min(chunks, size // max(min_chunk_size, 1)))
+    bounds = []
+    start = 0
+    with open(path, 'rb') as f:
+        for k in range(1, chunks):
+            f.seek(max(size * k // chunks, start))
+            f.readline()
+            end = f.tell()
+            if end >= size:
+                break
+            bounds.append((start, end))
+            start = end
+    bounds.append((start, size))
+    return bounds
+
+
+def _text_lines(raw):
+    # decode one raw line, with the same newline translation as a file opened in text mode
+    text = raw.decode(ENCODING)
+    if '\r' in text:
+        return _NEWLINE_RE.findall(text.replace('\r\n', '\n').replace('\r', '\n'))
+    return (text,)
+
+
+def read_chunk(path, start, end):
+    '''
+    Generator: the text lines of bytes start..end of a file.
+    '''
+    remaining = end - start
+    with open(path, 'rb', buffering=BUFFER_SIZE) as f:
+        f.seek(start)
+        for raw in f:
+            remaining -= len(raw)
+            for line in _text_lines(raw):
+                yield line
+            if remaining <= 0:
+                break
+
+
+def reverse_lines(path, start, end):
+    '''
+    Generator: the text lines of bytes start..end of a file, last line first.
+    '''
+    with open(path, 'rb') as f:
+        pos = end
+        tail = b''
+        while pos > start:
+            size = min(SCAN_BLOCK_SIZE, pos - start)
+            pos -= size
+            f.seek(pos)
+            pieces = (f.read(size) + tail).split(b'\n')
+            tail = pieces[0]
+            for raw in reversed(pieces[1:]):
+                for line in reversed(_text_lines(raw)):
+                    yield line
+        for line in reversed(_text_lines(tail)):
+            yield line
+
+
+def scan_convert_state(path, start, end):
+    '''
+    The converter state entries last assigned in bytes start..end of a file (entries the range never
+    assigns are left out).  Mirrors the state updates in convert_lines().
+    '''
+    found = {}
+    emitted = {}            # 'S'/'F' -> the raw value written, _REMAPPED, or None (unknown: after a rapid or Z move)
+    for line in reverse_lines(path, start, end):
+        if len(found) == len(_CONVERT_STATE):
+            break
+        words = parse_line(line)
+        if not words:
+            continue
+        motion = words.motion
+        if motion == 1 and 'Z' in words:
+            found.setdefault('CurrentZ', words['Z'])
+            for letter in 'SF':
+                emitted.setdefault(letter, words.get(letter))
+        elif motion in (1, 2, 3):
+            if motion != 1 and 'Z' in words:
+                found.setdefault('CurrentZ', words['Z'])
+            if 'S' in words:
+                found.setdefault('OutputPower', words['S'])
+                emitted.setdefault('S', _REMAPPED)
+            if 'F' in words:
+                found.setdefault('OutputFeedRate', words['F'])
+                emitted.setdefault('F', _REMAPPED)
+        elif motion == 0:
+            wrapped = 'X' in words or 'Y' in words
+            if not wrapped and 'Z' in words:
+                found.setdefault('CurrentZ', words['Z'])
+            if wrapped or 'Z' in words:
+                emitted.setdefault('S', None)
+                emitted.setdefault('F', None)
+        else:
+            for letter in 'SF':
+                if letter in words:
+                    emitted.setdefault(letter, words[letter])
+        for letter, name in (('S', 'EmittedPower'), ('F', 'EmittedFeedRate')):
+            if letter in emitted and name not in found:
+                found[name] = emitted[letter]
+
+    # remap the raw S/F values, exactly as the converter would have
+    if 'OutputPower' in found:
+        found['OutputPower'] = remap.spindle_remapper().map_value(found['OutputPower'])
+    if 'OutputFeedRate' in found:
+        found['OutputFeedRate'] = remap.feed_remapper().map_value(found['OutputFeedRate'])
+    for letter, name, output in (('S', 'EmittedPower', 'OutputPower'), ('F', 'EmittedFeedRate', 'OutputFeedRate')):
+        if name in found and found[name] is _REMAPPED:
+            found[name] = found[output]
+    return found
+
+
+def _z_moves(lines, summary):
+    # pass lines through, noting in the dict summary the first and last post-processor Z moves, the direction of
+    # the last reversal, the last feed rate set and the number of lines; and in summary['lead'] the same for
+    # the Z-only moves (see coalesce_z_lines()) the lines start with
+    first = last = direction = feed = None
+    count = 0
+    lead = None
+    try:
+        for line in lines:
+            count += 1
+            if 'F' in line:
+                feed = parse_line(line).get('F', feed)
+            z = z_target(line)
+            if lead is None and (z is None or not z_only(parse_line(line))):
+                lead = dict(first=first, last=last, direction=direction, feed=feed, lines=count - 1)
+            if z is not None:
+                if first is None:
+                    first = z
+                elif z != last:
+                    direction = 1 if z > last else -1
+                last = z
+            yield line
+    finally:
+        summary.update(first=first, last=last, direction=direction, feed=feed, lines=count)
+        summary['lead'] = lead if lead is not None else dict(summary)
+
+
+def next_zfix_state(zstate, summary):
+    '''
+    The post-processor state after a chunk, from the state before it and the chunk's Z moves summary.
+    Mirrors the direction and feed rate tracking in zfix_lines().
+    '''
+    first, last, direction = summary['first'], summary['last'], summary['direction']
+    if summary['feed'] is not None:
+        zstate = dict(zstate, feed=summary['feed'])
+    if first is None:
+        return dict(zstate)
+    if direction is None:
+        # every Z move of the chunk goes to 'first': only the first one can change the direction
+        if zstate.get('firstmove', True):
+            direction = 1 if first > 0 else -1
+        elif first != zstate.get('current_z', 0.0):
+            direction = 1 if first > zstate.get('current_z', 0.0) else -1
+        else:
+            direction = zstate.get('current_z_dir', 0)
+    state = dict(zstate)
+    state.update(current_z=last, current_z_dir=direction, firstmove=False)
+    return state
+
+
+def _convert_chunk(path, start, end, state, outputfile):
+    # worker: convert one chunk into outputfile; returns the conversion counts and the Z moves summary
+    summary = {}
+    with open(outputfile, 'w', buffering=BUFFER_SIZE) as f:
+        f.writelines(_z_moves(convert_lines(read_chunk(path, start, end), state), summary))
+    return state['counts'], summary
+
+
+def _read_parts(parts):
+    # generator: the lines of (path, skip, take) parts of converted chunks, in order (take None = to the end)
+    for path, skip, take in parts:
+        with open(path, 'r', buffering=BUFFER_SIZE) as f:
+            stop = None if take is None else skip + take
+            for number, line in enumerate(f):
+                if stop is not None and number >= stop:
+                    break
+                if number >= skip:
+                    yield line
+
+
+def _coalesce_chunk(parts, state, outputfile):
+    # worker: collapse the Z-only runs of the lines of 'parts' (see _read_parts()), starting from the Z position
+    # in state; returns the coalesce counts and the Z moves summary of the output
+    stats = {}
+    summary = {}
+    with open(outputfile, 'w', buffering=BUFFER_SIZE) as f:
+        f.writelines(_z_moves(coalesce_z_lines(_read_parts(parts), stats, state), summary))
+    return stats, summary
+
+
+def _zfix_chunk(inputfile, state, outputfile, first_line, dwell=SETTINGS.ZBugDwell):
+    # worker: post-process one converted chunk, whose first line is line first_line + 1 of the whole conversion;
+    # returns the post-processor counts
+    state = dict(state, move_count=0, cumulative_Z_error=0.0)
+    with open(inputfile, 'r', buffering=BUFFER_SIZE) as infil, open(outputfile, 'w', buffering=BUFFER_SIZE) as f:
+        try:
+            f.writelines(zfix_lines(infil, state, dwell=dwell))
+        except ZFixError as e:
+            raise ZFixError(e.line + first_line, e.text)
+    return state['counts']
+
+
+def _coalesce_parts(summaries):
+    # the (path index, skip, take) parts of the converted chunks each coalesce worker reads: its own chunk less
+    # the Z-only moves it starts with, and those that the chunks after it start with (a whole chunk of them
+    # passes on to the next one)
+    work = []
+    for k, summary in enumerate(summaries):
+        if k > 0 and summary['lead']['lines'] == summary['lines']:
+            work.append([])
+            continue
+        parts = [(k, summary['lead']['lines'] if k > 0 else 0, None)]
+        for j in range(k + 1, len(summaries)):
+            lead = summaries[j]['lead']['lines']
+            if lead:
+                parts.append((j, 0, lead))
+            if lead < summaries[j]['lines']:
+                break
+        work.append(parts)
+    return work
+
+
+def _add_counts(total, counts):
+    for name, value in counts.items():
+        total[name] = total.get(name, 0) + value
+
+
+def convert_parallel(inputfile, outputfile, jobs=None, zfix=True, min_chunk_size=MIN_CHUNK_SIZE, stats=None,
+                     dwell=SETTINGS.ZBugDwell, coalesce=False):
+    '''
+    Convert (and, with zfix, post-process) one file in chunks across 'jobs' worker processes.  dwell and
+    coalesce are the post-process options (see postProcessZBug.add_zfix_arguments()).
+
+    The output is identical to the sequential conversion.  stats, if given, is a dict that is filled
+    with the 'convert', 'zfix' and (with coalesce) 'coalesce' counts (as from the sequential stages) and
+    the 'parallel' timings.
+    '''
+    if stats is None:
+        stats = {}
+    started = time.perf_counter()
+    jobs = jobs or os.cpu_count()
+    bounds = chunk_bounds(inputfile, jobs, min_chunk_size)
+
+    outdir = os.path.dirname(os.path.abspath(outputfile)) if outputfile != '-' else None
+    with tempfile.TemporaryDirectory(dir=outdir) as tmp, ProcessPoolExecutor(max_workers=jobs) as pool:
+        # 1. the converter state at the start of each chunk
+        states = [{}]
+        for found in pool.map(scan_convert_state, [inputfile] * (len(bounds) - 1), [b[0] for b in bounds[:-1]],
+                              [b[1] for b in bounds[:-1]]):
+            state = dict(states[-1])
+            state.update(found)
+            states.append(state)
+        scanned = time.perf_counter()
+
+        # 2. convert the chunks
+        converted = [os.path.join(tmp, 'convert{}.nc'.format(k)) for k in range(len(bounds))]
+        results = list(pool.map(_convert_chunk, [inputfile] * len(bounds), [b[0] for b in bounds],
+                                [b[1] for b in bounds], states, converted))
+        convert_counts = {}
+        for counts, summary in results:
+            _add_counts(convert_counts, counts)
+        summaries = [summary for counts, summary in results]
+        parts = converted
+
+        # 3. collapse the Z-only runs, each chunk starting from the Z position after the moves before it
+        coalesce_counts = {}
+        if zfix and coalesce:
+            zstates = [{}]
+            zstate = {}
+            for before, summary in zip(summaries, summaries[1:]):
+                zstate = next_zfix_state(zstate, before)
+                zstates.append(next_zfix_state(zstate, summary['lead']))
+            work = [[(converted[k], skip, take) for k, skip, take in chunk_parts]
+                    for chunk_parts in _coalesce_parts(summaries)]
+            parts = [os.path.join(tmp, 'coalesce{}.nc'.format(k)) for k in range(len(bounds))]
+            summaries = []
+            for counts, summary in pool.map(_coalesce_chunk, work, zstates, parts):
+                _add_counts(coalesce_counts, counts)
+                summaries.append(summary)
+
+        # 4. post-process them
+        zfix_counts = {}
+        if zfix:
+            zstates = [{}]
+            first_lines = [0]
+            for summary in summaries[:-1]:
+                zstates.append(next_zfix_state(zstates[-1], summary))
+                first_lines.append(first_lines[-1] + summary['lines'])
+            inputs = parts
+            parts = [os.path.join(tmp, 'zfix{}.nc'.format(k)) for k in range(len(bounds))]
+            for counts in pool.map(_zfix_chunk, inputs, zstates, parts, first_lines, [dwell] * len(bounds)):
+                final_z = counts.pop('final Z')
+                _add_counts(zfix_counts, counts)
+            zfix_counts['final Z'] = final_z
+
+        # 5. join them up
+        out = sys.stdout.buffer if outputfile == '-' else open(outputfile, 'wb')
+        try:
+            for part in parts:
+                with open(part, 'rb') as f:
+                    shutil.copyfileobj(f, out, BUFFER_SIZE)
+        finally:
+            if out is sys.stdout.buffer:
+                out.flush()
+            else:
+                out.close()
+
+    stats['convert'] = convert_counts
+    if zfix:
+        stats['zfix'] = zfix_counts
+        if coalesce:
+            stats['coalesce'] = coalesce_counts
+    stats['parallel'] = {'chunks': len(bounds), 'jobs': jobs,
+                         'pre-scan seconds': round(scanned - started, 3),
+                         'elapsed seconds': round(time.perf_counter() - started, 3)}
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='parallel.py',
+                                     description='convert one large lightburn gcode file on all cores')
+    parser.add_argument('inputfile', help='lightburn-generated .nc file (a real file: it is read in chunks)')
+    parser.add_argument('outputfile', help="2.5d mill .nc file to create ('-' = stdout)")
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count(),
+                        help='number of worker processes (and chunks) (default: one per CPU, %(default)s)')
+    parser.add_argument('--no-zfix', dest='zfix', action='store_false',
+                        help="don't run the Z-bug post-process after the conversion")
+    parser.add_argument('--min-chunk', type=int, default=MIN_CHUNK_SIZE,
+                        help='smallest chunk worth a worker, in bytes (default %(default)s)')
+    add_zfix_arguments(parser)
+    diagnostics.add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    with diagnostics.from_args(args) as diag:
+        if args.inputfile == '-':
+            diag.error('parallel', 'the input must be a file, not stdin')
+            return 1
+        try:
+            stats = convert_parallel(args.inputfile, args.outputfile, args.jobs, args.zfix, args.min_chunk,
+                                     dwell=args.dwell, coalesce=args.coalesce)
+        except ZFixError as e:
+            diag.error('zfix', 'ERROR - ' + str(e), line=e.line)
+            return 1
+        diag.summary('convert', stats['convert'])
+        if args.zfix:
+            for stage, counts in zfix_summaries(args, {'counts': stats['zfix'], 'coalesce': stats.get('coalesce')}):
+                diag.summary(stage, counts)
+        diag.summary('parallel', stats['parallel'])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
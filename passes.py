@@ -0,0 +1,217 @@
+# passes.py -- multi-pass depth stepping: expand each cut into passes at increasing depth.
+#
+# A laser cuts through (or engraves) a line in one go, with the depth controlled by its power.  A mill
+# has to take the material off in steps, so this stage, which runs on the lightburn gcode before the
+# conversion stage, repeats each cut segment (a G0 travel move followed by the G1 cutting moves that
+# start there) at increasing depths:
+#
+#   - segments whose laser power (S) is in the cutting band (LaserCuttingPowerMin..Max in mappings.py)
+#     are cut in NumberOfPasses passes, each DepthPerPass deeper than the last (never deeper than
+#     MaterialThickness),
+#   - segments in the engraving band (LaserEngravingPowerMin..Max) get a single pass at DepthPerPass,
+#   - anything else (e.g. S0 moves) is passed through unchanged.
+#
+# Each pass starts with a G1 plunge to its depth at PlungeFeedRate (or, optionally, a ramp down along
+# the first cutting move).  Closed contours (those that end where they started) go straight down to
+# the next pass without a retract; open ones travel back to their start for each pass, which the
+# conversion stage wraps in the usual retract/plunge.  After the last pass the tool is lifted back to
+# the surface (Z0), so the conversion stage's next plunge goes to the surface rather than into the
+# material.
+#
+# The expansion streams: only the current segment is held, in a spooled buffer that stays in memory up to
+# 'buffer_size' bytes and spills to a temporary file beyond that, and each pass re-reads it from there.
+
+from settings import SETTINGS
+from gcodewords import parse_line, format_number, add_words
+
+CUT = 'cut'
+ENGRAVE = 'engrave'
+
+DEFAULT_BUFFER_SIZE = 4 * 1024 * 1024    # bytes of a segment held in memory before spilling to disk
+CLOSED_TOLERANCE = 1e-6                  # mm: a segment ending this close to its start is a closed contour
+SURFACE_Z = 0.0                          # work Z of the top of the material
+
+_SEGMENT_WORDS = frozenset('GXYSF')
+
+
+def classify_power(power):
+    '''
+    Classify a laser power (S) value: CUT, ENGRAVE, or None if it is in neither band.
+    '''
+    if power is None:
+        return None
+    if SETTINGS.LaserCuttingPowerMin <= power <= SETTINGS.LaserCuttingPowerMax:
+        return CUT
+    if SETTINGS.LaserEngravingPowerMin <= power <= SETTINGS.LaserEngravingPowerMax:
+        return ENGRAVE
+    return None
+
+
+def pass_depths(kind, depth_per_pass=SETTINGS.DepthPerPass, number_of_passes=SETTINGS.NumberOfPasses,
+                thickness=SETTINGS.MaterialThickness):
+    '''
+    The (positive) depth of each pass for a segment of the given kind.
+    '''
+    if kind == CUT:
+        depths = []
+        for k in range(1, number_of_passes + 1):
+            depth = min(k * depth_per_pass, thickness)
+            if not depths or depth > depths[-1]:
+                depths.append(depth)
+        return depths
+    if kind == ENGRAVE:
+        return [min(depth_per_pass, thickness)]
+    return []
+
+
+class _Segment(object):
+    '''
+    the segment currently being collected: its travel move and a buffer of its cutting moves.
+    '''
+
+    def __init__(self, buffer_size):
+        import tempfile     # imported here, so the tools only load it when --passes is used
+        self.buffer = tempfile.SpooledTemporaryFile(max_size=buffer_size, mode='w+')
+        self.reset(None, None, None)
+
+    def reset(self, rapid, start, f_in):
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        self.rapid = rapid         # the original G0 line
+        self.start = start         # (x, y) where the cutting starts
+        self.end = start
+        self.first = None          # the first G1 line and its target
+        self.first_target = None
+        self.count = 0             # number of G1 lines
+        self.f_in = f_in           # modal F when the segment starts
+        self.power = None          # highest laser power used by the segment
+
+    def add(self, line, target, power):
+        if self.count == 0:
+            self.first = line
+            self.first_target = target
+        self.buffer.write(line)
+        self.count += 1
+        self.end = target
+        if power is not None and (self.power is None or power > self.power):
+            self.power = power
+
+    def lines(self):
+        self.buffer.seek(0)
+        return self.buffer
+
+    def close(self):
+        self.buffer.close()
+
+
+def _expand(seg, ramp, plunge_feed, stats):
+    # yield the lines for all passes of one segment
+    if seg.rapid is None:
+        return
+    kind = classify_power(seg.power) if seg.count else None
+    depths = pass_depths(kind)
+    if not depths:
+        yield seg.rapid
+        for line in seg.lines():
+            yield line
+        stats['segments unchanged'] += 1
+        return
+
+    stats['segments cut' if kind == CUT else 'segments engraved'] += 1
+    closed = (abs(seg.end[0] - seg.start[0]) <= CLOSED_TOLERANCE and
+              abs(seg.end[1] - seg.start[1]) <= CLOSED_TOLERANCE)
+    # only ramp along a first move that actually goes somewhere
+    can_ramp = (ramp and seg.first_target is not None and
+                (seg.first_target[0] != seg.start[0] or seg.first_target[1] != seg.start[1]))
+    first = seg.first
+    first_words = parse_line(first)
+    cut_feed = first_words.get('F', seg.f_in)
+    if seg.f_in is not None and 'F' not in first_words:
+        # the plunge changes the modal feed, so the first cut has to set it back
+        first = add_words(first, ' F' + format_number(seg.f_in))
+    plunge_f = ' F' + format_number(plunge_feed)
+    # the move back to the start after a ramp is a cut at full depth, so it goes at the cutting feed
+    back_f = '' if cut_feed is None else ' F' + format_number(cut_feed)
+    start_x, start_y = format_number(seg.start[0]), format_number(seg.start[1])
+
+    for k, depth in enumerate(depths):
+        z = format_number(-depth)
+        if k == 0 or not closed:
+            yield seg.rapid
+        else:
+            stats['retracts skipped'] += 1
+        if can_ramp:
+            # ramp down along the first move, then come back to the start at full depth
+            yield "G1 X{} Y{} Z{}{}\n".format(format_number(seg.first_target[0]), format_number(seg.first_target[1]),
+                                             z, plunge_f)
+            yield "G1 X{} Y{}{}\n".format(start_x, start_y, back_f)
+        else:
+            yield "G1 Z{}{}\n".format(z, plunge_f)
+        lines = seg.lines()
+        next(lines)
+        yield first
+        for line in lines:
+            yield line
+        stats['passes'] += 1
+    yield "G0 Z{}\n".format(format_number(SURFACE_Z))
+
+
+def pass_lines(lines, ramp=False, plunge_feed=SETTINGS.PlungeFeedRate, buffer_size=DEFAULT_BUFFER_SIZE, stats=None):
+    '''
+    Generator: expand the cut segments of lightburn gcode lines into multiple depth passes.
+
+    ramp enters each pass with a ramp along the first cutting move instead of a straight plunge.
+    buffer_size is the number of bytes of a segment held in memory (beyond that it is spilled to a
+    temporary file).  stats, if given, is a dict that is filled with counts for the summary.
+    '''
+    if stats is None:
+        stats = {}
+    for key in ('segments cut', 'segments engraved', 'segments unchanged', 'passes', 'retracts skipped'):
+        stats.setdefault(key, 0)
+
+    x = y = 0.0              # modal position, S and F
+    s = f = None
+    absolute = True          # G90/G91
+    seg = _Segment(buffer_size)
+    try:
+        for line in lines:
+            words = parse_line(line)
+            motion = words.motion
+            plain = absolute and _SEGMENT_WORDS.issuperset(words)
+            if plain and motion == 0 and ('X' in words or 'Y' in words) and 'S' not in words and 'F' not in words:
+                # a travel move: finish the previous segment and start a new one
+                for out in _expand(seg, ramp, plunge_feed, stats):
+                    yield out
+                x = words.get('X', x)
+                y = words.get('Y', y)
+                seg.reset(line, (x, y), f)
+                continue
+            if plain and motion == 1 and seg.rapid is not None:
+                # a cutting move: add it to the current segment
+                s = words.get('S', s)
+                f = words.get('F', f)
+                x = words.get('X', x)
+                y = words.get('Y', y)
+                seg.add(line, (x, y), s)
+                continue
+
+            # anything else ends the segment and is passed through
+            for out in _expand(seg, ramp, plunge_feed, stats):
+                yield out
+            seg.reset(None, None, None)
+            gcodes = words.gcodes
+            if 90.0 in gcodes:
+                absolute = True
+            if 91.0 in gcodes:
+                absolute = False
+            if motion is not None and absolute:
+                x = words.get('X', x)
+                y = words.get('Y', y)
+            s = words.get('S', s)
+            f = words.get('F', f)
+            yield line
+
+        for out in _expand(seg, ramp, plunge_feed, stats):
+            yield out
+    finally:
+        seg.close()
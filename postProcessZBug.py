@@ -54,116 +54,375 @@
 #      should cancel out in the long run. If they don't cancel out, the error will be relatively small compared 
 #      to a indeterminate-length move in the wrong direction, which is what the bug causes if not corrected.
 #  
-# usage: python postProcessZBug.py <inputfile> <outputfile
+# usage: python postProcessZBug.py <inputfile> <outputfile>
+#
+#   either file may be '-' for stdin/stdout, e.g. to post-process the converter's output directly:
+#   python millburn.py <inputfile> - | python postProcessZBug.py - <outputfile>
 
-import sys
 import re
-from mappings import *
-
-if len(sys.argv) != 3:
-    print("Usage: python millburn.py <inputfile> <outputfile>")
-    sys.exit(1)
-
-inputfile = sys.argv[1]
-outputfile = sys.argv[2]
-OutputPower = 0
-OutputFeedRate = 0.0
-CurrentZ = 0.0
-
-with open(inputfile, "r") as infil:
-    lines = infil.readlines()   
-
-# open the output file
-
-Z_correction = 0.01   # this is the amount to move the Z-axis to correct for the bug in grblhal.
-                          # initially set to 0.01mm. The absolute value of this setting will be applied in the direction
-                          # of each Z-axis move command in the input file.
-                          #                         
-cumulative_Z_error = 0.00  # this is the cumulative error in the Z-axis position, which is the sum of the actual values
-                           #  of the inserted Z-axis moves. This is for informational purposes only, and is not used in the
-                           # calculations.    
-initial_z = 0.0            # this is the (assumed) initial Z-axis position
-current_z = 0.0            # this is the current Z-axis position
-firstmove = True           # this is a flag to indicate that the first Z-axis move has been encountered 
-z_dir_change = False       # this is a flag to indicate that the Z-axis direction has changed since the last move
-move_count = 0             # this is a count of the total number of Z-axis moves in the input file
-current_z_dir = 0          # this is the current direction of the Z-axis move (1 = up, -1 = down)
-
-with open(outputfile, "w") as f:
-
-    # loop through the lines in the input file, making the necessary changes and printing each line to the output file:
-
-    #          - insert an additional z-axis move immediately prior to each direction-changing z-axis move
-    #            (distance = 0.01mm, direction = same as the existing direction-switching move)
-
-    for line in lines:
-        # check if the line is a Z-axis move command 
-
-        if line.startswith("G0") or line.startswith("G1") or line.startswith("G00") or line.startswith("G01"):
-          # does the line contain a Z-axis move command?
-          if 'Z' in line:
-            #match = re.search(r'Z(-?\d+\.\d+)', line)
-            match = re.search(r'Z(-?\d+)', line)
-            if match:
-                # extract the Z-axis coordinate, allowing for the fact that there may be  needed characters after it in the line
-                # (i.e. the match may not be at the end of the line)
-
-                # e.g. 'G1 Z10 F1000' or 'G0 Z-5.5'
-                z = float(match.group(1))
-                
-
-                # is this the first Z-axis move?
-
-                if firstmove:
-                    if z > 0:
-                        current_z_dir = 1
-                    else:
-                        current_z_dir = -1
+import sys
+import itertools
+import argparse
+from settings import SETTINGS
+import diagnostics
+import profiling
+from gcodeio import open_input, open_output, open_mapped, open_output_bytes, newlines_translated, scan_mapped, write_mixed, RawLines
+from gcodewords import parse_line, format_number, add_words
 
-                    current_z = z
-                    move_count = 0
-                    firstmove = False
-                    print('INFO - initial Z-axis position is: ' + str(initial_z) +  ' first move is to Z = ' + str(z))
+# with --mmap, the only lines zfix_lines() has to decode: G0/G1 lines with a Z in them, and any line with an F
+# (the feed rate it puts back after each correction move)
+ZFIX_PATTERN = re.compile(rb'^G[01][^\n]*Z|F', re.M)
+
+_Z_ONLY_LETTERS = frozenset('GZF')
+
+
+class ZFixError(ValueError):
+    # a line the post-processor can't handle: 'line' is its number in the input, 'text' the line
+    def __init__(self, line, text):
+        ValueError.__init__(self, line, text)
+        self.line = line
+        self.text = text
+
+    def __str__(self):
+        return 'line {}: no Z coordinate specified for Z-axis move: {}'.format(self.line, self.text)
+
+
+def z_target(line):
+    # the Z position of a line that zfix_lines() treats as a Z-axis move, or None (same test as zfix_lines())
+    if (line.startswith("G0") or line.startswith("G1")) and 'Z' in line:
+        return parse_line(line).get('Z')
+    return None
+
+
+def z_only(words):
+    # a move that only moves Z: a single G0/G1, a Z and perhaps a feed rate, and no comment
+    letters = [letter for letter, value in words.pairs]
+    return (words.comment is None and letters.count('G') == 1 and words['G'] in (0.0, 1.0)
+            and _Z_ONLY_LETTERS.issuperset(letters))
+
+
+def _collapse_run(run, start_z):
+    # the lines to output for a run of (line, words) Z-only moves, starting from start_z
+    final_z = run[-1][1]['Z']
+    floor = min(start_z, final_z) if start_z is not None else None
+    if floor is None or len(run) == 1 or any(words['Z'] < floor and words['G'] == 1.0 for line, words in run[:-1]):
+        return [line for line, words in run]        # nothing to gain, or it would skip a cut (drilling) move
+    line, words = run[-1]
+    if 'F' not in words:
+        # the feed rate the dropped moves would have left in effect
+        for dropped, dropped_words in reversed(run[:-1]):
+            if 'F' in dropped_words:
+                return [add_words(line, ' F' + format_number(dropped_words['F']))]
+        if final_z == start_z:
+            return []                               # the run ends where it started
+    return [line]
+
+
+def coalesce_z_lines(lines, stats=None, state=None):
+    """
+    Generator: collapse each run of consecutive Z-only moves (no X/Y motion, or any other line, in
+    between) into a single move to the run's final Z, so that it costs at most one Z direction change
+    -- e.g. a plunge straight back out (two reversals), or a retract followed by a further retract.
+    A run that ends where it started is dropped altogether.  A run is left as it is if collapsing it
+    would skip a G1 move deeper than both its start and its end (a drilling move); the G0 plunges that
+    millburn.py puts between back-to-back rapids are not cuts, and go.
+
+    stats is an optional dict; it is filled with the counts for the run when the generator finishes,
+    including 'Z direction changes in', the number zfix_lines() would have corrected without this.
+
+    state is an optional dict with the Z position before the first line, as zfix_lines() keeps it
+    ('current_z', 'current_z_dir', 'firstmove'); it is not updated.  The first line must not be part
+    of a run that started before it.
+
+    RawLines in lines (see zfix_lines()) are passed through as they are.
+    """
+    if stats is None:
+        stats = {}
+    if state is None:
+        state = {}
+    run = []                    # (line, words) of the Z-only moves since the last other line
+    # as in zfix_lines(), for counting its direction changes (None: no Z move yet)
+    current_z = None if state.get('firstmove', True) else state.get('current_z', 0.0)
+    current_z_dir = state.get('current_z_dir', 0)
+    start_z = current_z         # the Z position before the run (None: not known yet)
+    reversals = 0
+    collapsed = 0
+    removed = 0
+
+    try:
+        for line in itertools.chain(lines, (None,)):      # None: the end of the input
+            words = None
+            if line is not None and line.__class__ is not RawLines and (line.startswith("G0") or line.startswith("G1")) and 'Z' in line:
+                words = parse_line(line)
+                z = words.get('Z')
+                if z is None:
+                    words = None
                 else:
-                    # has the Z-axis direction changed since the last move?
-                    if (z - current_z) * current_z_dir < 0:
-                        z_dir_change = True
+                    if current_z is None:
+                        current_z_dir = 1 if z > 0 else -1
+                    elif (z - current_z) * current_z_dir < 0:
                         current_z_dir = -current_z_dir
-                        if z > current_z:
-                            Z_correction = 0.01
+                        reversals += 1
+                    current_z = z
+                    if z_only(words):
+                        run.append((line, words))
+                        continue
+            if run:
+                output = _collapse_run(run, start_z)
+                if len(output) < len(run):
+                    collapsed += 1
+                    removed += len(run) - len(output)
+                for kept in output:
+                    yield kept
+                start_z = run[-1][1]['Z']
+                run = []
+            if line is None:
+                break
+            if words is not None:
+                start_z = words['Z']
+            yield line
+    finally:
+        stats['Z runs collapsed'] = collapsed
+        stats['Z moves removed'] = removed
+        stats['Z direction changes in'] = reversals
+
+
+def zfix_lines(lines, state=None, diag=None, dwell=SETTINGS.ZBugDwell):
+    """
+    Generator: yield the input gcode lines with a short Z-axis move and a dwell inserted
+    immediately before each direction-changing G0/G1 Z-axis move.
+
+    Lines are processed one at a time, so the input can be a file object (or any other iterable)
+    of any size.
+
+    state is an optional dict holding the post-processor state ('current_z', 'current_z_dir',
+    'firstmove', 'cumulative_Z_error', 'move_count', 'feed').  Missing entries take their initial values;
+    the dict is updated in place when the generator finishes.  Aggregate counts for the run are
+    left in state['counts'].
+
+    diag is an optional diagnostics.Diagnostics object; per-line messages are only built when
+    diag.trace is set.
+
+    A G0/G1 line with a Z but no Z coordinate raises ZFixError.
+
+    lines may also contain gcodeio.RawLines (runs of lines from scan_mapped() with no Z-axis
+    moves); they are passed through as they are.
+
+    dwell is the length of the dwell (seconds) after each correction move; 0 leaves the dwell out.
+    The feed rate in effect before each (slow, F10) correction move is put back on the move that
+    follows it, so that it doesn't carry over into the cuts after it.  (So every line with an F word
+    has to be seen: state['feed'] is the last feed rate set.)
+    """
+    if state is None:
+        state = {}
+    Z_correction = 0.01        # this is the amount to move the Z-axis to correct for the bug in grblhal.
+                               # initially set to 0.01mm. The absolute value of this setting will be applied in the direction
+                               # of each Z-axis move command in the input file.
+                               #
+    cumulative_Z_error = state.get('cumulative_Z_error', 0.00)
+                               # this is the cumulative error in the Z-axis position, which is the sum of the actual values
+                               #  of the inserted Z-axis moves. This is for informational purposes only, and is not used in the
+                               # calculations.
+    initial_z = 0.0            # this is the (assumed) initial Z-axis position
+    current_z = state.get('current_z', 0.0)        # this is the current Z-axis position
+    firstmove = state.get('firstmove', True)       # this is a flag to indicate that the first Z-axis move has been encountered
+    z_dir_change = False       # this is a flag to indicate that the Z-axis direction has changed since the last move
+    move_count = state.get('move_count', 0)        # this is a count of the total number of Z-axis moves in the input file
+    current_z_dir = state.get('current_z_dir', 0)  # this is the current direction of the Z-axis move (1 = up, -1 = down)
+    feed = state.get('feed')                       # the feed rate set by the input so far
+    trace = diag is not None and diag.trace
+    lines_in = 0               # these are counts for the end-of-run summary
+    z_moves = 0
+
+    try:
+        # loop through the lines in the input file, making the necessary changes and yielding each line:
+
+        #          - insert an additional z-axis move immediately prior to each direction-changing z-axis move
+        #            (distance = 0.01mm, direction = same as the existing direction-switching move)
+
+        for line in lines:
+            if line.__class__ is RawLines:
+                # a run of lines with no Z-axis moves, passed through undecoded (--mmap)
+                lines_in += line.count
+                yield line
+                continue
+            lines_in += 1
+            if 'F' in line:
+                feed = parse_line(line).get('F', feed)
+            # check if the line is a Z-axis move command
+
+            if line.startswith("G0") or line.startswith("G1") or line.startswith("G00") or line.startswith("G01"):
+              # does the line contain a Z-axis move command?
+              if 'Z' in line:
+                # tokenize the line (once) to get the Z-axis coordinate, wherever it is in the line
+                # e.g. 'G1 Z10 F1000', 'G0 Z-5.5' or 'G1X1Z-.25'
+                words = parse_line(line)
+                z = words.get('Z')
+                if z is not None:
+                    z_moves += 1
+
+                    # is this the first Z-axis move?
+
+                    if firstmove:
+                        if z > 0:
+                            current_z_dir = 1
                         else:
-                            Z_correction = -0.01
-                        shortMove_z = current_z + Z_correction
-                        current_z = z  
-                    else:
-                        z_dir_change = False
+                            current_z_dir = -1
+
                         current_z = z
-                        Z_correction = 0.00
-                    # insert the additional z-axis move immediately prior to the existing move 
-                    # (make it a very slow move G1 move to give the controller time to process it without ambiguity do to possible competing interrupts)
-                    #    question: how long does it take to move 0.01mm at 10mm/min?
-                    #    answer: 0.01mm / 10mm/min = 0.001 minutes = 0.06 seconds
-                    #            0.01mm / 0.0025mm/step = 4 steps
-                    #            alternatively, 0.1mm / 0.0025mm/step = 40 steps
-                    #                           40 steps at 10mm/min = 0.6 seconds
-                    if z_dir_change:
-                        f.write("G1 Z{:.2f} F10 \n".format(shortMove_z))
-                        cumulative_Z_error += Z_correction
-                        move_count += 1
-                        # add 5 second delay
-                        f.write("G4 P5.0\n")
-                        print("INFO - inserted Z-axis move to correct for direction change: " + line)
+                        move_count = 0
+                        firstmove = False
+                        if trace:
+                            diag.event('zfix', 'first', 'INFO - initial Z-axis position is: ' + str(initial_z) +  ' first move is to Z = ' + str(z),
+                                       line=lines_in, z=z)
                     else:
-                        print("INFO - Z-axis move with no direction change: " + line)
-            else:
-                print("z = " + str(z))
-                print("ERROR - no Z coordinate specified for Z-axis move: " + line)
-                exit(1)
-          else:
-            print("INFO - non-Z-axis G0/1 move command: " + line)
-
-        # now output the original line
-        f.write(line)
-
-    print('INFO - final Z-axis position is: ' + str(current_z) + '  cumulative Z-axis error is: ' + str(cumulative_Z_error)  + ' total Z-axis move count is: ' + str(move_count))
-    print('INFO - output file ' + outputfile + ' has been created')
\ No newline at end of file
+                        # has the Z-axis direction changed since the last move?
+                        if (z - current_z) * current_z_dir < 0:
+                            z_dir_change = True
+                            current_z_dir = -current_z_dir
+                            if z > current_z:
+                                Z_correction = 0.01
+                            else:
+                                Z_correction = -0.01
+                            shortMove_z = current_z + Z_correction
+                            current_z = z
+                        else:
+                            z_dir_change = False
+                            current_z = z
+                            Z_correction = 0.00
+                        # insert the additional z-axis move immediately prior to the existing move
+                        # (make it a very slow move G1 move to give the controller time to process it without ambiguity do to possible competing interrupts)
+                        #    question: how long does it take to move 0.01mm at 10mm/min?
+                        #    answer: 0.01mm / 10mm/min = 0.001 minutes = 0.06 seconds
+                        #            0.01mm / 0.0025mm/step = 4 steps
+                        #            alternatively, 0.1mm / 0.0025mm/step = 40 steps
+                        #                           40 steps at 10mm/min = 0.6 seconds
+                        if z_dir_change:
+                            yield "G1 Z{:.2f} F10 \n".format(shortMove_z)
+                            cumulative_Z_error += Z_correction
+                            move_count += 1
+                            # add a delay (5 seconds by default)
+                            if dwell:
+                                yield "G4 P{}\n".format(float(dwell))
+                            if feed is not None and 'F' not in words:
+                                line = add_words(line, ' F' + format_number(feed))
+                            if trace:
+                                diag.event('zfix', 'reversal', "INFO - inserted Z-axis move to correct for direction change: " + line.rstrip('\n'),
+                                           line=lines_in, z=z, correction=Z_correction)
+                        elif trace:
+                            diag.event('zfix', 'z', "INFO - Z-axis move with no direction change: " + line.rstrip('\n'),
+                                       line=lines_in, z=z)
+                elif words.comment is None:
+                    raise ZFixError(lines_in, line.rstrip('\n'))
+                elif trace:
+                    diag.event('zfix', 'xy', "INFO - non-Z-axis G0/1 move command: " + line.rstrip('\n'), line=lines_in)
+              elif trace:
+                diag.event('zfix', 'xy', "INFO - non-Z-axis G0/1 move command: " + line.rstrip('\n'), line=lines_in)
+
+            # now output the original line
+            yield line
+    finally:
+        state['current_z'] = current_z
+        state['current_z_dir'] = current_z_dir
+        state['firstmove'] = firstmove
+        state['cumulative_Z_error'] = cumulative_Z_error
+        state['move_count'] = move_count
+        state['feed'] = feed
+        state['counts'] = {
+            'lines in': lines_in,
+            'Z moves': z_moves,
+            'Z direction changes': move_count,
+            'cumulative Z error': cumulative_Z_error,
+            'dwell seconds': move_count * dwell,
+            'final Z': current_z,
+        }
+
+
+def add_zfix_arguments(parser):
+    # the post-process options (also taken by batch.py)
+    parser.add_argument('--dwell', type=float, default=SETTINGS.ZBugDwell, metavar='SECONDS',
+                        help='dwell after each correction move (default %(default)s; 0 = none)')
+    parser.add_argument('--coalesce', action='store_true',
+                        help='collapse runs of Z-only moves first, so fewer direction changes need correcting')
+
+
+def zfix_stage_lines(lines, args, state, diag=None, profile=None):
+    '''
+    The post-process selected by the add_zfix_arguments() options, as a generator of output lines.
+    profile is an optional profiling.Profile, which times each stage.
+    '''
+    if profile is None:
+        profile = profiling.Profile()
+    if args.coalesce:
+        state['coalesce'] = {}
+        lines = profile.stage('coalesce', coalesce_z_lines(lines, state['coalesce']))
+    return profile.stage('zfix', zfix_lines(lines, state, diag, args.dwell))
+
+
+def zfix_summaries(args, state):
+    # (stage, counts) pairs for the end-of-run summary, once zfix_stage_lines() has finished
+    summaries = [('zfix', state['counts'])]
+    if args.coalesce:
+        counts = dict(state['coalesce'])
+        saved = counts['Z direction changes in'] - state['counts']['Z direction changes']
+        counts['dwells saved'] = saved
+        counts['dwell seconds saved'] = saved * args.dwell
+        summaries.append(('coalesce', counts))
+    return summaries
+
+
+def command_counts(args, state):
+    # lines by command type, for the --profile report, once zfix_stage_lines() has finished
+    counts = state['counts']
+    commands = {'Z moves': counts['Z moves']}
+    if args.coalesce:
+        commands['Z moves removed'] = state['coalesce']['Z moves removed']
+    commands['Z-fix moves inserted'] = counts['Z direction changes']
+    commands['Z-fix dwells inserted'] = counts['Z direction changes'] if args.dwell else 0
+    commands['other lines'] = counts['lines in'] - counts['Z moves']
+    return commands
+
+
+def _zfix_file(args, state, diag, profile):
+    # read, post-process and write one line at a time
+    if args.mmap and not diag.trace:
+        with open_mapped(args.inputfile) as buf:
+            if not newlines_translated(buf):
+                with profile, open_output_bytes(args.outputfile) as f:
+                    lines = profile.stage('read', scan_mapped(buf, ZFIX_PATTERN))
+                    write_mixed(f, zfix_stage_lines(lines, args, state, diag, profile))
+    if 'counts' not in state:
+        with profile, open_input(args.inputfile) as infil, open_output(args.outputfile) as f:
+            f.writelines(zfix_stage_lines(profile.stage('read', infil), args, state, diag, profile))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='postProcessZBug.py',
+                                     description='work around the grblhal Z-axis direction-change bug')
+    parser.add_argument('inputfile', help="gcode file to post-process ('-' = stdin)")
+    parser.add_argument('outputfile', help="post-processed gcode file to create ('-' = stdout)")
+    parser.add_argument('--mmap', action='store_true',
+                        help='memory-map the input and pass unchanged lines through undecoded (faster; not with -v)')
+    add_zfix_arguments(parser)
+    diagnostics.add_arguments(parser)
+    profiling.add_arguments(parser)
+    args = parser.parse_args(argv)
+    if args.mmap and args.inputfile == '-':
+        parser.error('--mmap needs an input file')
+
+    state = {}
+    profile = profiling.from_args(args)
+    with diagnostics.from_args(args) as diag:
+        try:
+            _zfix_file(args, state, diag, profile)
+        except ZFixError as e:
+            diag.error('zfix', 'ERROR - ' + str(e), line=e.line)
+            return 1
+        for stage, counts in zfix_summaries(args, state):
+            diag.summary(stage, counts)
+        profile.report(diag, 'zfix', command_counts(args, state))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,152 @@
+# remap.py -- laser power -> spindle speed and laser feed -> mill feed remapping (SMapping / FMapping).
+#
+# The mapping tables live in mappings.py.  Each is either None or one of:
+#
+#   ('linear', [(input, output), ...])          piecewise-linear interpolation between the points
+#                                               (inputs in increasing order; inputs outside the table
+#                                               take the output of the nearest end point)
+#   ('banded', [(min, max, output), ...])       a fixed output for every input in min..max (inclusive);
+#                                               inputs in no band take the default output
+#
+# Spindle speeds are always clamped to CutterMinSpeed..CutterMaxSpeed.  With no SMapping every S word
+# becomes defaultSpindleSpeed; with no FMapping feed rates are passed through unchanged.
+#
+# The converter evaluates the tables a batch of lines at a time: all the S (or F) values of a batch are
+# mapped in one call.  If NumPy is installed each batch is evaluated as array operations (np.searchsorted);
+# otherwise a pure Python fallback is used, with a cache of the values seen so far (lightburn files only
+# use a handful of distinct powers and feeds).  Both give bit-for-bit the same results.
+
+from bisect import bisect_right
+from settings import SETTINGS
+
+numpy = None            # NumPy is optional, and slow to import: see _load_numpy()
+
+NUMPY_MIN_BATCH = 32    # below this many values, plain Python is quicker than building arrays
+
+LINEAR = 'linear'
+BANDED = 'banded'
+
+
+def _load_numpy():
+    # import NumPy the first time a batch is big enough to use it; returns it, or False if it isn't installed
+    global numpy
+    if numpy is None:
+        try:
+            import numpy as module
+        except ImportError:
+            module = False
+        numpy = module
+    return numpy
+
+
+class Remapper(object):
+    '''
+    maps a batch of input values through a lookup table, then clamps the results to lo..hi.
+    '''
+
+    def __init__(self, table=None, default=None, lo=None, hi=None):
+        # table: a mapping table (see above) or None
+        # default: output for inputs the table doesn't cover (None = pass the input through unchanged)
+        self.default = default
+        self.lo = lo
+        self.hi = hi
+        self.kind = None
+        self.cache = {}
+        if table is None:
+            return
+        kind, rows = table
+        if kind == LINEAR:
+            rows = sorted(rows)
+            self.xs = [float(r[0]) for r in rows]
+            self.ys = [float(r[1]) for r in rows]
+        elif kind == BANDED:
+            rows = sorted(rows)
+            self.mins = [float(r[0]) for r in rows]
+            self.maxs = [float(r[1]) for r in rows]
+            self.ys = [float(r[2]) for r in rows]
+        else:
+            raise ValueError("unknown mapping table type '{}' (expected '{}' or '{}')".format(kind, LINEAR, BANDED))
+        if not rows:
+            raise ValueError("mapping table '{}' has no entries".format(kind))
+        self.kind = kind
+
+    def map_values(self, values):
+        # map a list of input values, returning a list of outputs
+        if not values:
+            return []
+        if len(values) >= NUMPY_MIN_BATCH and _load_numpy():
+            return self._map_numpy(values)
+        cache = self.cache
+        out = []
+        for value in values:
+            result = cache.get(value)
+            if result is None:
+                result = cache[value] = self.map_value(value)
+            out.append(result)
+        return out
+
+    def map_value(self, value):
+        # map a single input value
+        if self.kind == LINEAR:
+            xs = self.xs
+            if value <= xs[0]:
+                result = self.ys[0]
+            elif value >= xs[-1]:
+                result = self.ys[-1]
+            else:
+                i = bisect_right(xs, value)
+                x0, x1 = xs[i - 1], xs[i]
+                y0, y1 = self.ys[i - 1], self.ys[i]
+                result = y0 + (y1 - y0) * (value - x0) / (x1 - x0)
+        elif self.kind == BANDED:
+            i = bisect_right(self.mins, value) - 1
+            if i >= 0 and value <= self.maxs[i]:
+                result = self.ys[i]
+            else:
+                result = value if self.default is None else self.default
+        else:
+            result = value if self.default is None else self.default
+        if self.lo is not None and result < self.lo:
+            result = self.lo
+        if self.hi is not None and result > self.hi:
+            result = self.hi
+        return float(result)
+
+    def _map_numpy(self, values):
+        v = numpy.asarray(values, dtype=float)
+        if self.kind == LINEAR:
+            # the same arithmetic as map_value() (rather than numpy.interp), so that a value maps to exactly
+            # the same float whichever way it is evaluated, and the output never depends on how lines are batched
+            xs = numpy.asarray(self.xs)
+            ys = numpy.asarray(self.ys)
+            if len(xs) == 1:
+                result = numpy.full_like(v, ys[0])
+            else:
+                i = numpy.clip(numpy.searchsorted(xs, v, side='right'), 1, len(xs) - 1)
+                x0, x1 = xs[i - 1], xs[i]
+                y0, y1 = ys[i - 1], ys[i]
+                with numpy.errstate(divide='ignore', invalid='ignore'):
+                    result = y0 + (y1 - y0) * (v - x0) / (x1 - x0)
+                result = numpy.where(v <= xs[0], ys[0], numpy.where(v >= xs[-1], ys[-1], result))
+        elif self.kind == BANDED:
+            i = numpy.searchsorted(self.mins, v, side='right') - 1
+            safe = numpy.clip(i, 0, len(self.ys) - 1)
+            inside = (i >= 0) & (v <= numpy.asarray(self.maxs)[safe])
+            fallback = v if self.default is None else numpy.full_like(v, self.default)
+            result = numpy.where(inside, numpy.asarray(self.ys)[safe], fallback)
+        else:
+            result = v.copy() if self.default is None else numpy.full_like(v, self.default)
+        if self.lo is not None or self.hi is not None:
+            result = numpy.clip(result, self.lo, self.hi)
+        return result.tolist()
+
+
+def spindle_remapper():
+    # laser power (S) -> spindle speed, from SMapping in mappings.py
+    return Remapper(SETTINGS.SMapping, SETTINGS.defaultSpindleSpeed, SETTINGS.CutterMinSpeed,
+                    SETTINGS.CutterMaxSpeed)
+
+
+def feed_remapper():
+    # laser feed rate (F) -> mill feed rate, from FMapping in mappings.py
+    return Remapper(SETTINGS.FMapping)
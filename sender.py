@@ -0,0 +1,278 @@
+# sender.py -- stream a gcode program to grblHAL with character-counting flow control.
+#
+# Sending a line and then waiting for its 'ok' (as validateSettings.py does) leaves the controller's serial
+# receive buffer empty while each reply makes its way back, so the planner can run dry on programs made of
+# many short moves.  This sender uses grbl's character-counting protocol instead:
+#
+#   - the controller has a receive buffer of 'ControllerRxBufferSize' bytes (mappings.py), a ring buffer
+#     that holds one byte less than its size,
+#   - every line sent is remembered, with its length, until its reply ('ok' or 'error:N') comes back,
+#   - a new line is written as soon as it fits in the buffer alongside all the lines still awaiting a reply.
+#
+# Replies are read by a background thread, so writing never waits for a reply it doesn't need, and the
+# receive buffer is kept as full as possible.  Errors are recorded against the line (number and text) that
+# caused them and streaming carries on; an ALARM stops the stream (nothing more is written after it).
+#
+# A G4 dwell or an M code can hold its 'ok' for a long time, so while lines are awaiting a reply and the
+# controller is quiet, the sender asks for a status report ('?', which grbl answers straight away): any reply,
+# status reports included, shows the controller is alive.  Only 'reply_timeout' seconds of complete silence
+# stop the stream.
+#
+# Lines are sent with comments and spaces removed (they only take up buffer space).  Progress -- lines/sec
+# and the fill of the receive buffer -- is reported every 'interval' seconds.
+#
+# The port is anything with pyserial's write()/readline()/close() (readline() must return b'' after a short
+# timeout); open_port() opens a serial device (or a pty) with pyserial, which is only needed for that.  See
+# fakegrbl.py for a stand-in controller on a pty, to try the sender out without a machine:
+#
+#   python fakegrbl.py                                     (prints the pty to use, e.g. /dev/pts/5)
+#   python millburn.py job.nc - | python sender.py - --port /dev/pts/5
+
+import re
+import sys
+import time
+import argparse
+import threading
+from collections import deque
+from settings import SETTINGS
+import diagnostics
+from gcodeio import open_input
+
+READ_TIMEOUT = 0.1          # seconds: port readline() timeout, so the reader thread can notice when to stop
+REPLY_TIMEOUT = 30.0        # seconds without any reply (with lines outstanding) before giving up (0 = never)
+STATUS_POLL = 1.0           # seconds without a reply (with lines outstanding) between status requests
+DEFAULT_INTERVAL = 1.0      # seconds between progress reports
+WAKE_TIME = 2.0             # seconds to let the controller start up (and to discard its start-up messages)
+
+_COMMENT_RE = re.compile(r'\([^)]*\)|;.*')
+
+
+class SendError(Exception):
+    pass
+
+
+def open_port(path=SETTINGS.SerialPort, baud=SETTINGS.SerialBaudRate):
+    '''
+    Open a serial port (or pty) for the sender, with pyserial.
+    '''
+    try:
+        import serial       # only needed to open a real port, so only imported here
+    except ImportError:
+        raise SendError('pyserial is needed to open {} (pip install pyserial)'.format(path))
+    return serial.serial_for_url(path, baud, timeout=READ_TIMEOUT)
+
+
+def clean_line(line):
+    # the line as it is sent: no comment, no whitespace, upper case (may be empty)
+    if '(' in line or ';' in line:
+        line = _COMMENT_RE.sub('', line)
+    return ''.join(line.split()).upper()
+
+
+class Sender(object):
+    '''
+    streams lines to a grbl controller, keeping fewer than rx_buffer_size bytes awaiting a reply.
+    '''
+
+    def __init__(self, port, rx_buffer_size=SETTINGS.ControllerRxBufferSize, diag=None, reply_timeout=REPLY_TIMEOUT):
+        self.port = port
+        self.rx_buffer_size = rx_buffer_size
+        self.diag = diagnostics.Diagnostics(diagnostics.SILENT) if diag is None else diag
+        self.reply_timeout = reply_timeout
+        self.pending = deque()          # (line number, text, length) of the lines awaiting a reply
+        self.buffered = 0               # bytes of those lines in the controller's receive buffer
+        self.cond = threading.Condition()
+        self.errors = []                # (line number, text, reply) of the lines the controller rejected
+        self.alarm = None
+        self.status = None              # the last status report ('<Idle|...>')
+        self.messages = 0               # other (informational) lines from the controller
+        self.sent = 0
+        self.acked = 0
+        self.bytes_sent = 0
+        self.max_buffered = 0
+        self.last_reply = time.monotonic()
+        self.last_poll = 0.0
+        self.stopping = False
+        self.reader = None
+
+    def wake(self, settle=WAKE_TIME):
+        # wake the controller up and discard its start-up messages, before any counting starts
+        self.port.write(b'\r\n\r\n')
+        deadline = time.monotonic() + settle
+        while time.monotonic() < deadline:
+            self.port.readline()
+
+    def start(self):
+        self.stopping = False
+        self.last_reply = time.monotonic()
+        self.reader = threading.Thread(target=self._read, name='grbl-reader', daemon=True)
+        self.reader.start()
+
+    def stop(self):
+        self.stopping = True
+        if self.reader is not None:
+            self.reader.join()
+            self.reader = None
+
+    def _read(self):
+        # the reader thread: match each 'ok'/'error' to the oldest line awaiting a reply
+        while not self.stopping:
+            raw = self.port.readline()
+            if not raw:
+                continue
+            reply = raw.decode('ascii', 'replace').strip()
+            if not reply:
+                continue
+            with self.cond:
+                self.last_reply = time.monotonic()
+                if reply == 'ok' or reply.startswith('error'):
+                    if self.pending:
+                        number, text, length = self.pending.popleft()
+                        self.buffered -= length
+                        self.acked += 1
+                        if reply != 'ok':
+                            self.errors.append((number, text, reply))
+                            self.diag.error('send', 'line {}: {} -> {}'.format(number, text, reply),
+                                            line=number, text=text, reply=reply)
+                    self.cond.notify_all()
+                elif reply.startswith('ALARM'):
+                    self.alarm = reply
+                    self.cond.notify_all()
+                elif reply.startswith('<'):
+                    self.status = reply
+                    self.cond.notify_all()
+                else:
+                    self.messages += 1
+                    if self.diag.trace:
+                        self.diag.event('send', 'message', reply)
+
+    def _wait(self, predicate):
+        # wait (holding self.cond) until predicate() is true; raise on an alarm (even if it already is, so
+        # nothing is written after one) or if replies stop coming
+        while True:
+            if self.alarm is not None:
+                raise SendError('controller reported {}'.format(self.alarm))
+            if predicate():
+                return
+            if self.pending:
+                now = time.monotonic()
+                quiet = now - self.last_reply
+                if self.reply_timeout and quiet > self.reply_timeout:
+                    raise SendError('no reply from the controller for {:.0f}s ({} lines outstanding)'.format(
+                        self.reply_timeout, len(self.pending)))
+                if quiet > STATUS_POLL and now - self.last_poll > STATUS_POLL:
+                    # a dwell or M code may be holding its 'ok': the status report shows the controller is alive
+                    self.port.write(b'?')
+                    self.last_poll = now
+            self.cond.wait(READ_TIMEOUT)
+
+    def send(self, lines, progress=None, interval=DEFAULT_INTERVAL):
+        '''
+        Stream gcode lines, then wait for the replies to all of them.
+
+        progress, if given, is called with stats() every 'interval' seconds.
+        '''
+        started = time.monotonic()
+        next_report = started + interval
+        size = self.rx_buffer_size
+        for number, line in enumerate(lines, 1):
+            text = clean_line(line)
+            if not text:
+                continue
+            data = (text + '\n').encode('ascii')
+            length = len(data)
+            if length >= size:
+                raise SendError('line {} does not fit in the receive buffer ({} bytes): {}'.format(number, size, text))
+            with self.cond:
+                self._wait(lambda: self.buffered + length < size)
+                self.pending.append((number, text, length))
+                self.buffered += length
+                self.max_buffered = max(self.max_buffered, self.buffered)
+            self.port.write(data)
+            self.sent += 1
+            self.bytes_sent += length
+            if self.diag.trace:
+                self.diag.event('send', 'line', text, line=number, buffered=self.buffered)
+            if progress is not None and time.monotonic() >= next_report:
+                progress(self.stats(started))
+                next_report = time.monotonic() + interval
+        while True:
+            with self.cond:
+                self._wait(lambda: not self.pending or time.monotonic() >= next_report)
+                if not self.pending:
+                    return self.stats(started)
+            if progress is not None:
+                progress(self.stats(started))
+            next_report = time.monotonic() + interval
+
+    def wait_idle(self, poll=0.2, timeout=None):
+        # poll the controller's status ('?', which needs no buffer space) until the machine is idle
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.cond:
+                self.status = None
+            self.port.write(b'?')
+            with self.cond:
+                end = time.monotonic() + poll
+                self._wait(lambda: self.status is not None or time.monotonic() >= end)
+                if self.status is not None and self.status.startswith('<Idle'):
+                    return
+            if deadline is not None and time.monotonic() >= deadline:
+                raise SendError('the controller did not become idle within {:.0f}s'.format(timeout))
+            time.sleep(poll)
+
+    def stats(self, started):
+        elapsed = max(time.monotonic() - started, 1e-9)
+        return {
+            'lines sent': self.sent,
+            'lines acknowledged': self.acked,
+            'errors': len(self.errors),
+            'lines/sec': round(self.acked / elapsed, 1),
+            'buffer fill': '{:.0%}'.format(self.buffered / self.rx_buffer_size),
+            'max buffer fill': '{:.0%}'.format(self.max_buffered / self.rx_buffer_size),
+            'elapsed (s)': round(elapsed, 2),
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='sender.py',
+                                     description='stream gcode to a grblHAL controller (character-counting flow control)')
+    parser.add_argument('inputfile', help="gcode file to send ('-' = stdin)")
+    parser.add_argument('--port', default=SETTINGS.SerialPort, help='serial port (default %(default)s)')
+    parser.add_argument('--baud', type=int, default=SETTINGS.SerialBaudRate, help='baud rate (default %(default)s)')
+    parser.add_argument('--rx-buffer', type=int, default=SETTINGS.ControllerRxBufferSize,
+                        help="size of the controller's receive buffer in bytes (default %(default)s)")
+    parser.add_argument('--interval', type=float, default=DEFAULT_INTERVAL,
+                        help='seconds between progress reports (default %(default)s)')
+    parser.add_argument('--reply-timeout', type=float, default=REPLY_TIMEOUT,
+                        help='seconds without any reply, status reports included, before giving up '
+                             '(0 = never; default %(default)s)')
+    parser.add_argument('--no-wait', action='store_true',
+                        help="don't wait for the machine to finish moving after the last reply")
+    diagnostics.add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    with diagnostics.from_args(args) as diag:
+        progress = None
+        if diag.level >= diagnostics.SUMMARY:
+            def progress(stats):
+                print('sent {lines sent}, acknowledged {lines acknowledged} ({lines/sec} lines/sec), '
+                      'buffer {buffer fill}'.format(**stats), file=diag.stream)
+        # imported here because controller.py imports this module (and, when this file is run as a script,
+        # gets its own copy of it -- so SendError must be the one controller.py sees)
+        from controller import ControllerSession, SendError
+        try:
+            with ControllerSession(args.port, args.baud, args.rx_buffer, diag,
+                                   reply_timeout=args.reply_timeout) as session:
+                with open_input(args.inputfile) as infil:
+                    stats = session.stream(infil, progress, args.interval, wait=not args.no_wait)
+                errors = session.sender.errors
+        except (SendError, OSError) as e:
+            diag.error('send', str(e))
+            return 1
+        diag.summary('send', stats)
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
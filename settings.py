@@ -0,0 +1,93 @@
+# settings.py -- the settings in mappings.py, loaded and checked once, as one typed Settings object.
+#
+# mappings.py is still the file to edit.  Rather than each module star-importing it, they all read their
+# settings from SETTINGS, built here the first time any of them is imported:
+#
+#   from settings import SETTINGS
+#   yield "G0 Z{:.2f}\n".format(SETTINGS.ZClearance)
+#
+# Every setting's type is checked as it is loaded, so e.g. ZClearance = '3' is reported by name when a tool
+# starts, rather than as a TypeError in the middle of a conversion.  (The S/F mapping tables themselves are
+# checked by remap.py.)
+
+import importlib
+
+_NUMBER = (int, float)
+_TABLE = (tuple, list, type(None))
+
+# name -> the type(s) its value may have
+FIELDS = (
+    ('GodeHeader', str),
+    ('LaserCuttingPowerMin', _NUMBER),
+    ('LaserCuttingPowerMax', _NUMBER),
+    ('LaserEngravingPowerMin', _NUMBER),
+    ('LaserEngravingPowerMax', _NUMBER),
+    ('ZClearance', _NUMBER),
+    ('MaterialThickness', _NUMBER),
+    ('MaterialType', str),
+    ('CutterMinSpeed', _NUMBER),
+    ('CutterMaxSpeed', _NUMBER),
+    ('defaultSpindleSpeed', _NUMBER),
+    ('defaultFeedRate', _NUMBER),
+    ('DepthPerPass', _NUMBER),
+    ('NumberOfPasses', int),
+    ('PlungeFeedRate', _NUMBER),
+    ('ChordalTolerance', _NUMBER),
+    ('RapidRateXY', _NUMBER),
+    ('RapidRateZ', _NUMBER),
+    ('AccelerationXY', _NUMBER),
+    ('AccelerationZ', _NUMBER),
+    ('JunctionDeviation', _NUMBER),
+    ('PlannerBlocks', int),
+    ('ZBugDwell', _NUMBER),
+    ('SMapping', _TABLE),
+    ('FMapping', _TABLE),
+    ('SerialPort', str),
+    ('SerialBaudRate', int),
+    ('ControllerRxBufferSize', int),
+    ('CacheDir', str),
+    ('CacheMaxBytes', int),
+)
+
+
+class SettingsError(ValueError):
+    pass
+
+
+def _type_names(kinds):
+    kinds = kinds if isinstance(kinds, tuple) else (kinds,)
+    return ' or '.join('None' if kind is type(None) else kind.__name__ for kind in kinds)
+
+
+class Settings(object):
+    '''
+    the settings, as attributes named as in mappings.py.
+    '''
+    __slots__ = tuple(name for name, kinds in FIELDS)
+
+    def __init__(self, values, source='mappings.py'):
+        # values: a dict of setting name -> value (e.g. a module's vars()); other names in it are ignored
+        for name, kinds in FIELDS:
+            if name not in values:
+                raise SettingsError('{}: {} is missing'.format(source, name))
+            value = values[name]
+            if not isinstance(value, kinds) or isinstance(value, bool):
+                raise SettingsError('{}: {} should be {}, not {!r}'.format(source, name, _type_names(kinds), value))
+            setattr(self, name, value)
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return 'Settings({})'.format(', '.join('{}={!r}'.format(name, getattr(self, name)) for name in self.__slots__))
+
+
+def load_settings(module='mappings'):
+    '''
+    Load (and check) the settings from a module, by name.
+    '''
+    loaded = importlib.import_module(module)
+    return Settings(vars(loaded), module + '.py')
+
+
+SETTINGS = load_settings()
@@ -0,0 +1,314 @@
+# simplify.py -- geometric simplification: merge collinear G1 segments and fit G2/G3 arcs.
+#
+# lightburn writes curves as dense chains of very short G1 moves.  Each move is a separate block for the
+# grblHAL planner, so long chains of them starve the planner (the machine slows down to process them)
+# and make the files huge.  This stage runs on the converted (mill) program and replaces each chain of
+# consecutive G1 XY moves with fewer moves, none of which strays more than 'tolerance' mm (the chordal
+# tolerance, 'ChordalTolerance' in mappings.py) from the original path:
+#
+#   - runs of points that lie on a circular arc are replaced by a single G2/G3 arc move (centre given
+#     by I/J offsets from the arc start, in the XY plane),
+#   - the remaining points are reduced with the Douglas-Peucker algorithm, which in particular merges
+#     collinear (and nearly collinear) segments.
+#
+# Points that are kept are written out as the original lines, unchanged -- except a line that leaves out X
+# or Y (lightburn omits an axis that doesn't change) after a dropped point: the axis it leaves out would
+# now come from an earlier point, so it is written out as 'G1 X.. Y..' in full.  Chains are broken by anything
+# other than a plain G1 X/Y move (Z moves, rapids, comments, M codes ...), and by a change of S or F, so
+# the cutting depth, speeds and feeds are exactly those of the original program.  At most 'max_chain'
+# points are held in memory at a time.  A chain that now ends in an arc leaves G2/G3 as the motion mode,
+# so the next move that relies on the mode (e.g. 'X10 Y5', with no G word) is given an explicit G1.
+
+import math
+from settings import SETTINGS
+from gcodewords import parse_line, format_number, add_words
+
+DEFAULT_MAX_CHAIN = 10000     # points simplified together
+MIN_ARC_POINTS = 4            # an arc must replace at least this many points (3 moves)
+MAX_ARC_POINTS = 500          # longest run of points tested as one arc
+MAX_ARC_RADIUS = 5000.0       # mm: anything flatter is left for Douglas-Peucker
+
+_CHAIN_WORDS = frozenset('GXYSF')
+_ARC_CODES = ('G2', 'G3')
+_AXIS_WORDS = frozenset('XYZ')
+_NON_MODAL = (10.0, 28.0, 30.0, 92.0)     # G codes whose X/Y/Z words are not a move in the motion mode
+
+
+def _circle(a, b, c):
+    # centre and radius of the circle through three points, or None if they are (nearly) collinear
+    bx, by = b[0] - a[0], b[1] - a[1]
+    cx, cy = c[0] - a[0], c[1] - a[1]
+    d = 2.0 * (bx * cy - by * cx)
+    if abs(d) < 1e-12:
+        return None
+    b2 = bx * bx + by * by
+    c2 = cx * cx + cy * cy
+    ux = (cy * b2 - by * c2) / d
+    uy = (bx * c2 - cx * b2) / d
+    return (a[0] + ux, a[1] + uy), math.hypot(ux, uy)
+
+
+def _fit_arc(points, i, j, tolerance):
+    # if points[i..j] lie on one arc (within tolerance), return (centre, clockwise, deviation)
+    fit = _circle(points[i], points[(i + j) // 2], points[j])
+    if fit is None:
+        return None
+    (ox, oy), r = fit
+    if r > MAX_ARC_RADIUS:
+        return None
+    deviation = 0.0
+    sweep = 0.0
+    direction = 0
+    angle = math.atan2(points[i][1] - oy, points[i][0] - ox)
+    for k in range(i + 1, j + 1):
+        px, py = points[k]
+        d = abs(math.hypot(px - ox, py - oy) - r)
+        # the arc also bulges away from each original (straight) move, by its sagitta
+        half = math.hypot(px - points[k - 1][0], py - points[k - 1][1]) / 2.0
+        if half >= r:
+            return None
+        d = max(d, r - math.sqrt(r * r - half * half))
+        if d > tolerance:
+            return None
+        deviation = max(deviation, d)
+        next_angle = math.atan2(py - oy, px - ox)
+        step = next_angle - angle
+        if step > math.pi:
+            step -= 2 * math.pi
+        elif step < -math.pi:
+            step += 2 * math.pi
+        sign = 1 if step > 0 else -1
+        if direction == 0:
+            direction = sign
+        elif sign != direction or step == 0:
+            return None
+        sweep += abs(step)
+        angle = next_angle
+    if sweep >= 2 * math.pi - 1e-6:
+        return None
+    return (ox, oy), direction < 0, deviation
+
+
+def _straight(points, i, j, tolerance):
+    # do points[i..j] all lie within tolerance of the straight line from points[i] to points[j]?
+    ax, ay = points[i]
+    dx, dy = points[j][0] - ax, points[j][1] - ay
+    length = math.hypot(dx, dy)
+    if length == 0.0:
+        return False
+    for k in range(i + 1, j):
+        if abs((points[k][0] - ax) * dy - (points[k][1] - ay) * dx) / length > tolerance:
+            return False
+    return True
+
+
+def _longest_arc(points, i, limit, tolerance):
+    # the longest arc starting at points[i] and ending no later than points[limit]: (j, fit) or None.
+    # Arc lengths are probed by doubling and then bisection, so each start point costs
+    # O(k log k) rather than O(k^2) for an arc of k points.
+    j = i + MIN_ARC_POINTS - 1
+    if j > limit:
+        return None
+    fit = _fit_arc(points, i, j, tolerance)
+    if fit is None:
+        return None
+    best = (j, fit)
+    bad = None
+    while bad is None:
+        probe = min(i + 2 * (best[0] - i), limit)
+        if probe == best[0]:
+            break
+        fit = _fit_arc(points, i, probe, tolerance)
+        if fit is None:
+            bad = probe
+        else:
+            best = (probe, fit)
+    while bad is not None and bad - best[0] > 1:
+        probe = (best[0] + bad) // 2
+        fit = _fit_arc(points, i, probe, tolerance)
+        if fit is None:
+            bad = probe
+        else:
+            best = (probe, fit)
+    # a run that is straight to within tolerance is better left to Douglas-Peucker
+    if _straight(points, i, best[0], tolerance):
+        return None
+    return best
+
+
+def _douglas_peucker(points, first, last, tolerance, keep):
+    # mark the points of points[first..last] to keep; returns the largest deviation of a dropped point
+    deviation = 0.0
+    stack = [(first, last)]
+    while stack:
+        a, b = stack.pop()
+        if b <= a + 1:
+            continue
+        ax, ay = points[a]
+        bx, by = points[b]
+        dx, dy = bx - ax, by - ay
+        length = math.hypot(dx, dy)
+        worst = -1.0
+        index = a
+        for k in range(a + 1, b):
+            px, py = points[k]
+            if length > 0.0:
+                # distance from the segment a-b (not just the line through it)
+                t = ((px - ax) * dx + (py - ay) * dy) / (length * length)
+                t = min(max(t, 0.0), 1.0)
+                d = math.hypot(px - (ax + t * dx), py - (ay + t * dy))
+            else:
+                d = math.hypot(px - ax, py - ay)
+            if d > worst:
+                worst = d
+                index = k
+        if worst > tolerance:
+            keep[index] = True
+            stack.append((a, index))
+            stack.append((index, b))
+        else:
+            deviation = max(deviation, worst)
+    return deviation
+
+
+def _simplify_chain(points, lines, tolerance, stats):
+    # points[0] is the position before the chain; points[k] is the target of lines[k - 1]
+    n = len(points) - 1
+    out = []
+    run_start = 0
+    i = 0
+
+    def flush_run(end):
+        keep = [False] * (end + 1)
+        keep[end] = True
+        stats['max deviation'] = max(stats['max deviation'],
+                                     _douglas_peucker(points, run_start, end, tolerance, keep))
+        previous = run_start
+        for k in range(run_start + 1, end + 1):
+            if keep[k]:
+                line = lines[k - 1]
+                if previous != k - 1:
+                    words = parse_line(line)
+                    if 'X' not in words or 'Y' not in words:
+                        line = "G1 X{} Y{}\n".format(format_number(points[k][0]), format_number(points[k][1]))
+                out.append(line)
+                previous = k
+
+    while i <= n - (MIN_ARC_POINTS - 1):
+        best = _longest_arc(points, i, min(n, i + MAX_ARC_POINTS - 1), tolerance)
+        if best is None:
+            i += 1
+            continue
+        j, ((ox, oy), clockwise, deviation) = best
+        if i > run_start:
+            flush_run(i)
+        sx, sy = points[i]
+        ex, ey = points[j]
+        out.append("{} X{} Y{} I{} J{}\n".format('G2' if clockwise else 'G3',
+                                                 format_number(ex), format_number(ey),
+                                                 format_number(ox - sx), format_number(oy - sy)))
+        stats['arcs'] += 1
+        stats['max deviation'] = max(stats['max deviation'], deviation)
+        run_start = i = j
+    if n > run_start:
+        flush_run(n)
+
+    # the chain's S/F words (only ever on its first line) must survive if that line was replaced
+    if out and out[0] is not lines[0]:
+        words = parse_line(lines[0])
+        extra = ''
+        for letter, text in words.pairs:
+            if letter in 'SF':
+                extra += ' ' + letter + text
+        if extra:
+            out[0] = add_words(out[0], extra)
+    stats['moves in'] += n
+    stats['moves out'] += len(out)
+    return out
+
+
+def simplify_lines(lines, tolerance=SETTINGS.ChordalTolerance, max_chain=DEFAULT_MAX_CHAIN, stats=None):
+    '''
+    Generator: yield the (converted) gcode lines with chains of G1 moves simplified to within
+    'tolerance' mm of the original path.
+
+    stats, if given, is a dict that is filled with counts for summary().
+    '''
+    if stats is None:
+        stats = {}
+    for key in ('moves in', 'moves out', 'arcs'):
+        stats.setdefault(key, 0)
+    stats.setdefault('max deviation', 0.0)
+
+    x = y = None             # current position (None = unknown)
+    absolute = True
+    points = []              # the current chain
+    chain = []
+    arc_mode = False         # is the motion mode an arc written in place of the original G1 moves?
+
+    for line in lines:
+        words = parse_line(line)
+        motion = words.motion
+        if (absolute and motion == 1 and x is not None and y is not None and words.comment is None
+                and 'G' in words and len(words.gcodes) == 1 and _CHAIN_WORDS.issuperset(words)
+                and ('X' in words or 'Y' in words)):
+            new_speeds = 'S' in words or 'F' in words
+            if chain and (new_speeds or len(chain) >= max_chain):
+                output = _simplify_chain(points, chain, tolerance, stats)
+                for out in output:
+                    yield out
+                arc_mode = output[-1].startswith(_ARC_CODES)
+                points = [points[-1]]
+                chain = []
+            if not chain:
+                points = [(x, y)]
+            x = words.get('X', x)
+            y = words.get('Y', y)
+            points.append((x, y))
+            chain.append(line)
+            continue
+
+        if chain:
+            output = _simplify_chain(points, chain, tolerance, stats)
+            for out in output:
+                yield out
+            arc_mode = output[-1].startswith(_ARC_CODES)
+            chain = []
+        gcodes = words.gcodes
+        modal_move = (motion is None and not _AXIS_WORDS.isdisjoint(words)
+                      and not any(g in _NON_MODAL for g in gcodes))
+        if motion is not None:
+            arc_mode = False
+        elif arc_mode and modal_move:
+            # a move in the motion mode, which was G1 before the arc replaced the chain's last moves
+            line = 'G1 ' + line
+            arc_mode = False
+        if 90.0 in gcodes:
+            absolute = True
+        if 91.0 in gcodes:
+            absolute = False
+        if any(g in (28.0, 30.0, 53.0, 92.0, 10.0, 20.0, 21.0) for g in gcodes) or not absolute:
+            x = y = None
+        elif motion is not None or modal_move:
+            x = words.get('X', x)
+            y = words.get('Y', y)
+        yield line
+
+    if chain:
+        for out in _simplify_chain(points, chain, tolerance, stats):
+            yield out
+
+
+def summary(stats):
+    '''
+    Summarise simplification stats: moves in/out, reduction ratio and maximum deviation.
+    '''
+    moves_in = stats['moves in']
+    moves_out = stats['moves out']
+    return {
+        'G1 moves in': moves_in,
+        'moves out': moves_out,
+        'arcs': stats['arcs'],
+        'reduction': '{:.1f}x'.format(moves_in / moves_out) if moves_out else '-',
+        'max deviation (mm)': round(stats['max deviation'], 4),
+    }
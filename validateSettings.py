@@ -1,32 +1,30 @@
-import serial
-
-
-def send_command(ser, command):
-    ser.write((command + '\n').encode())
-    response = ser.readline().decode().strip()
-    return response
-
-def verify_settings(expected_settings):
-    # Connect to the CNC machine
-    ser = serial.Serial('/dev/ttyUSB0', 115200, timeout=1)
-    
-    # Query current settings
-    send_command(ser, "$$")
-    response = ser.read(ser.in_waiting).decode().split('\n')
-    
-    # Parse current settings
-    current_settings = {}
-    for line in response:
-        if line.startswith('$'):
-            param, value = line.split('=')
-            current_settings[param] = value
-    
+
+# validateSettings.py -- preflight checks of the controller's settings, and offset resets.
+#
+# Both functions work over a ControllerSession (controller.py), so a preflight opens the port once, reads '$$'
+# once (the settings are cached for the rest of the session) and sends all the G10 offset writes as one batch.
+# Without a session they open (and close) their own.
+
+import sys
+import argparse
+from settings import SETTINGS
+from controller import ControllerSession, SendError
+
+
+def verify_settings(expected_settings, session=None):
+    if session is None:
+        with ControllerSession() as session:
+            return verify_settings(expected_settings, session)
+
+    # Query current settings (read once per session)
+    current_settings = session.settings()
+
     # Verify settings
     for param, expected_value in expected_settings.items():
         if current_settings.get(param) != expected_value:
             print(f"Mismatch in {param}: expected {expected_value}, found {current_settings.get(param)}")
             return False
-    
+
     return True
 
 expected_settings = {
@@ -36,24 +34,42 @@ expected_settings = {
     # Add more settings as needed
 }
 
-if verify_settings(expected_settings):
-    print("Machine settings are correct.")
-else:
-    print("Machine settings are incorrect. Halting execution.")
+def reset_G54_offsets_to_Zero(session=None):
+    if session is None:
+        with ControllerSession() as session:
+            return reset_G54_offsets_to_Zero(session)
+
+    session.write_offsets([
+        # reset all offests to zero
+        "G10 L2 P0 X0 Y0 Z0",
+        # Reset G54, G55, G56 offsets to zero
+        "G10 L20 P0 X0 Y0 Z0",
+        "G10 L20 P1 X0 Y0 Z0",
+        "G10 L20 P2 X0 Y0 Z0",
+        "G10 L20 P3 X0 Y0 Z0",
+    ])
 
-def reset_G54_offsets_to_Zero():
 
-    # Connect to the CNC machine
-    ser = serial.Serial('/dev/ttyUSB0', 115200, timeout=1)
-    # reset all offests to zero
-    send_command(ser, "G10 L2 P0 X0 Y0 Z0")
-    # Reset G54, G55, G56 offsets to zero
-    send_command(ser, "G10 L20 P0 X0 Y0 Z0")
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='validateSettings.py', description="check the controller's settings")
+    parser.add_argument('--port', default=SETTINGS.SerialPort, help='serial port (default %(default)s)')
+    parser.add_argument('--reset-offsets', action='store_true',
+                        help='then reset the G54-G56 work offsets to zero')
+    args = parser.parse_args(argv)
 
-    send_command(ser, "G10 L20 P1 X0 Y0 Z0")
-    send_command(ser, "G10 L20 P2 X0 Y0 Z0")
-    send_command(ser, "G10 L20 P3 X0 Y0 Z0")
-    
-    ser.close()
+    try:
+        with ControllerSession(args.port) as session:
+            if not verify_settings(expected_settings, session):
+                print("Machine settings are incorrect. Halting execution.")
+                return 1
+            print("Machine settings are correct.")
+            if args.reset_offsets:
+                reset_G54_offsets_to_Zero(session)
+    except SendError as e:
+        print(e, file=sys.stderr)
+        return 1
+    return 0
 
 
+if __name__ == '__main__':
+    sys.exit(main())